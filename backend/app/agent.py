@@ -1,9 +1,10 @@
-import os
-from datetime import datetime
 from typing import Annotated, Literal, Optional
 from typing_extensions import TypedDict
+import asyncio
 import logging
+import os
 import re
+import uuid
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -78,13 +79,12 @@ def _update_and_log_token_usage(thread_id: str, usage: dict) -> None:
     )
 
 from langgraph.graph import StateGraph, START, END
-from langgraph.graph.message import AnyMessage, add_messages
+from langgraph.graph.message import AnyMessage
 from langgraph.prebuilt import tools_condition, ToolNode
-from langchain_google_genai import ChatGoogleGenerativeAI
+from .llm_providers import get_chat_model
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import Runnable, RunnableConfig
-from langchain_core.messages import ToolMessage, HumanMessage, AIMessage
-from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from langchain_core.messages import ToolMessage, HumanMessage, AIMessage, SystemMessage
 from langmem.short_term import SummarizationNode, RunningSummary
 
 from .tools import (
@@ -109,7 +109,13 @@ from .tools import (
     solicitar_otp,
     verificar_codigo_otp,
     generar_certificado_tributario,
+    recuperar_fragmentos,
 )
+from .prerouter import prerouter, PREROUTER_ENABLED, PREROUTER_SHADOW
+from .prompt_cache import cached_agent_runnable, prompt_cache_usage, prompt_date
+from .token_counts import add_messages_counted, count_tokens_cached, history_tokens
+from .history_compaction import compact_answered_tool_outputs
+from .tracing import traced, traced_config
 
 # --- State Definition ---
 
@@ -122,7 +128,8 @@ def update_dialog_stack(left: list[str], right: Optional[str]) -> list[str]:
     return left + [right]
 
 class State(TypedDict):
-    messages: Annotated[list[AnyMessage], add_messages]
+    # add_messages + cached per-message token counts (see token_counts.py)
+    messages: Annotated[list[AnyMessage], add_messages_counted]
     dialog_state: Annotated[
         list[
             Literal[
@@ -161,54 +168,83 @@ def _should_force_certificados_tool_call(state: State) -> bool:
     return has_otp or has_long_number
 
 class Assistant:
+    """
+    Graph node wrapping an agent runnable.
+
+    Exposes both a sync entry point (__call__, used by graph.invoke) and an
+    async one (acall, used by graph.ainvoke) that share the same retry and
+    logging logic; register it with _assistant_node() so LangGraph picks
+    the right one for the execution mode.
+    """
+
     def __init__(self, runnable: Runnable, name: str = "Unknown"):
         self.runnable = runnable
         self.name = name
 
-    def __call__(self, state: State, config: RunnableConfig):
-        logger.info(f"dY- Agent '{self.name}' is processing...")
-        attempt = 0
-        while True:
-            result = self.runnable.invoke(state)
-            if not result.tool_calls and (
-                not result.content
-                or isinstance(result.content, list)
-                and not result.content[0].get("text")
-            ):
-                messages = state["messages"] + [("user", "Respond with a real output.")]
-                state = {**state, "messages": messages}
-            elif self.name == "Certificados Agent" and _should_force_certificados_tool_call(state):
-                # Force tool usage when user already provided numeric data or OTP code.
-                last_msg = state["messages"][-1]
-                content = getattr(last_msg, "content", "") or ""
-                has_otp = re.search(r"\b\d{6}\b", str(content)) is not None
-                if has_otp:
-                    force_msg = "OBLIGATORIO: El usuario acaba de proporcionar un código de 6 dígitos. Llama a `verificar_codigo_otp` AHORA con la cédula y el código. No respondas con texto."
-                else:
-                    force_msg = "OBLIGATORIO: El usuario acaba de proporcionar su cédula. Llama a `solicitar_otp` AHORA con ese número de cédula. No respondas con texto."
-                messages = state["messages"] + [("user", force_msg)]
-                state = {**state, "messages": messages}
+    def _retry_state(self, state: State, result) -> Optional[State]:
+        """Return the state to retry with, or None when the result is final."""
+        if not result.tool_calls and (
+            not result.content
+            or isinstance(result.content, list)
+            and not result.content[0].get("text")
+        ):
+            messages = state["messages"] + [("user", "Respond with a real output.")]
+            return {**state, "messages": messages}
+        if self.name == "Certificados Agent" and _should_force_certificados_tool_call(state):
+            # Force tool usage when user already provided numeric data or OTP code.
+            last_msg = state["messages"][-1]
+            content = getattr(last_msg, "content", "") or ""
+            has_otp = re.search(r"\b\d{6}\b", str(content)) is not None
+            if has_otp:
+                force_msg = "OBLIGATORIO: El usuario acaba de proporcionar un código de 6 dígitos. Llama a `verificar_codigo_otp` AHORA con la cédula y el código. No respondas con texto."
             else:
-                break
+                force_msg = "OBLIGATORIO: El usuario acaba de proporcionar su cédula. Llama a `solicitar_otp` AHORA con ese número de cédula. No respondas con texto."
+            messages = state["messages"] + [("user", force_msg)]
+            return {**state, "messages": messages}
+        return None
 
-            attempt += 1
-            if attempt >= 3:
-                break
-
-        
+    def _finish(self, result, config: RunnableConfig) -> dict:
         # Log tool calls if any
         if result.tool_calls:
             for tc in result.tool_calls:
                 logger.info(f"🔧 Agent '{self.name}' called tool: {tc['name']} with args: {tc.get('args', {})}")
         else:
             logger.info(f"💬 Agent '{self.name}' responded with content (no tool call)")
-        
+
         thread_id = (config or {}).get("configurable", {}).get("thread_id", "unknown")
         usage = _extract_token_usage(result)
         _update_and_log_token_usage(thread_id, usage)
+        prompt_cache_usage.record(self.name, result)
 
         return {"messages": result}
 
+    def __call__(self, state: State, config: RunnableConfig):
+        logger.info(f"dY- Agent '{self.name}' is processing...")
+        state = _summary_window(state)
+        for _attempt in range(3):
+            result = self.runnable.invoke(state)
+            retry_state = self._retry_state(state, result)
+            if retry_state is None:
+                break
+            state = retry_state
+        return self._finish(result, config)
+
+    async def acall(self, state: State, config: RunnableConfig):
+        logger.info(f"dY- Agent '{self.name}' is processing (async)...")
+        state = _summary_window(state)
+        for _attempt in range(3):
+            result = await self.runnable.ainvoke(state)
+            retry_state = self._retry_state(state, result)
+            if retry_state is None:
+                break
+            state = retry_state
+        return self._finish(result, config)
+
+
+def _assistant_node(assistant: Assistant) -> RunnableLambda:
+    """Register an Assistant with both its sync and async entry points."""
+    return RunnableLambda(assistant, afunc=assistant.acall, name=assistant.name)
+
 def create_entry_node(assistant_name: str, new_dialog_state: str):
     def entry_node(state: State) -> dict:
         tool_call_id = state["messages"][-1].tool_calls[0]["id"]
@@ -244,13 +280,7 @@ def pop_dialog_state(state: State) -> dict:
 
 # --- Prompts & Runnables ---
 
-# Support both GEMINI_API_KEY (project convention) and GOOGLE_API_KEY (langchain default)
-_GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
-
-llm = ChatGoogleGenerativeAI(
-    model="gemini-3.1-flash-lite-preview",
-    google_api_key=_GEMINI_API_KEY,
-) # Using Gemini for routing and reasoning
+llm = get_chat_model("gemini-3.1-flash-lite-preview", role="agent")  # Using Gemini for routing and reasoning
 
 # Intent-Preserving Summarization Prompt
 SUMMARIZATION_PROMPT = """Tu objetivo es comprimir la conversación sin perder los 'triggers' de enrutamiento.
@@ -295,14 +325,14 @@ primary_prompt = ChatPromptTemplate.from_messages(
             "- Si la pregunta es ambigua, HAZ PREGUNTAS DE SEGUIMIENTO en lugar de asumir.\n"
             "- Si el tema no es de COOTRADECUN, responde: 'Lo siento, solo puedo ayudarte con temas de COOTRADECUN.'\n\n"
             
-            "Current time: {time}."
+            "Current date: {date}."
         ),
         ("placeholder", "{messages}"),
     ]
-).partial(time=datetime.now)
+).partial(date=prompt_date)
 
 primary_tools = [ToAtencionAsociado, ToNominas, ToVivienda, ToConvenios, ToCartera, ToContabilidad, ToTesoreria, ToCredito]  # ToCertificados deshabilitado temporalmente
-primary_runnable = primary_prompt | llm.bind_tools(primary_tools)
+primary_runnable = cached_agent_runnable("primary", primary_prompt, llm, primary_tools)
 
 # 2. Atencion Asociado Agent
 asociado_prompt = ChatPromptTemplate.from_messages(
@@ -330,14 +360,14 @@ asociado_prompt = ChatPromptTemplate.from_messages(
             "- Responde de forma CONCISA: máximo 3-4 puntos clave.\n"
             "- Usa bullet points o listas, NO párrafos largos.\n"
             "- Al final ofrece: '¿Quieres que te explique alguno con más detalle?'\n"
-            "\nCurrent time: {time}."
+            "\nCurrent date: {date}."
         ),
         ("placeholder", "{messages}"),
     ]
-).partial(time=datetime.now)
+).partial(date=prompt_date)
 
-asociado_tools = [consultar_atencion_asociado, CompleteOrEscalate]
-asociado_runnable = asociado_prompt | llm.bind_tools(asociado_tools)
+asociado_tools = [consultar_atencion_asociado, recuperar_fragmentos, CompleteOrEscalate]
+asociado_runnable = cached_agent_runnable("asociado", asociado_prompt, llm, asociado_tools)
 
 # 3. Nominas Agent
 nominas_prompt = ChatPromptTemplate.from_messages(
@@ -358,14 +388,14 @@ nominas_prompt = ChatPromptTemplate.from_messages(
             "**REGLA DE ESCALACIÓN**: Si el usuario pregunta sobre CERTIFICADOS (tributario, aportes, paz y salvo), "
             "VIVIENDA, ASOCIACIÓN, CONVENIOS o CARTERA → usa CompleteOrEscalate INMEDIATAMENTE.\n\n"
             "**REGLA DE FORMATO**: Responde CONCISO (máx 3-4 puntos). Ofrece expandir detalles si lo necesita.\n"
-            "\nCurrent time: {time}."
+            "\nCurrent date: {date}."
         ),
         ("placeholder", "{messages}"),
     ]
-).partial(time=datetime.now)
+).partial(date=prompt_date)
 
-nominas_tools = [consultar_nominas, CompleteOrEscalate]
-nominas_runnable = nominas_prompt | llm.bind_tools(nominas_tools)
+nominas_tools = [consultar_nominas, recuperar_fragmentos, CompleteOrEscalate]
+nominas_runnable = cached_agent_runnable("nominas", nominas_prompt, llm, nominas_tools)
 
 # 4. Vivienda Agent
 vivienda_prompt = ChatPromptTemplate.from_messages(
@@ -388,14 +418,14 @@ vivienda_prompt = ChatPromptTemplate.from_messages(
             "**REGLA DE ESCALACIÓN**: Si el usuario pregunta sobre CERTIFICADOS (tributario, aportes, paz y salvo), "
             "NÓMINAS, ASOCIACIÓN, CONVENIOS o CARTERA → usa CompleteOrEscalate INMEDIATAMENTE.\n\n"
             "**REGLA DE FORMATO**: Responde CONCISO (máx 3-4 puntos). Ofrece expandir detalles si lo necesita.\n"
-            "\nCurrent time: {time}."
+            "\nCurrent date: {date}."
         ),
         ("placeholder", "{messages}"),
     ]
-).partial(time=datetime.now)
+).partial(date=prompt_date)
 
-vivienda_tools = [consultar_vivienda, CompleteOrEscalate]
-vivienda_runnable = vivienda_prompt | llm.bind_tools(vivienda_tools)
+vivienda_tools = [consultar_vivienda, recuperar_fragmentos, CompleteOrEscalate]
+vivienda_runnable = cached_agent_runnable("vivienda", vivienda_prompt, llm, vivienda_tools)
 
 # 5. Convenios Agent
 convenios_prompt = ChatPromptTemplate.from_messages(
@@ -418,14 +448,14 @@ convenios_prompt = ChatPromptTemplate.from_messages(
             "**REGLA DE ESCALACIÓN**: Si el usuario pregunta sobre CERTIFICADOS (tributario, aportes, paz y salvo), "
             "VIVIENDA, NÓMINAS, ASOCIACIÓN o CARTERA → usa CompleteOrEscalate INMEDIATAMENTE.\n\n"
             "**REGLA DE FORMATO**: Responde CONCISO (máx 3-4 puntos). Ofrece expandir detalles si lo necesita.\n"
-            "\nCurrent time: {time}."
+            "\nCurrent date: {date}."
         ),
         ("placeholder", "{messages}"),
     ]
-).partial(time=datetime.now)
+).partial(date=prompt_date)
 
-convenios_tools = [consultar_convenios, CompleteOrEscalate]
-convenios_runnable = convenios_prompt | llm.bind_tools(convenios_tools)
+convenios_tools = [consultar_convenios, recuperar_fragmentos, CompleteOrEscalate]
+convenios_runnable = cached_agent_runnable("convenios", convenios_prompt, llm, convenios_tools)
 
 # 6. Cartera Agent
 cartera_prompt = ChatPromptTemplate.from_messages(
@@ -450,14 +480,14 @@ cartera_prompt = ChatPromptTemplate.from_messages(
             "**REGLA DE ESCALACIÓN**: Si el usuario pregunta sobre CERTIFICADOS (tributario, aportes, paz y salvo), "
             "VIVIENDA, NÓMINAS, ASOCIACIÓN o CONVENIOS → usa CompleteOrEscalate INMEDIATAMENTE.\n\n"
             "**REGLA DE FORMATO**: Responde CONCISO (máx 3-4 puntos). Ofrece expandir detalles si lo necesita.\n"
-            "\nCurrent time: {time}."
+            "\nCurrent date: {date}."
         ),
         ("placeholder", "{messages}"),
     ]
-).partial(time=datetime.now)
+).partial(date=prompt_date)
 
-cartera_tools = [consultar_cartera, CompleteOrEscalate]
-cartera_runnable = cartera_prompt | llm.bind_tools(cartera_tools)
+cartera_tools = [consultar_cartera, recuperar_fragmentos, CompleteOrEscalate]
+cartera_runnable = cached_agent_runnable("cartera", cartera_prompt, llm, cartera_tools)
 
 # 7. Contabilidad Agent
 contabilidad_prompt = ChatPromptTemplate.from_messages(
@@ -481,14 +511,14 @@ contabilidad_prompt = ChatPromptTemplate.from_messages(
             "- CERTIFICADOS (tributario personales, OTP) → ESCALAR\n"
             "- VIVIENDA, NÓMINAS, ASOCIACIÓN, CONVENIOS, CARTERA, TESORERÍA → ESCALAR\n\n"
             "**REGLA DE FORMATO**: Responde CONCISO (máx 3-4 puntos). Ofrece expandir detalles si lo necesita.\n"
-            "\nCurrent time: {time}."
+            "\nCurrent date: {date}."
         ),
         ("placeholder", "{messages}"),
     ]
-).partial(time=datetime.now)
+).partial(date=prompt_date)
 
-contabilidad_tools = [consultar_contabilidad, CompleteOrEscalate]
-contabilidad_runnable = contabilidad_prompt | llm.bind_tools(contabilidad_tools)
+contabilidad_tools = [consultar_contabilidad, recuperar_fragmentos, CompleteOrEscalate]
+contabilidad_runnable = cached_agent_runnable("contabilidad", contabilidad_prompt, llm, contabilidad_tools)
 
 # 8. Tesoreria Agent
 tesoreria_prompt = ChatPromptTemplate.from_messages(
@@ -512,14 +542,14 @@ tesoreria_prompt = ChatPromptTemplate.from_messages(
             "- CERTIFICADOS (tributario, OTP) → ESCALAR\n"
             "- VIVIENDA, NÓMINAS, ASOCIACIÓN, CONVENIOS, CARTERA, CONTABILIDAD → ESCALAR\n\n"
             "**REGLA DE FORMATO**: Responde CONCISO (máx 3-4 puntos). Ofrece expandir detalles si lo necesita.\n"
-            "\nCurrent time: {time}."
+            "\nCurrent date: {date}."
         ),
         ("placeholder", "{messages}"),
     ]
-).partial(time=datetime.now)
+).partial(date=prompt_date)
 
-tesoreria_tools = [consultar_tesoreria, CompleteOrEscalate]
-tesoreria_runnable = tesoreria_prompt | llm.bind_tools(tesoreria_tools)
+tesoreria_tools = [consultar_tesoreria, recuperar_fragmentos, CompleteOrEscalate]
+tesoreria_runnable = cached_agent_runnable("tesoreria", tesoreria_prompt, llm, tesoreria_tools)
 
 # 9. Crédito Agent
 credito_prompt = ChatPromptTemplate.from_messages(
@@ -542,14 +572,14 @@ credito_prompt = ChatPromptTemplate.from_messages(
             "- CERTIFICADOS (tributario, OTP) → ESCALAR\n"
             "- VIVIENDA, NÓMINAS, ASOCIACIÓN, CONVENIOS, CARTERA, CONTABILIDAD, TESORERÍA → ESCALAR\n\n"
             "**REGLA DE FORMATO**: Responde CONCISO (máx 3-4 puntos). Ofrece expandir detalles si lo necesita.\n"
-            "\nCurrent time: {time}."
+            "\nCurrent date: {date}."
         ),
         ("placeholder", "{messages}"),
     ]
-).partial(time=datetime.now)
+).partial(date=prompt_date)
 
-credito_tools = [consultar_credito, CompleteOrEscalate]
-credito_runnable = credito_prompt | llm.bind_tools(credito_tools)
+credito_tools = [consultar_credito, recuperar_fragmentos, CompleteOrEscalate]
+credito_runnable = cached_agent_runnable("credito", credito_prompt, llm, credito_tools)
 
 # 10. Certificados Agent (with OTP authentication)
 certificados_prompt = ChatPromptTemplate.from_messages(
@@ -574,14 +604,14 @@ certificados_prompt = ChatPromptTemplate.from_messages(
             "- NUNCA respondas con texto cuando debes llamar una herramienta.\n\n"
             "Tipos de certificados: Tributario, Aportes, Paz y Salvo.\n"
             "Si el usuario cambia de tema, usa CompleteOrEscalate.\n"
-            "\nCurrent time: {time}."
+            "\nCurrent date: {date}."
         ),
         ("placeholder", "{messages}"),
     ]
-).partial(time=datetime.now)
+).partial(date=prompt_date)
 
 certificados_tools = [solicitar_otp, verificar_codigo_otp, generar_certificado_tributario, CompleteOrEscalate]
-certificados_runnable = certificados_prompt | llm.bind_tools(certificados_tools)
+certificados_runnable = cached_agent_runnable("certificados", certificados_prompt, llm, certificados_tools)
 
 
 # --- Summarization Node (Official LangGraph Pattern) ---
@@ -589,68 +619,249 @@ certificados_runnable = certificados_prompt | llm.bind_tools(certificados_tools)
 # without breaking tool call context.
 
 # Separate LLM for summarization (without tools) to avoid Gemini ordering issues
-summarization_llm = ChatGoogleGenerativeAI(
-    model="gemini-3.1-flash-lite-preview",
-    google_api_key=_GEMINI_API_KEY,
-)
+summarization_llm = get_chat_model("gemini-3.1-flash-lite-preview", role="summarizer")
 
 _summarization_node_internal = SummarizationNode(
-    token_counter=count_tokens_approximately,
+    token_counter=count_tokens_cached,
     model=summarization_llm,
     max_tokens=4000,              # Max tokens to keep in context (was 8000)
     max_tokens_before_summary=3000,  # Trigger summarization when exceeded (was 6000)
     max_summary_tokens=500,       # Max tokens for the summary itself
 )
 
-def summarization_node_with_logging(state: State):
-    """Wrapper that adds logging to the SummarizationNode for debugging."""
+# inline:   summarize at the start of the turn (the user waits for the extra
+#           LLM call when the thread crosses the threshold).
+# deferred: the turn runs with the current summary window; the summary is
+#           updated by summarize_in_background() after the reply is sent.
+SUMMARIZATION_MODE = os.getenv("SUMMARIZATION_MODE", "inline").lower()
+
+_summarizing_threads: set[str] = set()
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _should_summarize(state: State) -> bool:
+    """Log the pre-summarization state; False when the thread is well below threshold."""
     messages_before = len(state.get("messages", []))
-    context_before = state.get("context", {})
-    has_summary = bool(context_before.get("summary"))
+    has_summary = bool(state.get("context", {}).get("running_summary"))
 
-    # Estimate tokens before
-    tokens_before = count_tokens_approximately(state.get("messages", []))
+    # Estimate tokens before (O(1): cumulative count stamped by the messages reducer)
+    tokens_before = history_tokens(state.get("messages", []))
 
     # Skip summarization entirely when well below threshold (max_tokens_before_summary=3000)
     if tokens_before < 2000 and not has_summary:
-        return {}
+        return False
 
     logger.info(f"🧠 [SUMMARIZATION] BEFORE: messages={messages_before}, tokens≈{tokens_before}, has_prior_summary={has_summary}")
+    return True
+
+
+def _log_summarization_result(state: State, result: dict) -> dict:
+    messages_before = len(state.get("messages", []))
+    context_before = state.get("context", {})
+    has_summary = bool(context_before.get("running_summary"))
 
-    # Call the actual summarization node
-    result = _summarization_node_internal.invoke(state)
-    
     # Log after
-    messages_after = len(result.get("messages", state.get("messages", [])))
+    # SummarizationNode returns the window sent to the agents as summarized_messages
+    messages_after = len(result.get("summarized_messages", state.get("messages", [])))
     context_after = result.get("context", context_before)
-    has_summary_after = bool(context_after.get("summary"))
-    tokens_after = count_tokens_approximately(result.get("messages", state.get("messages", [])))
+    has_summary_after = bool(context_after.get("running_summary"))
+    tokens_after = count_tokens_cached(result.get("summarized_messages", state.get("messages", [])))
     
     logger.info(f"🧠 [SUMMARIZATION] AFTER: messages={messages_after}, tokens≈{tokens_after}, has_summary={has_summary_after}")
     
     if messages_before != messages_after:
         logger.info(f"✂️ [SUMMARIZATION] Trimmed {messages_before - messages_after} messages!")
     
-    if has_summary_after and not has_summary:
-        logger.info(f"📝 [SUMMARIZATION] New summary created!")
+    if context_after.get("running_summary") is not context_before.get("running_summary") and has_summary_after:
+        logger.info(f"📝 [SUMMARIZATION] {'Summary updated' if has_summary else 'New summary created'}!")
     
     return result
 
+
+def _compact_history(state: State) -> tuple[State, dict]:
+    """Stub the answered RAG tool outputs (history_compaction.py) before summarizing."""
+    replacements = compact_answered_tool_outputs(state.get("messages", []))
+    if not replacements:
+        return state, {}
+    compacted = {**state, "messages": add_messages_counted(state["messages"], replacements)}
+    return compacted, {"messages": replacements}
+
+
+def summarization_node_with_logging(state: State):
+    """Wrapper that adds logging to the SummarizationNode for debugging."""
+    state, compaction = _compact_history(state)
+    if SUMMARIZATION_MODE == "deferred" or not _should_summarize(state):
+        return compaction
+    # Call the actual summarization node
+    return {**_log_summarization_result(state, _summarization_node_internal.invoke(state)), **compaction}
+
+
+async def asummarization_node_with_logging(state: State):
+    """Async variant of summarization_node_with_logging (used by graph.ainvoke)."""
+    state, compaction = _compact_history(state)
+    if SUMMARIZATION_MODE == "deferred" or not _should_summarize(state):
+        return compaction
+    return {**_log_summarization_result(state, await _summarization_node_internal.ainvoke(state, config=traced_config({}))), **compaction}
+
+
+@traced("summarize.deferred")
+async def _summarize_thread(graph, config: dict, thread_id: str) -> None:
+    # Runs in the turn's context: its spans join the turn's trace, after the reply
+    from .debug import aget_graph_state, aupdate_graph_state
+
+    try:
+        snapshot = await aget_graph_state(graph, config)
+        state = (snapshot.values or {}) if snapshot else {}
+        if not state.get("messages") or not _should_summarize(state):
+            return
+        result = _log_summarization_result(state, await _summarization_node_internal.ainvoke(state, config=traced_config({})))
+        context = result.get("context")
+        if not context or context.get("running_summary") is state.get("context", {}).get("running_summary"):
+            return  # Below threshold: nothing new to store
+        # Takes the thread lock: waits for a turn in progress instead of racing its checkpoint.
+        # The summary references message ids, so it stays valid if new messages arrived meanwhile.
+        await aupdate_graph_state(graph, config, {"context": context}, as_node="primary_assistant")
+        logger.info(f"🧠 [SUMMARIZATION] Deferred summary stored for thread={thread_id}")
+    except Exception as e:
+        logger.error(f"❌ [SUMMARIZATION] Deferred summarization failed for thread={thread_id}: {e}")
+    finally:
+        _summarizing_threads.discard(thread_id)
+
+
+def summarize_in_background(graph, config: dict) -> None:
+    """
+    Deferred mode: summarize the thread after its reply, off the critical path.
+
+    Call after the turn's response is ready; a no-op in inline mode or while
+    the thread is already being summarized.
+    """
+    if SUMMARIZATION_MODE != "deferred":
+        return
+    thread_id = config.get("configurable", {}).get("thread_id", "unknown")
+    if thread_id in _summarizing_threads:
+        return
+    _summarizing_threads.add(thread_id)
+    task = asyncio.create_task(_summarize_thread(graph, config, thread_id))
+    _background_tasks.add(task)  # Keep a reference until done
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _summary_window(state: State) -> State:
+    """
+    Messages sent to the LLM: the running summary plus the messages it does
+    not cover (the checkpoint keeps the full history).
+    """
+    running_summary = state.get("context", {}).get("running_summary")
+    messages = state["messages"]
+    if not running_summary or not messages:
+        return state
+    start = next(
+        (i + 1 for i, m in enumerate(messages) if m.id == running_summary.last_summarized_message_id),
+        0,
+    )
+    start = min(start, len(messages) - 1)
+    # Open the window on a user turn (Gemini rejects a history starting with a tool result)
+    while start > 0 and not isinstance(messages[start], HumanMessage):
+        start -= 1
+    summary = SystemMessage(content=f"Resumen de la conversación anterior:\n{running_summary.summary}")
+    return {**state, "messages": [summary] + messages[start:]}
+
 # --- Graph Construction ---
 
 builder = StateGraph(State)
 
 # Add summarization node with logging wrapper
-builder.add_node("summarize", summarization_node_with_logging)
+builder.add_node(
+    "summarize",
+    RunnableLambda(summarization_node_with_logging, afunc=asummarization_node_with_logging, name="summarize"),
+)
 
 # Primary Assistant Node
-builder.add_node("primary_assistant", Assistant(primary_runnable, name="Primary Assistant"))
+builder.add_node("primary_assistant", _assistant_node(Assistant(primary_runnable, name="Primary Assistant")))
+
+# --- Pre-Router (zero-LLM routing, see prerouter.py) ---
+
+# Department -> transfer tool the primary assistant would have called
+ROUTE_TOOLS = {
+    "atencion_asociado": ToAtencionAsociado,
+    "nominas": ToNominas,
+    "vivienda": ToVivienda,
+    "convenios": ToConvenios,
+    "cartera": ToCartera,
+    "contabilidad": ToContabilidad,
+    "tesoreria": ToTesoreria,
+    "credito": ToCredito,
+}
+
+PREROUTED_ID_PREFIX = "prerouter-"
+
+
+def _last_human_text(state: State) -> str:
+    last = state["messages"][-1] if state.get("messages") else None
+    if not isinstance(last, HumanMessage) or not isinstance(last.content, str):
+        return ""
+    return last.content
+
+
+def _pre_route_result(state: State, config: RunnableConfig, text: str, decision) -> dict:
+    thread_id = (config or {}).get("configurable", {}).get("thread_id", "unknown")
+    prerouter.record_decision(thread_id, decision)
+    if not (PREROUTER_ENABLED and decision.confident):
+        return {}  # Shadow mode or low confidence: primary_assistant routes
+    # Same message the primary assistant emits when it transfers, so
+    # enter_<dept>, route_primary and the checkpointed history are unchanged
+    routed = AIMessage(
+        content="",
+        id=f"{PREROUTED_ID_PREFIX}{uuid.uuid4().hex}",
+        tool_calls=[{
+            "name": ROUTE_TOOLS[decision.department].__name__,
+            "args": {"request": text},
+            "id": f"call_{uuid.uuid4().hex[:12]}",
+        }],
+    )
+    return {"messages": [routed]}
+
+
+def pre_router_node(state: State, config: RunnableConfig):
+    text = _last_human_text(state)
+    if not text:
+        return {}
+    return _pre_route_result(state, config, text, prerouter.classify(text))
+
+
+async def apre_router_node(state: State, config: RunnableConfig):
+    """Async variant of pre_router_node (the centroid path embeds the message)."""
+    text = _last_human_text(state)
+    if not text:
+        return {}
+    return _pre_route_result(state, config, text, await asyncio.to_thread(prerouter.classify, text))
+
+
+def _was_prerouted(state: State) -> bool:
+    """True when this turn's hand-off to the current specialist came from the pre-router."""
+    for message in reversed(state["messages"]):
+        if isinstance(message, HumanMessage):
+            return False
+        if isinstance(message, AIMessage) and any(tc["name"].startswith("To") for tc in message.tool_calls):
+            return (message.id or "").startswith(PREROUTED_ID_PREFIX)
+    return False
+
+
+builder.add_node("pre_router", RunnableLambda(pre_router_node, afunc=apre_router_node, name="pre_router"))
 
 def route_from_start(_state: State):
     # Each WhatsApp message is a complete invocation — always start from
     # primary_assistant so it can decide the correct sub-agent based on the
     # new message. Resuming the last sub-agent caused an extra unnecessary
     # LLM call when the user switched topics between turns.
+    # The pre-router goes first and only skips primary_assistant when enabled
+    # and confident (in shadow mode it just records its guess).
+    return "pre_router" if PREROUTER_ENABLED or PREROUTER_SHADOW else "primary_assistant"
+
+def route_pre_router(state: State):
+    last = state["messages"][-1]
+    if isinstance(last, AIMessage) and last.tool_calls:
+        return _route_primary(state)
     return "primary_assistant"
 
 # START -> summarize first, then route to appropriate agent
@@ -658,7 +869,12 @@ builder.add_edge(START, "summarize")
 builder.add_conditional_edges(
     "summarize",
     route_from_start,
-    ["primary_assistant", "atencion_asociado", "nominas", "vivienda", "convenios", "cartera", "contabilidad", "tesoreria", "credito", "certificados"],
+    ["pre_router", "primary_assistant", "atencion_asociado", "nominas", "vivienda", "convenios", "cartera", "contabilidad", "tesoreria", "credito", "certificados"],
+)
+builder.add_conditional_edges(
+    "pre_router",
+    route_pre_router,
+    ["primary_assistant"] + [f"enter_{dept}" for dept in ROUTE_TOOLS],
 )
 
 # --- Specialized Workflows ---
@@ -668,7 +884,7 @@ def create_workflow(name: str, runnable: Runnable, tools: list, entry_state: str
     builder.add_node(f"enter_{name}", create_entry_node(f"{name.capitalize()} Assistant", entry_state))
     
     # Agent Node
-    builder.add_node(name, Assistant(runnable, name=f"{name.capitalize()} Agent"))
+    builder.add_node(name, _assistant_node(Assistant(runnable, name=f"{name.capitalize()} Agent")))
     builder.add_edge(f"enter_{name}", name)
     
     # Tools Node - ONLY include callable tools, not Pydantic schemas like CompleteOrEscalate
@@ -684,6 +900,8 @@ def create_workflow(name: str, runnable: Runnable, tools: list, entry_state: str
         tool_calls = state["messages"][-1].tool_calls
         did_cancel = any(tc["name"] == CompleteOrEscalate.__name__ for tc in tool_calls)
         if did_cancel:
+            if _was_prerouted(state):
+                prerouter.record_escalation(name)  # Misroute: the specialist handed the turn back
             return "leave_skill"
         return f"{name}_tools"
 
@@ -710,7 +928,18 @@ create_workflow("credito", credito_runnable, credito_tools, "credito")
 create_workflow("certificados", certificados_runnable, certificados_tools, "certificados")
 
 # Primary Routing Logic
-def route_primary(state: State):
+def route_primary(state: State, config: RunnableConfig = None):
+    from .debug import in_state_update
+
+    route = _route_primary(state)
+    # Skipped when update_state re-runs this edge (small talk, deferred summary): no LLM routed
+    if config is not None and not in_state_update():
+        # Shadow agreement: compare the LLM's choice with the pre-router's guess
+        department = route[len("enter_"):] if route != END else None
+        prerouter.record_llm_route(config.get("configurable", {}).get("thread_id", "unknown"), department)
+    return route
+
+def _route_primary(state: State):
     tool_calls = state["messages"][-1].tool_calls
     if tool_calls:
         if tool_calls[0]["name"] == ToAtencionAsociado.__name__:
@@ -0,0 +1,388 @@
+"""
+Checkpoint Cache — write-through LRU of the latest checkpoint per thread.
+
+Every turn reads its thread's checkpoint several times (the pre-invoke
+get_state in _run_graph, the run itself, small talk, the final get_state
+with DEBUG_GRAPH), and each read is the PostgresSaver SELECT with its blob
+and write aggregates plus deserializing the whole history. The node steps
+then write a new checkpoint each. CachedCheckpointSaver wraps the
+PostgresSaver / AsyncPostgresSaver:
+
+1. Write-through: put / put_writes go to PostgreSQL first; once stored, the
+   new checkpoint (and the pending writes of the latest one) becomes the
+   thread's cache entry.
+2. Reads of the latest checkpoint (no checkpoint_id in the config) are
+   served from the entry. Reads of a given checkpoint_id, list() and the
+   other methods go to the wrapped saver.
+3. Invalidation: Cloud Tasks may deliver a thread's next turn to another
+   instance, which advances the thread behind our back. Before serving an
+   entry, HEAD_SQL reads the thread's latest checkpoint_id (primary-key
+   index, no blobs); on mismatch the entry is dropped and the checkpoint
+   loaded from PostgreSQL. CHECKPOINT_CACHE_VALIDATE=false trusts entries
+   (only safe when one instance serves every thread). delete_thread, prune
+   and copy_thread drop the affected entries.
+4. Bounded: at most CHECKPOINT_CACHE_SIZE threads and CHECKPOINT_CACHE_MAX_MB
+   of serialized checkpoints; least recently used threads are evicted.
+   Entries are kept serialized (the saver's serde), so a caller never
+   shares mutable state with the cache or with another caller.
+
+Stats: GET /checkpoint_cache/stats. Reads and writes are traced as db
+spans (checkpoint.get_tuple with cache=hit|miss|stale, see tracing.py).
+
+Config (env):
+    CHECKPOINT_CACHE_ENABLED=true
+    CHECKPOINT_CACHE_SIZE=256
+    CHECKPOINT_CACHE_MAX_MB=64
+    CHECKPOINT_CACHE_VALIDATE=true
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Iterator, Optional, Sequence
+
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+)
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+
+from .tracing import set_attributes, traced
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_CACHE_ENABLED = os.getenv("CHECKPOINT_CACHE_ENABLED", "true").lower() in ("true", "1", "yes")
+CHECKPOINT_CACHE_SIZE = int(os.getenv("CHECKPOINT_CACHE_SIZE", "256"))
+CHECKPOINT_CACHE_MAX_MB = int(os.getenv("CHECKPOINT_CACHE_MAX_MB", "64"))
+CHECKPOINT_CACHE_VALIDATE = os.getenv("CHECKPOINT_CACHE_VALIDATE", "true").lower() in ("true", "1", "yes")
+
+# Latest checkpoint id of a thread: an index-only lookup on the checkpoints PK
+HEAD_SQL = """
+SELECT checkpoint_id FROM checkpoints
+WHERE thread_id = %s AND checkpoint_ns = %s
+ORDER BY checkpoint_id DESC LIMIT 1
+"""
+
+
+@dataclass
+class _Entry:
+    config: dict
+    parent_config: Optional[dict]
+    checkpoint: tuple  # serde.dumps_typed
+    metadata: tuple    # serde.dumps_typed
+    writes: dict       # (task_id, idx) -> (task_id, channel, serde.dumps_typed(value))
+    size: int = 0
+
+    @property
+    def checkpoint_id(self) -> str:
+        return self.config["configurable"]["checkpoint_id"]
+
+
+def _key(config: dict) -> tuple[str, str]:
+    configurable = config["configurable"]
+    return configurable["thread_id"], configurable.get("checkpoint_ns", "")
+
+
+def _typed_size(typed: tuple) -> int:
+    return len(typed[1] or b"")
+
+
+class CachedCheckpointSaver(BaseCheckpointSaver):
+    """Write-through LRU cache of each thread's latest checkpoint over a Postgres saver."""
+
+    def __init__(
+        self,
+        saver: BaseCheckpointSaver,
+        max_entries: int = CHECKPOINT_CACHE_SIZE,
+        max_mb: int = CHECKPOINT_CACHE_MAX_MB,
+        validate: bool = CHECKPOINT_CACHE_VALIDATE,
+    ):
+        super().__init__(serde=saver.serde)
+        self.saver = saver
+        self.max_entries = max_entries
+        self.max_bytes = max_mb * 1024 * 1024
+        self.validate = validate
+        self._is_async = isinstance(saver, AsyncPostgresSaver)
+        self._entries: "OrderedDict[tuple[str, str], _Entry]" = OrderedDict()
+        self._bytes = 0
+        # Sync graphs run on worker threads (debug.ainvoke_graph)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    @property
+    def config_specs(self) -> list:
+        return self.saver.config_specs
+
+    # --- Entries ---
+
+    def _entry(self, tup: CheckpointTuple) -> _Entry:
+        writes = {}
+        for n, (task_id, channel, value) in enumerate(tup.pending_writes or []):
+            writes[(task_id, WRITES_IDX_MAP.get(channel, n))] = (task_id, channel, self.serde.dumps_typed(value))
+        entry = _Entry(
+            config=tup.config,
+            parent_config=tup.parent_config,
+            checkpoint=self.serde.dumps_typed(tup.checkpoint),
+            metadata=self.serde.dumps_typed(tup.metadata),
+            writes=writes,
+        )
+        entry.size = (
+            _typed_size(entry.checkpoint)
+            + _typed_size(entry.metadata)
+            + sum(_typed_size(typed) for _, _, typed in writes.values())
+        )
+        return entry
+
+    def _tuple(self, entry: _Entry) -> CheckpointTuple:
+        return CheckpointTuple(
+            config={"configurable": dict(entry.config["configurable"])},
+            checkpoint=self.serde.loads_typed(entry.checkpoint),
+            metadata=self.serde.loads_typed(entry.metadata),
+            parent_config={"configurable": dict(entry.parent_config["configurable"])} if entry.parent_config else None,
+            pending_writes=[(task_id, channel, self.serde.loads_typed(typed)) for task_id, channel, typed in entry.writes.values()],
+        )
+
+    def _drop(self, key: tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _store(self, key: tuple[str, str], entry: _Entry) -> None:
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current.checkpoint_id > entry.checkpoint_id:
+                return  # A concurrent put already cached a newer checkpoint
+            self._drop(key)
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                evicted, _ = next(iter(self._entries.items()))
+                self._drop(evicted)
+                self.evictions += 1
+
+    def _cached(self, key: tuple[str, str]) -> Optional[_Entry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _serve(self, key: tuple[str, str], entry: Optional[_Entry], head: Optional[str]) -> Optional[CheckpointTuple]:
+        """Cached tuple when entry is still the thread's head, else None (entry dropped)."""
+        if entry is None:
+            self.misses += 1
+            set_attributes(cache="miss")
+            return None
+        if self.validate and head != entry.checkpoint_id:
+            self.stale += 1
+            set_attributes(cache="stale")
+            logger.info(f"💾 [CHECKPOINT-CACHE] thread={key[0]} advanced elsewhere, reloading")
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self._drop(key)
+            return None
+        self.hits += 1
+        set_attributes(cache="hit")
+        return self._tuple(entry)
+
+    def _remember(self, config: dict, next_config: dict, checkpoint: Checkpoint, metadata: CheckpointMetadata) -> None:
+        parent_id = get_checkpoint_id(config)
+        thread_id, checkpoint_ns = _key(next_config)
+        tup = CheckpointTuple(
+            config=next_config,
+            checkpoint=checkpoint,
+            metadata=metadata,
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_id}}
+                if parent_id else None
+            ),
+            pending_writes=[],
+        )
+        try:
+            self._store((thread_id, checkpoint_ns), self._entry(tup))
+        except Exception as e:
+            logger.warning(f"💾 [CHECKPOINT-CACHE] Could not cache thread={thread_id}: {e}")
+            self.invalidate(thread_id)
+
+    def _remember_writes(self, config: dict, writes: Sequence[tuple[str, Any]], task_id: str) -> None:
+        # Same upsert rules as PostgresSaver: special channels replace, the rest insert once
+        key = _key(config)
+        checkpoint_id = get_checkpoint_id(config)
+        try:
+            typed = [(channel, self.serde.dumps_typed(value)) for channel, value in writes]
+        except Exception as e:
+            logger.warning(f"💾 [CHECKPOINT-CACHE] Could not cache writes of thread={key[0]}: {e}")
+            self.invalidate(key[0])
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.checkpoint_id != checkpoint_id:
+                return
+            for idx, (channel, value) in enumerate(typed):
+                write_key = (task_id, WRITES_IDX_MAP.get(channel, idx))
+                if write_key in entry.writes and channel not in WRITES_IDX_MAP:
+                    continue
+                previous = entry.writes.get(write_key)
+                delta = _typed_size(value) - (_typed_size(previous[2]) if previous else 0)
+                entry.writes[write_key] = (task_id, channel, value)
+                entry.size += delta
+                self._bytes += delta
+
+    def invalidate(self, thread_id: Optional[str] = None) -> None:
+        """Drop the entries of thread_id (every namespace), or all of them."""
+        with self._lock:
+            for key in [k for k in self._entries if thread_id is None or k[0] == thread_id]:
+                self._drop(key)
+
+    # --- Head validation ---
+
+    def _head(self, key: tuple[str, str]) -> Optional[str]:
+        with self.saver._cursor() as cur:
+            cur.execute(HEAD_SQL, key)
+            row = cur.fetchone()
+        return row["checkpoint_id"] if row else None
+
+    async def _ahead(self, key: tuple[str, str]) -> Optional[str]:
+        async with self.saver._cursor() as cur:
+            await cur.execute(HEAD_SQL, key)
+            row = await cur.fetchone()
+        return row["checkpoint_id"] if row else None
+
+    # --- Sync API ---
+
+    @traced("checkpoint.get_tuple", kind="db")
+    def get_tuple(self, config: dict) -> Optional[CheckpointTuple]:
+        if get_checkpoint_id(config) or self._is_async:
+            return self.saver.get_tuple(config)
+        key = _key(config)
+        entry = self._cached(key)
+        head = self._head(key) if entry is not None and self.validate else None
+        tup = self._serve(key, entry, head)
+        if tup is not None:
+            return tup
+        tup = self.saver.get_tuple(config)
+        if tup is not None:
+            self._store(key, self._entry(tup))
+        return tup
+
+    def list(self, config: Optional[dict], *, filter: Optional[dict] = None, before: Optional[dict] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        return self.saver.list(config, filter=filter, before=before, limit=limit)
+
+    @traced("checkpoint.put", kind="db")
+    def put(self, config: dict, checkpoint: Checkpoint, metadata: CheckpointMetadata, new_versions: ChannelVersions) -> dict:
+        next_config = self.saver.put(config, checkpoint, metadata, new_versions)
+        self._remember(config, next_config, checkpoint, metadata)
+        return next_config
+
+    @traced("checkpoint.put_writes", kind="db")
+    def put_writes(self, config: dict, writes: Sequence[tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        self.saver.put_writes(config, writes, task_id, task_path)
+        self._remember_writes(config, writes, task_id)
+
+    def delete_thread(self, thread_id: str) -> None:
+        self.invalidate(thread_id)
+        self.saver.delete_thread(thread_id)
+
+    def delete_for_runs(self, run_ids: Sequence[str]) -> None:
+        self.invalidate()
+        self.saver.delete_for_runs(run_ids)
+
+    def copy_thread(self, source_thread_id: str, target_thread_id: str) -> None:
+        self.invalidate(target_thread_id)
+        self.saver.copy_thread(source_thread_id, target_thread_id)
+
+    def prune(self, thread_ids: Sequence[str], *, strategy: str = "keep_latest") -> None:
+        for thread_id in thread_ids:
+            self.invalidate(thread_id)
+        self.saver.prune(thread_ids, strategy=strategy)
+
+    # --- Async API ---
+
+    @traced("checkpoint.get_tuple", kind="db")
+    async def aget_tuple(self, config: dict) -> Optional[CheckpointTuple]:
+        if get_checkpoint_id(config) or not self._is_async:
+            return await self.saver.aget_tuple(config)
+        key = _key(config)
+        entry = self._cached(key)
+        head = await self._ahead(key) if entry is not None and self.validate else None
+        tup = self._serve(key, entry, head)
+        if tup is not None:
+            return tup
+        tup = await self.saver.aget_tuple(config)
+        if tup is not None:
+            self._store(key, self._entry(tup))
+        return tup
+
+    async def alist(self, config: Optional[dict], *, filter: Optional[dict] = None, before: Optional[dict] = None, limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        async for tup in self.saver.alist(config, filter=filter, before=before, limit=limit):
+            yield tup
+
+    @traced("checkpoint.put", kind="db")
+    async def aput(self, config: dict, checkpoint: Checkpoint, metadata: CheckpointMetadata, new_versions: ChannelVersions) -> dict:
+        next_config = await self.saver.aput(config, checkpoint, metadata, new_versions)
+        self._remember(config, next_config, checkpoint, metadata)
+        return next_config
+
+    @traced("checkpoint.put_writes", kind="db")
+    async def aput_writes(self, config: dict, writes: Sequence[tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        await self.saver.aput_writes(config, writes, task_id, task_path)
+        self._remember_writes(config, writes, task_id)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        self.invalidate(thread_id)
+        await self.saver.adelete_thread(thread_id)
+
+    async def adelete_for_runs(self, run_ids: Sequence[str]) -> None:
+        self.invalidate()
+        await self.saver.adelete_for_runs(run_ids)
+
+    async def acopy_thread(self, source_thread_id: str, target_thread_id: str) -> None:
+        self.invalidate(target_thread_id)
+        await self.saver.acopy_thread(source_thread_id, target_thread_id)
+
+    async def aprune(self, thread_ids: Sequence[str], *, strategy: str = "keep_latest") -> None:
+        for thread_id in thread_ids:
+            self.invalidate(thread_id)
+        await self.saver.aprune(thread_ids, strategy=strategy)
+
+    def get_next_version(self, current, channel):
+        return self.saver.get_next_version(current, channel)
+
+    def stats(self) -> dict:
+        reads = self.hits + self.misses + self.stale
+        return {
+            "enabled": True,
+            "validate": self.validate,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "mb": round(self._bytes / 1024 / 1024, 2),
+            "max_mb": round(self.max_bytes / 1024 / 1024, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / reads, 3) if reads else 0.0,
+        }
+
+
+def cached_checkpointer(saver: BaseCheckpointSaver) -> BaseCheckpointSaver:
+    """Wrap a Postgres saver in the cache (unless CHECKPOINT_CACHE_ENABLED=false)."""
+    if not CHECKPOINT_CACHE_ENABLED:
+        return saver
+    logger.info(
+        f"💾 [CHECKPOINT-CACHE] Enabled ({CHECKPOINT_CACHE_SIZE} threads, {CHECKPOINT_CACHE_MAX_MB} MB, "
+        f"validate={CHECKPOINT_CACHE_VALIDATE})"
+    )
+    return CachedCheckpointSaver(saver)
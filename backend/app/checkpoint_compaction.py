@@ -0,0 +1,228 @@
+"""
+Checkpoint Compaction — retention for the PostgresSaver tables.
+
+LangGraph writes a checkpoint (+ blobs and writes) on every node step, so
+checkpoints / checkpoint_blobs / checkpoint_writes (docs/checkpoint_tables.sql)
+grow by dozens of rows per message. The graph only ever reads the latest
+checkpoint of a thread, so the job:
+
+1. Deletes threads idle longer than CHECKPOINT_RETENTION_DAYS (all rows).
+2. Keeps only the latest CHECKPOINT_KEEP_LATEST checkpoints of the other
+   threads (per checkpoint_ns; checkpoint ids are time-ordered).
+3. Drops the writes of deleted checkpoints and the blobs no remaining
+   checkpoint references (checkpoint -> channel_versions).
+
+Threads are processed in batches of CHECKPOINT_COMPACT_BATCH, one
+transaction each. Threads with a checkpoint in the last
+CHECKPOINT_ACTIVE_MINUTES are skipped (a turn may be writing blobs right
+now), as are threads whose advisory lock (thread_locks.advisory_key) is
+held by a running turn. Reclaimed rows and bytes (pg_column_size of the
+deleted rows) are reported per table; the space is reusable after
+(auto)VACUUM.
+
+CLI: script_compact_checkpoints.py
+
+Config (env):
+    CHECKPOINT_KEEP_LATEST=10
+    CHECKPOINT_RETENTION_DAYS=60
+    CHECKPOINT_ACTIVE_MINUTES=15
+    CHECKPOINT_COMPACT_BATCH=200
+"""
+
+import os
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .thread_locks import advisory_key
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_KEEP_LATEST = int(os.getenv("CHECKPOINT_KEEP_LATEST", "10"))
+CHECKPOINT_RETENTION_DAYS = int(os.getenv("CHECKPOINT_RETENTION_DAYS", "60"))
+CHECKPOINT_ACTIVE_MINUTES = int(os.getenv("CHECKPOINT_ACTIVE_MINUTES", "15"))
+CHECKPOINT_COMPACT_BATCH = int(os.getenv("CHECKPOINT_COMPACT_BATCH", "200"))
+
+TABLES = ("checkpoints", "checkpoint_writes", "checkpoint_blobs")
+
+# --- SQL ---
+
+# One page of threads (PK index order) with their last activity and size
+THREAD_PAGE_SQL = """
+SELECT thread_id,
+       MAX((checkpoint->>'ts')::timestamptz) AS last_ts,
+       COUNT(*) AS n_checkpoints
+FROM checkpoints
+WHERE thread_id > %(after)s
+GROUP BY thread_id
+ORDER BY thread_id
+LIMIT %(limit)s
+"""
+
+# Skip threads a running turn holds (THREAD_LOCK_MODE=advisory); released at commit
+TRY_XACT_LOCK_SQL = "SELECT pg_try_advisory_xact_lock(%s)"
+
+DELETE_THREADS_SQL = {
+    table: f"""
+WITH deleted AS (
+    DELETE FROM {table} t
+    WHERE t.thread_id = ANY(%(threads)s)
+    RETURNING pg_column_size(t.*) AS bytes
+)
+SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM deleted
+"""
+    for table in TABLES
+}
+
+DELETE_OLD_CHECKPOINTS_SQL = """
+WITH ranked AS (
+    SELECT thread_id, checkpoint_ns, checkpoint_id,
+           ROW_NUMBER() OVER (
+               PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC
+           ) AS rn
+    FROM checkpoints
+    WHERE thread_id = ANY(%(threads)s)
+),
+deleted AS (
+    DELETE FROM checkpoints c
+    USING ranked r
+    WHERE r.rn > %(keep)s
+      AND c.thread_id = r.thread_id
+      AND c.checkpoint_ns = r.checkpoint_ns
+      AND c.checkpoint_id = r.checkpoint_id
+    RETURNING pg_column_size(c.*) AS bytes
+)
+SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM deleted
+"""
+
+DELETE_ORPHAN_WRITES_SQL = """
+WITH deleted AS (
+    DELETE FROM checkpoint_writes w
+    WHERE w.thread_id = ANY(%(threads)s)
+      AND NOT EXISTS (
+          SELECT 1 FROM checkpoints c
+          WHERE c.thread_id = w.thread_id
+            AND c.checkpoint_ns = w.checkpoint_ns
+            AND c.checkpoint_id = w.checkpoint_id
+      )
+    RETURNING pg_column_size(w.*) AS bytes
+)
+SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM deleted
+"""
+
+DELETE_ORPHAN_BLOBS_SQL = """
+WITH deleted AS (
+    DELETE FROM checkpoint_blobs b
+    WHERE b.thread_id = ANY(%(threads)s)
+      AND NOT EXISTS (
+          SELECT 1 FROM checkpoints c
+          WHERE c.thread_id = b.thread_id
+            AND c.checkpoint_ns = b.checkpoint_ns
+            AND c.checkpoint -> 'channel_versions' ->> b.channel = b.version
+      )
+    RETURNING pg_column_size(b.*) AS bytes
+)
+SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM deleted
+"""
+
+
+@dataclass
+class CompactionReport:
+    threads_scanned: int = 0
+    threads_deleted: int = 0
+    threads_compacted: int = 0
+    threads_skipped: int = 0
+    batches: int = 0
+    rows: dict = field(default_factory=lambda: dict.fromkeys(TABLES, 0))
+    bytes: dict = field(default_factory=lambda: dict.fromkeys(TABLES, 0))
+    elapsed_ms: int = 0
+    dry_run: bool = False
+
+    def add(self, table: str, result) -> None:
+        rows, size = result
+        self.rows[table] += rows
+        self.bytes[table] += size
+
+    def log(self) -> None:
+        prefix = "🧹 [CHECKPOINT-COMPACT]" + (" (dry run)" if self.dry_run else "")
+        logger.info(
+            f"{prefix} threads scanned={self.threads_scanned} deleted={self.threads_deleted} "
+            f"compacted={self.threads_compacted} skipped={self.threads_skipped} "
+            f"batches={self.batches} in {self.elapsed_ms}ms"
+        )
+        for table in TABLES:
+            logger.info(f"{prefix}   {table}: -{self.rows[table]} rows, -{self.bytes[table] / 1024 / 1024:.2f} MB")
+
+
+def _lockable(cur, thread_ids: list[str]) -> list[str]:
+    return [t for t in thread_ids if cur.execute(TRY_XACT_LOCK_SQL, (advisory_key(t),)).fetchone()[0]]
+
+
+def _compact_batch(cur, report: CompactionReport, expired: list[str], compactable: list[str], keep: int) -> None:
+    candidates = len(expired) + len(compactable)
+    expired = _lockable(cur, expired)
+    compactable = _lockable(cur, compactable)
+    report.threads_skipped += candidates - len(expired) - len(compactable)  # Running right now
+    if expired:
+        for table in TABLES:
+            report.add(table, cur.execute(DELETE_THREADS_SQL[table], {"threads": expired}).fetchone())
+        report.threads_deleted += len(expired)
+    if compactable:
+        params = {"threads": compactable, "keep": keep}
+        report.add("checkpoints", cur.execute(DELETE_OLD_CHECKPOINTS_SQL, params).fetchone())
+        report.add("checkpoint_writes", cur.execute(DELETE_ORPHAN_WRITES_SQL, params).fetchone())
+        report.add("checkpoint_blobs", cur.execute(DELETE_ORPHAN_BLOBS_SQL, params).fetchone())
+        report.threads_compacted += len(compactable)
+
+
+def compact_checkpoints(
+    conn,
+    keep: int = CHECKPOINT_KEEP_LATEST,
+    retention_days: int = CHECKPOINT_RETENTION_DAYS,
+    active_minutes: int = CHECKPOINT_ACTIVE_MINUTES,
+    batch_size: int = CHECKPOINT_COMPACT_BATCH,
+    max_batches: Optional[int] = None,
+    dry_run: bool = False,
+) -> CompactionReport:
+    """
+    Run the retention policy over all threads (see module docstring).
+
+    conn is a psycopg connection (not autocommit); every batch is committed,
+    or rolled back with dry_run=True (the report then shows what would be
+    reclaimed).
+    """
+    report = CompactionReport(dry_run=dry_run)
+    started = time.monotonic()
+    after = ""
+    keep = max(keep, 1)
+
+    while max_batches is None or report.batches < max_batches:
+        with conn.cursor() as cur:
+            page = cur.execute(THREAD_PAGE_SQL, {"after": after, "limit": batch_size}).fetchall()
+            if not page:
+                conn.rollback()
+                break
+            after = page[-1][0]
+            now = cur.execute("SELECT now()").fetchone()[0]
+
+            expired, compactable = [], []
+            for thread_id, last_ts, n_checkpoints in page:
+                idle_seconds = (now - last_ts).total_seconds() if last_ts else float("inf")
+                if idle_seconds > retention_days * 86400:
+                    expired.append(thread_id)
+                elif idle_seconds < active_minutes * 60:
+                    report.threads_skipped += 1
+                elif n_checkpoints > keep:
+                    compactable.append(thread_id)
+            report.threads_scanned += len(page)
+            _compact_batch(cur, report, expired, compactable, keep)
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+        report.batches += 1
+
+    report.elapsed_ms = int((time.monotonic() - started) * 1000)
+    report.log()
+    return report
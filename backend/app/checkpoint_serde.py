@@ -0,0 +1,162 @@
+"""
+Checkpoint Serializer — msgpack + zstd with a trained dictionary.
+
+PostgresSaver stores every channel value that changed in a step
+(checkpoint_blobs) and every task write (checkpoint_writes) through its
+serde. The messages channel is the whole accumulated history, RAG
+ToolMessages included, so each step re-stores KBs of Spanish text.
+
+CompressedSerializer wraps LangGraph's JsonPlusSerializer, whose msgpack
+encoding of the LangChain messages is already a compact binary format:
+
+1. Payloads of CHECKPOINT_ZSTD_MIN_BYTES or more are zstd-compressed at
+   CHECKPOINT_ZSTD_LEVEL and stored with type "<type>+zstd" (the suffix
+   convention of LangGraph's EncryptedSerializer). Smaller payloads, and
+   those that do not shrink, are stored as before.
+2. Dictionary: single writes and short histories barely compress on their
+   own. CHECKPOINT_ZSTD_DICT_PATH points to a dictionary trained on our
+   corpus (docs/*.pdf chunks as serialized messages, plus stored
+   checkpoints) with script_checkpoint_serde.py --train. A comma-separated
+   list is accepted: the first dictionary compresses, all of them
+   decompress (every frame carries its dictionary id), so rows written with
+   a retired dictionary stay readable.
+3. Legacy rows ("msgpack", "json", "null", ...) are read as before;
+   script_checkpoint_serde.py --migrate rewrites them compressed.
+
+Compression is opt-in (CHECKPOINT_COMPRESSION=true) because it is one-way:
+a release without this serializer cannot read "+zstd" rows, so once rows
+are written compressed (new writes, or --migrate) a rollback past this
+code breaks those threads. CHECKPOINT_COMPRESSION=false again stops
+compressing new rows but still reads compressed ones; keep every
+dictionary that wrote rows in CHECKPOINT_ZSTD_DICT_PATH.
+
+Benchmark (bytes saved, serialization cost per turn):
+script_checkpoint_serde.py
+
+Config (env):
+    CHECKPOINT_COMPRESSION=false        (true: compress new rows, one-way, see above)
+    CHECKPOINT_ZSTD_LEVEL=3
+    CHECKPOINT_ZSTD_MIN_BYTES=256
+    CHECKPOINT_ZSTD_DICT_PATH=          (empty: zstd without dictionary)
+"""
+
+import os
+import logging
+import threading
+from typing import Any, Optional
+
+import zstandard as zstd
+from langgraph.checkpoint.serde.base import SerializerProtocol
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_COMPRESSION = os.getenv("CHECKPOINT_COMPRESSION", "false").lower() in ("true", "1", "yes")
+CHECKPOINT_ZSTD_LEVEL = int(os.getenv("CHECKPOINT_ZSTD_LEVEL", "3"))
+CHECKPOINT_ZSTD_MIN_BYTES = int(os.getenv("CHECKPOINT_ZSTD_MIN_BYTES", "256"))
+CHECKPOINT_ZSTD_DICT_PATH = os.getenv("CHECKPOINT_ZSTD_DICT_PATH", "")
+
+ZSTD_SUFFIX = "+zstd"
+DEFAULT_DICT_SIZE = 112640  # zstd's default (110 KB)
+
+
+def load_dictionaries(paths: str = CHECKPOINT_ZSTD_DICT_PATH) -> list[zstd.ZstdCompressionDict]:
+    """Dictionaries from a comma-separated list of files (compression one first)."""
+    dictionaries = []
+    for path in (p.strip() for p in paths.split(",")):
+        if not path:
+            continue
+        try:
+            with open(path, "rb") as f:
+                dictionary = zstd.ZstdCompressionDict(f.read())
+            dictionaries.append(dictionary)
+            logger.info(f"🗜️ [CHECKPOINT-SERDE] Loaded dictionary {path} (id={dictionary.dict_id()})")
+        except OSError as e:
+            # Rows compressed with it will fail to load: surface it loudly
+            logger.error(f"🗜️ [CHECKPOINT-SERDE] Could not load dictionary {path}: {e}")
+    return dictionaries
+
+
+def train_dictionary(samples: list[bytes], size: int = DEFAULT_DICT_SIZE, level: int = CHECKPOINT_ZSTD_LEVEL) -> zstd.ZstdCompressionDict:
+    """Train a dictionary on raw (uncompressed) serialized payloads."""
+    return zstd.train_dictionary(size, samples, level=level)
+
+
+class CompressedSerializer(SerializerProtocol):
+    """JsonPlusSerializer payloads compressed with zstd (see module docstring)."""
+
+    def __init__(
+        self,
+        serde: Optional[SerializerProtocol] = None,
+        dictionaries: Optional[list[zstd.ZstdCompressionDict]] = None,
+        level: int = CHECKPOINT_ZSTD_LEVEL,
+        min_bytes: int = CHECKPOINT_ZSTD_MIN_BYTES,
+        compress: bool = CHECKPOINT_COMPRESSION,
+    ):
+        self.serde = serde or JsonPlusSerializer()
+        self.dictionaries = list(dictionaries or [])
+        self.level = level
+        self.min_bytes = min_bytes
+        self.compress = compress
+        self._by_id = {d.dict_id(): d for d in self.dictionaries}
+        # zstd (de)compressor objects must not be shared between threads
+        self._local = threading.local()
+
+    @property
+    def dict_id(self) -> int:
+        """Id of the compression dictionary (0: none)."""
+        return self.dictionaries[0].dict_id() if self.dictionaries else 0
+
+    def _compressor(self) -> zstd.ZstdCompressor:
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            dictionary = self.dictionaries[0] if self.dictionaries else None
+            compressor = zstd.ZstdCompressor(level=self.level, dict_data=dictionary)
+            self._local.compressor = compressor
+        return compressor
+
+    def _decompressor(self, dict_id: int) -> zstd.ZstdDecompressor:
+        decompressors = getattr(self._local, "decompressors", None)
+        if decompressors is None:
+            decompressors = self._local.decompressors = {}
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id and dict_id not in self._by_id:
+                raise ValueError(f"Checkpoint compressed with zstd dictionary {dict_id}, not in CHECKPOINT_ZSTD_DICT_PATH")
+            decompressor = zstd.ZstdDecompressor(dict_data=self._by_id.get(dict_id))
+            decompressors[dict_id] = decompressor
+        return decompressor
+
+    def compress_typed(self, data: tuple[str, bytes]) -> tuple[str, bytes]:
+        """Compress an already serialized (type, bytes) pair when worth it."""
+        type_, payload = data
+        if not self.compress or type_.endswith(ZSTD_SUFFIX) or len(payload) < self.min_bytes:
+            return data
+        compressed = self._compressor().compress(payload)
+        if len(compressed) >= len(payload):
+            return data
+        return type_ + ZSTD_SUFFIX, compressed
+
+    def decompress_typed(self, data: tuple[str, bytes]) -> tuple[str, bytes]:
+        """Inverse of compress_typed; legacy pairs are returned unchanged."""
+        type_, payload = data
+        if not type_.endswith(ZSTD_SUFFIX):
+            return data
+        dict_id = zstd.get_frame_parameters(payload).dict_id
+        return type_[: -len(ZSTD_SUFFIX)], self._decompressor(dict_id).decompress(payload)
+
+    def dumps_typed(self, obj: Any) -> tuple[str, bytes]:
+        return self.compress_typed(self.serde.dumps_typed(obj))
+
+    def loads_typed(self, data: tuple[str, bytes]) -> Any:
+        return self.serde.loads_typed(self.decompress_typed(data))
+
+
+def checkpoint_serde() -> CompressedSerializer:
+    """Serializer for the PostgresSaver in main.py."""
+    serde = CompressedSerializer(dictionaries=load_dictionaries())
+    logger.info(
+        f"🗜️ [CHECKPOINT-SERDE] compression={'on' if serde.compress else 'off'} "
+        f"level={serde.level} min_bytes={serde.min_bytes} dict_id={serde.dict_id or 'none'}"
+    )
+    return serde
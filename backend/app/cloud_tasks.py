@@ -15,6 +15,9 @@ This gives us:
 import json
 import os
 import logging
+from datetime import datetime, timedelta, timezone
+
+from .metrics import record_enqueue
 
 logger = logging.getLogger(__name__)
 
@@ -59,20 +62,24 @@ def enqueue_chat(task_id: str, message: str, thread_id: str) -> bool:
 
         client.create_task(request={"parent": parent, "task": task})
         logger.info(f"📬 Chat task enqueued: task_id={task_id} thread_id={thread_id}")
+        record_enqueue("chat", ok=True)
         return True
 
     except Exception as e:
         logger.error(f"❌ Failed to enqueue chat Cloud Task: {e}")
+        record_enqueue("chat", ok=False)
         return False
 
 
-def enqueue_message(parsed: dict, tenant_name: str) -> bool:
+def enqueue_message(parsed: dict, tenant_name: str, delay_seconds: int = 0) -> bool:
     """
     Enqueue a WhatsApp message for async processing via Cloud Tasks.
 
     Args:
-        parsed:      Dict from parse_incoming_message()
-        tenant_name: Name of the tenant (e.g. "Xplouse", "Cootradecun")
+        parsed:        Dict from parse_incoming_message()
+        tenant_name:   Name of the tenant (e.g. "Xplouse", "Cootradecun")
+        delay_seconds: Schedule the task later (requeue while the thread is
+                       locked by another instance, see thread_locks.py)
 
     Returns:
         True if enqueued successfully, False otherwise.
@@ -103,14 +110,22 @@ def enqueue_message(parsed: dict, tenant_name: str) -> bool:
                 "body": json.dumps(payload).encode(),
             }
         }
+        if delay_seconds:
+            from google.protobuf import timestamp_pb2
+
+            schedule_time = timestamp_pb2.Timestamp()
+            schedule_time.FromDatetime(datetime.now(timezone.utc) + timedelta(seconds=delay_seconds))
+            task["schedule_time"] = schedule_time
 
         client.create_task(request={"parent": parent, "task": task})
         logger.info(
             f"📬 Task enqueued for tenant={tenant_name} "
             f"from=+{parsed['sender'][-4:].rjust(len(parsed['sender']), '*')}"
         )
+        record_enqueue("message", ok=True)
         return True
 
     except Exception as e:
         logger.error(f"❌ Failed to enqueue Cloud Task: {e}")
+        record_enqueue("message", ok=False)
         return False
\ No newline at end of file
@@ -3,13 +3,21 @@ Async SQLAlchemy database module.
 
 Provides async engine and session factory for the chatbot models.
 Reuses the DATABASE_URL from environment (also used by LangGraph checkpointer).
+Its pool is sized from the process connection budget (see db_pools.py).
+
+create_tables() also adds the columns introduced after the tables existed
+(COLUMN_MIGRATIONS): create_all never alters an existing table, and code
+that writes a missing column would fail every insert.
 """
 
 import os
 import logging
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import DeclarativeBase
 
+from .db_pools import engine_kwargs
+
 logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL", "")
@@ -20,6 +28,12 @@ ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg:/
 engine = None
 async_session_factory = None
 
+# Idempotent and metadata-only (nullable, no default): safe on every startup
+COLUMN_MIGRATIONS = [
+    # docs/add_trace_id.sql (its index is left to that script)
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS trace_id VARCHAR(32)",
+]
+
 
 class Base(DeclarativeBase):
     """Base class for all SQLAlchemy models."""
@@ -34,10 +48,8 @@ def _ensure_engine():
             raise RuntimeError("DATABASE_URL not configured")
         engine = create_async_engine(
             ASYNC_DATABASE_URL,
-            pool_size=5,
-            max_overflow=10,
-            pool_pre_ping=True,
             echo=False,
+            **engine_kwargs(),
         )
         async_session_factory = async_sessionmaker(
             engine, class_=AsyncSession, expire_on_commit=False
@@ -56,8 +68,10 @@ async def get_db():
 
 
 async def create_tables():
-    """Create all tables defined by Base metadata."""
+    """Create all tables defined by Base metadata and add missing columns."""
     _ensure_engine()
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for statement in COLUMN_MIGRATIONS:
+            await conn.execute(text(statement))
     logger.info("✅ Database tables created/verified")
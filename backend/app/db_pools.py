@@ -0,0 +1,301 @@
+"""
+Database Pools — every PostgreSQL connection of the process, from one budget.
+
+Each module used to size its own pool: checkpointer 10, RAG 5, db_writer 5,
+SQLAlchemy 5 + 10 overflow. That is up to 35 connections per Cloud Run
+instance, so scaling out exhausted Cloud SQL max_connections long before
+CPU. Here the pools are created in one place:
+
+1. Budget: DB_CONNECTION_BUDGET is the most connections one instance may
+   open (Cloud SQL max_connections minus the reserved ones, divided by the
+   max instance count). It is split across the pools by the DB_POOL_SHARES
+   weights (every pool gets at least 1); the pool sizes never add up to
+   more than the budget, and SQLAlchemy gets no overflow.
+2. Shared pools, where the drivers allow it:
+   - sync_pool() (psycopg): RAG queries, embedding/expansion caches, the
+     pre-router centroids and, without ASYNC_GRAPH, the checkpointer.
+   - async_pool() (psycopg, ASYNC_GRAPH only): the checkpointer and the
+     advisory thread locks.
+   - asyncpg_pool(): db_writer (written against asyncpg).
+   - engine_kwargs(): the SQLAlchemy engine of database.py (read API).
+   SQLAlchemy cannot adopt an existing pool and db_writer is asyncpg
+   code, so those two keep their own pools, sized from the same budget.
+3. Profile: DB_POOL_PROFILE=pgbouncer for a pgbouncer in transaction mode
+   in front of Cloud SQL. No server-side prepared statements (psycopg
+   prepare_threshold=None, asyncpg statement_cache_size=0, SQLAlchemy's
+   asyncpg cache off with unique statement names), and no session advisory
+   locks (thread_locks stays local).
+4. Metrics: size / idle / in use / max / waiting per pool, utilization,
+   and acquire count / wait time / timeouts (psycopg from its pool stats,
+   asyncpg measured in acquire(); SQLAlchemy: utilization only) as
+   chatbot_db_pool_* in /metrics. Stats: db_pool_stats() (GET /db/pools/stats).
+
+Config (env):
+    DB_CONNECTION_BUDGET=20
+    DB_POOL_SHARES=async:4,sync:3,asyncpg:2,sqlalchemy:1
+    DB_POOL_PROFILE=direct              (direct | pgbouncer)
+    DB_POOL_TIMEOUT_S=30
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+from .metrics import pool_stats, register_pool
+
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "20"))
+DB_POOL_SHARES = os.getenv("DB_POOL_SHARES", "async:4,sync:3,asyncpg:2,sqlalchemy:1")
+DB_POOL_PROFILE = os.getenv("DB_POOL_PROFILE", "direct").lower()
+DB_POOL_TIMEOUT_S = float(os.getenv("DB_POOL_TIMEOUT_S", "30"))
+
+PGBOUNCER = DB_POOL_PROFILE == "pgbouncer"
+
+# libpq URL for psycopg / asyncpg (SQLAlchemy's "+asyncpg" prefix removed)
+PG_URL = (
+    DATABASE_URL
+    .replace("postgresql+asyncpg://", "postgresql://", 1)
+    .replace("postgres+asyncpg://", "postgresql://", 1)
+)
+
+
+# --- Budget ---
+
+def parse_shares(spec: str) -> dict[str, float]:
+    shares = {}
+    for part in (p.strip() for p in spec.split(",")):
+        if part:
+            name, _, weight = part.partition(":")
+            shares[name.strip()] = float(weight or 1)
+    return shares
+
+
+def split_budget(budget: int, shares: dict[str, float]) -> dict[str, int]:
+    """
+    Pool sizes proportional to the shares, at least 1 each, summing to at
+    most the budget (largest remainders get the leftover connections).
+    """
+    names = [n for n, w in shares.items() if w > 0]
+    if not names:
+        return {}
+    if budget < len(names):
+        logger.warning(f"🗄️ [DB-POOLS] DB_CONNECTION_BUDGET={budget} is below one connection per pool; using {len(names)}")
+        budget = len(names)
+    spare = budget - len(names)  # After the guaranteed 1 per pool
+    total = sum(shares[n] for n in names)
+    exact = {n: spare * shares[n] / total for n in names}
+    sizes = {n: 1 + int(exact[n]) for n in names}
+    leftover = budget - sum(sizes.values())
+    for n in sorted(names, key=lambda n: exact[n] - int(exact[n]), reverse=True)[:leftover]:
+        sizes[n] += 1
+    return sizes
+
+
+_sizes: Optional[dict[str, int]] = None
+
+
+def pool_sizes() -> dict[str, int]:
+    """Max connections per pool. Without ASYNC_GRAPH the async share goes to the sync pool."""
+    global _sizes
+    if _sizes is None:
+        from .debug import ASYNC_GRAPH  # debug imports thread_locks, which imports this module
+
+        shares = parse_shares(DB_POOL_SHARES)
+        if not ASYNC_GRAPH:
+            shares["sync"] = shares.get("sync", 0) + shares.pop("async", 0)
+        _sizes = split_budget(DB_CONNECTION_BUDGET, shares)
+        logger.info(
+            f"🗄️ [DB-POOLS] budget={DB_CONNECTION_BUDGET} profile={DB_POOL_PROFILE} "
+            + " ".join(f"{n}={s}" for n, s in _sizes.items())
+        )
+    return _sizes
+
+
+def _psycopg_kwargs() -> dict:
+    # prepare_threshold=None: never prepare server-side (pgbouncer transaction mode)
+    return {"prepare_threshold": None} if PGBOUNCER else {}
+
+
+# --- psycopg pools ---
+
+_sync_pool: Optional[ConnectionPool] = None
+_async_pool: Optional[AsyncConnectionPool] = None
+_sync_lock = threading.Lock()
+
+
+def sync_pool() -> ConnectionPool:
+    """Shared sync psycopg pool (lazy; opened on creation)."""
+    global _sync_pool
+    if _sync_pool is None:
+        if not PG_URL:
+            raise RuntimeError("DATABASE_URL not configured")
+        with _sync_lock:
+            if _sync_pool is None:
+                _sync_pool = ConnectionPool(
+                    conninfo=PG_URL,
+                    kwargs=_psycopg_kwargs(),
+                    min_size=1,
+                    max_size=pool_sizes()["sync"],
+                    timeout=DB_POOL_TIMEOUT_S,
+                    max_lifetime=3600,
+                    reconnect_timeout=30,
+                    check=ConnectionPool.check_connection,
+                    name="sync",
+                    open=True,
+                )
+    return _sync_pool
+
+
+def async_pool() -> AsyncConnectionPool:
+    """Shared async psycopg pool; opened by open_pools() inside the running loop."""
+    global _async_pool
+    if _async_pool is None:
+        if not PG_URL:
+            raise RuntimeError("DATABASE_URL not configured")
+        _async_pool = AsyncConnectionPool(
+            conninfo=PG_URL,
+            kwargs=_psycopg_kwargs(),
+            min_size=1,
+            max_size=pool_sizes()["async"],
+            timeout=DB_POOL_TIMEOUT_S,
+            max_lifetime=3600,
+            reconnect_timeout=30,
+            check=AsyncConnectionPool.check_connection,
+            name="async",
+            open=False,
+        )
+    return _async_pool
+
+
+# --- asyncpg pool (db_writer) ---
+
+class TimedAsyncpgPool:
+    """asyncpg.Pool whose acquire() records the wait (asyncpg keeps no such stats)."""
+
+    def __init__(self, pool):
+        self._pool = pool
+        self.requests = 0
+        self.wait_ms_total = 0.0
+        self.timeouts = 0
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator:
+        started = time.perf_counter()
+        try:
+            conn = await self._pool.acquire(timeout=DB_POOL_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.requests += 1
+            self.wait_ms_total += (time.perf_counter() - started) * 1000
+        try:
+            yield conn
+        finally:
+            await self._pool.release(conn)
+
+    def acquire_stats(self) -> dict:
+        return {"requests": self.requests, "wait_seconds": self.wait_ms_total / 1000, "timeouts": self.timeouts}
+
+
+_asyncpg_pool: Optional[TimedAsyncpgPool] = None
+_asyncpg_lock: Optional[asyncio.Lock] = None
+
+
+async def asyncpg_pool() -> Optional[TimedAsyncpgPool]:
+    """Lazy asyncpg pool, or None when DATABASE_URL is not configured."""
+    global _asyncpg_pool, _asyncpg_lock
+    if _asyncpg_pool is None and PG_URL:
+        import asyncpg
+
+        _asyncpg_lock = _asyncpg_lock or asyncio.Lock()
+        async with _asyncpg_lock:
+            if _asyncpg_pool is None:
+                size = pool_sizes()["asyncpg"]
+                pool = await asyncpg.create_pool(
+                    PG_URL,
+                    min_size=1,
+                    max_size=size,
+                    # Server-side statement cache off behind pgbouncer (transaction mode)
+                    statement_cache_size=0 if PGBOUNCER else 100,
+                )
+                _asyncpg_pool = TimedAsyncpgPool(pool)
+                logger.info(f"🗄️ [DB-POOLS] asyncpg pool created (min=1, max={size})")
+    return _asyncpg_pool
+
+
+# --- SQLAlchemy engine ---
+
+def engine_kwargs() -> dict:
+    """create_async_engine pool arguments within the budget (database.py)."""
+    kwargs = {
+        "pool_size": pool_sizes()["sqlalchemy"],
+        "max_overflow": 0,  # Overflow connections would exceed the budget
+        "pool_timeout": DB_POOL_TIMEOUT_S,
+        "pool_pre_ping": True,
+    }
+    if PGBOUNCER:
+        import uuid
+
+        kwargs["connect_args"] = {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            # asyncpg still prepares unnamed statements; unique names avoid clashes across server connections
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+        }
+    return kwargs
+
+
+# --- Lifecycle and stats ---
+
+async def open_pools() -> None:
+    """Open the async pool (needs a running event loop); call on startup."""
+    if _async_pool is not None:
+        await _async_pool.open()
+
+
+async def close_pools() -> None:
+    """Close every pool; call on shutdown."""
+    global _asyncpg_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+    if _asyncpg_pool is not None:
+        await _asyncpg_pool.close()
+        _asyncpg_pool = None
+    if _sync_pool is not None:
+        await asyncio.to_thread(_sync_pool.close)
+    from . import database
+    if database.engine is not None:
+        await database.engine.dispose()
+
+
+def _sqlalchemy_pool():
+    from . import database
+    return database.engine.pool if database.engine is not None else None
+
+
+register_pool("sync", lambda: _sync_pool)
+register_pool("async", lambda: _async_pool)
+register_pool("asyncpg", lambda: _asyncpg_pool)
+register_pool("sqlalchemy", _sqlalchemy_pool)
+
+
+def db_pool_stats() -> dict:
+    pools = {"sync": _sync_pool, "async": _async_pool, "asyncpg": _asyncpg_pool, "sqlalchemy": _sqlalchemy_pool()}
+    return {
+        "budget": DB_CONNECTION_BUDGET,
+        "profile": DB_POOL_PROFILE,
+        "sizes": pool_sizes(),
+        "pools": {name: pool_stats(pool) for name, pool in pools.items() if pool is not None},
+    }
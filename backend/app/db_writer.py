@@ -10,13 +10,21 @@ Uses asyncpg directly (bypassing SQLAlchemy) to maintain independence
 from the main engine and minimize the risk of interference with the
 chatbot flow.
 
-Connection management: uses an asyncpg.Pool (lazy-initialized) for
-efficient connection reuse. Each function acquires and releases a
-connection from the pool via `async with`.
+Connection management: uses the process-wide asyncpg pool of db_pools.py
+(lazy-initialized, sized from the connection budget). Each function
+acquires and releases a connection from the pool via `async with`.
+
+Turns: persist_turn writes a whole turn (contact, session, user and bot
+messages, session and contact counters) in ONE statement, so a WhatsApp
+turn costs one round trip instead of seven or more. The per-row functions
+below remain for other callers.
 
 Error handling: each function has its own try/except that logs the error
 without propagating it — never blocks the chatbot flow.
 
+Tracing: every write is a db span of the current turn's trace, and
+conversations rows carry the turn's trace_id (app/tracing.py).
+
 Session window:
   A session spans 24 hours from the first message. If the user writes again
   within that window, the same session is reused. After 24h, the old session
@@ -25,54 +33,32 @@ Session window:
   property on the SQLAlchemy model, which computes the status at read time.
 """
 
-import os
 import uuid
 import logging
 
-import asyncpg
+from .db_pools import PG_URL, TimedAsyncpgPool, asyncpg_pool
+from .tracing import current_trace_id, traced
 
 logger = logging.getLogger(__name__)
 
-# Normalize DATABASE_URL: raw asyncpg does not accept the "+asyncpg" prefix from SQLAlchemy
-_DATABASE_URL = (
-    os.getenv("DATABASE_URL", "")
-    .replace("postgresql+asyncpg://", "postgresql://", 1)
-    .replace("postgres+asyncpg://", "postgresql://", 1)
-)
-
 
 # ─── Connection Pool ────────────────────────────────────────────────────────
 
-_pool: asyncpg.Pool | None = None
-
-
-async def _get_pool() -> asyncpg.Pool | None:
-    """Returns a shared asyncpg connection pool (lazy init), or None if unconfigured."""
-    global _pool
-    if not _DATABASE_URL:
+async def _get_pool() -> TimedAsyncpgPool | None:
+    """Returns the shared asyncpg connection pool (see db_pools.py), or None if unconfigured."""
+    if not PG_URL:
         logger.warning("[db_writer] DATABASE_URL not configured — v4.0 writes disabled")
         return None
-    if _pool is None:
-        try:
-            _pool = await asyncpg.create_pool(_DATABASE_URL, min_size=1, max_size=5)
-            logger.info("[db_writer] Connection pool created (min=1, max=5)")
-        except Exception as e:
-            logger.error(f"[db_writer] Could not create connection pool: {e}")
-            return None
-    return _pool
-
-
-async def close_pool() -> None:
-    """Closes the connection pool. Call on app shutdown."""
-    global _pool
-    if _pool:
-        await _pool.close()
-        _pool = None
-        logger.info("[db_writer] Connection pool closed")
+    try:
+        return await asyncpg_pool()
+    except Exception as e:
+        logger.error(f"[db_writer] Could not create connection pool: {e}")
+        return None
 
 
 # ─── whatsapp_contacts ──────────────────────────────────────────────────────
 
+@traced("db_writer.upsert_contact", kind="db")
 async def upsert_contact(phone: str, name: str | None = None) -> str | None:
     """
     Creates or updates a contact in whatsapp_contacts.
@@ -108,6 +94,7 @@ async def upsert_contact(phone: str, name: str | None = None) -> str | None:
 
 # ─── sessions ───────────────────────────────────────────────────────────────
 
+@traced("db_writer.upsert_session", kind="db")
 async def upsert_session(contact_id: str, session_key: str) -> str | None:
     """
     Returns the active session ID for the given contact within the last 24 hours.
@@ -182,6 +169,7 @@ async def upsert_session(contact_id: str, session_key: str) -> str | None:
 
 # ─── conversations (unified messages) ──────────────────────────────────────
 
+@traced("db_writer.save_conversation", kind="db")
 async def save_conversation(
     session_id: str,
     role: str,
@@ -197,6 +185,7 @@ async def save_conversation(
     response_time_ms: int | None = None,
     tokens_in: int = 0,
     tokens_out: int = 0,
+    trace_id: str | None = None,
 ) -> None:
     """
     Writes a single message to the conversations table (unified).
@@ -206,13 +195,15 @@ async def save_conversation(
     response time, tokens, etc.).
 
     Position is auto-calculated as MAX(position)+1 for the session.
+    trace_id defaults to the current turn's trace (app/tracing.py).
     """
     pool = await _get_pool()
     if not pool:
         return
     try:
         async with pool.acquire() as conn:
-            # Pass session_id as str — the column type is TEXT, not UUID
+            # Pass session_id as str — accepted whether the column is TEXT
+            # (deployed schema) or UUID (ORM model / create_all)
             session_id_str = str(session_id)
 
             # Auto-calculate position
@@ -229,14 +220,14 @@ async def save_conversation(
                     detected_intent, department, tenant,
                     is_fallback, fallback_message,
                     response_time_ms, tokens_input, tokens_output,
-                    created_at
+                    trace_id, created_at
                 ) VALUES (
                     $1, $2, $3, $4,
                     $5, $6, 'text', $7,
                     $8, $9, $10,
                     $11, $12,
                     $13, $14, $15,
-                    NOW()
+                    $16, NOW()
                 )
             """,
                 session_id_str, wa_message_id, user_phone, user_name,
@@ -244,6 +235,7 @@ async def save_conversation(
                 detected_intent, department, tenant,
                 is_fallback, message if is_fallback else None,
                 response_time_ms, tokens_in, tokens_out,
+                trace_id or current_trace_id(),
             )
             logger.debug(
                 f"[db_writer] save_conversation OK — session={session_id} "
@@ -253,8 +245,223 @@ async def save_conversation(
         logger.error(f"[db_writer] save_conversation failed (session={session_id}, role={role}): {e}")
 
 
+# ─── persist_turn (one round trip per turn) ─────────────────────────────────
+
+# upsert_contact + upsert_session + save_conversation (user rows and the bot
+# row) + update_session_stats + mark_resolution + increment_contact_messages
+# as ONE statement: data-modifying CTEs run in a single snapshot and an
+# implicit transaction, so a turn is persisted entirely or not at all.
+# A session created here gets its counters at INSERT (CTEs cannot update
+# rows inserted by a sibling CTE); an existing one is updated. Positions
+# continue after MAX(position) of the session, read through
+# ix_conv_session_pos (session_id, position). conversations.session_id is
+# TEXT in the deployed schema but UUID in the ORM model, so the session id
+# is compared in the column's real type (never cast the column: the index
+# would be skipped, and text = uuid does not exist).
+_PERSIST_TURN_SQL_TEMPLATE = """
+    WITH params AS (
+        SELECT $1::text AS phone, $2::text AS name, $3::text AS session_key,
+               $4::text[] AS user_messages, $5::text[] AS user_message_ids,
+               $6::text AS bot_message, $7::text AS tenant,
+               $8::text AS detected_intent, $9::text AS primary_intent,
+               $10::boolean AS is_fallback, $11::integer AS response_time_ms,
+               $12::integer AS tokens_in, $13::integer AS tokens_out,
+               $14::numeric AS cost, $15::boolean AS resolved, $16::text AS trace_id,
+               cardinality($4::text[]) AS user_count,
+               CASE WHEN $6::text IS NULL THEN 0 ELSE 1 END AS bot_count
+    ),
+    existing AS (
+        SELECT s.id
+        FROM sessions s
+        JOIN whatsapp_contacts c ON c.id = s.contact_id
+        WHERE c.phone = $1
+          AND s.status = 'active'
+          AND s.started_at > NOW() - INTERVAL '24 hours'
+        ORDER BY s.started_at DESC
+        LIMIT 1
+    ),
+    contact AS (
+        INSERT INTO whatsapp_contacts (phone, name, first_seen_at, last_seen_at, total_sessions, total_messages)
+        SELECT p.phone, p.name, NOW(), NOW(),
+               CASE WHEN EXISTS (SELECT 1 FROM existing) THEN 0 ELSE 1 END,
+               p.user_count + p.bot_count
+        FROM params p
+        ON CONFLICT (phone) DO UPDATE
+            SET name           = COALESCE(EXCLUDED.name, whatsapp_contacts.name),
+                last_seen_at   = NOW(),
+                total_messages = whatsapp_contacts.total_messages + EXCLUDED.total_messages,
+                -- EXCLUDED.total_sessions is 1 when this turn opens a new session
+                is_returning   = CASE WHEN EXCLUDED.total_sessions = 1
+                                      THEN whatsapp_contacts.total_sessions >= 1
+                                      ELSE whatsapp_contacts.is_returning END,
+                total_sessions = whatsapp_contacts.total_sessions + EXCLUDED.total_sessions,
+                updated_at     = NOW()
+        RETURNING id
+    ),
+    abandoned AS (
+        UPDATE sessions s
+        SET status           = 'abandoned',
+            ended_at         = NOW(),
+            duration_seconds = EXTRACT(EPOCH FROM (NOW() - s.started_at))::INTEGER,
+            updated_at       = NOW()
+        FROM contact c
+        WHERE s.contact_id = c.id
+          AND s.status = 'active'
+          AND NOT EXISTS (SELECT 1 FROM existing)
+    ),
+    created AS (
+        INSERT INTO sessions (
+            session_key, contact_id, status, started_at,
+            total_messages, user_messages, bot_messages, fallback_count, primary_intent,
+            total_tokens_input, total_tokens_output, estimated_cost_usd, had_resolution
+        )
+        SELECT p.session_key, c.id, 'active', NOW(),
+               p.user_count + p.bot_count, p.user_count, p.bot_count, p.is_fallback::int, p.primary_intent,
+               p.tokens_in, p.tokens_out, p.cost, p.resolved
+        FROM contact c, params p
+        WHERE NOT EXISTS (SELECT 1 FROM existing)
+        RETURNING id
+    ),
+    updated AS (
+        UPDATE sessions s SET
+            total_messages      = s.total_messages      + p.user_count + p.bot_count,
+            user_messages       = s.user_messages       + p.user_count,
+            bot_messages        = s.bot_messages        + p.bot_count,
+            fallback_count      = s.fallback_count      + p.is_fallback::int,
+            primary_intent      = COALESCE(p.primary_intent, s.primary_intent),
+            total_tokens_input  = s.total_tokens_input  + p.tokens_in,
+            total_tokens_output = s.total_tokens_output + p.tokens_out,
+            estimated_cost_usd  = s.estimated_cost_usd  + p.cost,
+            had_resolution      = s.had_resolution OR p.resolved,
+            updated_at          = NOW()
+        FROM existing e, params p
+        WHERE s.id = e.id
+        RETURNING s.id
+    ),
+    turn_session AS (
+        SELECT id, (
+            SELECT COALESCE(MAX(position), 0) FROM conversations WHERE session_id = {session_id}
+        ) AS position
+        FROM (SELECT id FROM updated UNION ALL SELECT id FROM created) t
+    ),
+    saved AS (
+        INSERT INTO conversations (
+            session_id, wa_message_id, user_phone, user_name,
+            message, role, message_type, position,
+            detected_intent, department, tenant,
+            is_fallback, fallback_message,
+            response_time_ms, tokens_input, tokens_output,
+            trace_id, created_at
+        )
+        SELECT s.id, u.wa_message_id, p.phone, p.name,
+               u.message, 'user', 'text', s.position + u.ord,
+               NULL, NULL, p.tenant,
+               FALSE, NULL,
+               NULL, 0, 0,
+               p.trace_id, NOW()
+        FROM turn_session s, params p,
+             unnest(p.user_messages, p.user_message_ids) WITH ORDINALITY AS u(message, wa_message_id, ord)
+        UNION ALL
+        SELECT s.id, NULL, p.phone, p.name,
+               p.bot_message, 'assistant', 'text', s.position + p.user_count + 1,
+               p.detected_intent, NULL, p.tenant,
+               p.is_fallback, CASE WHEN p.is_fallback THEN p.bot_message END,
+               p.response_time_ms, p.tokens_in, p.tokens_out,
+               p.trace_id, NOW()
+        FROM turn_session s, params p
+        WHERE p.bot_message IS NOT NULL
+        RETURNING 1
+    )
+    SELECT (SELECT id::TEXT FROM turn_session) AS session_id, (SELECT count(*) FROM saved) AS saved
+"""
+_PERSIST_TURN_SQL = {
+    "uuid": _PERSIST_TURN_SQL_TEMPLATE.format(session_id="t.id"),
+    "text": _PERSIST_TURN_SQL_TEMPLATE.format(session_id="t.id::TEXT"),
+}
+
+_session_id_type: str | None = None
+
+
+async def _conversations_session_id_type(conn) -> str:
+    """'uuid' or 'text': the real type of conversations.session_id (read once per process)."""
+    global _session_id_type
+    if _session_id_type is None:
+        data_type = await conn.fetchval("""
+            SELECT data_type
+            FROM information_schema.columns
+            WHERE table_schema = current_schema()
+              AND table_name = 'conversations'
+              AND column_name = 'session_id'
+        """)
+        _session_id_type = "uuid" if data_type == "uuid" else "text"
+        logger.info(f"[db_writer] conversations.session_id is {data_type}")
+    return _session_id_type
+
+
+@traced("db_writer.persist_turn", kind="db")
+async def persist_turn(
+    phone: str,
+    name: str | None,
+    session_key: str,
+    user_messages: list[dict],
+    bot_message: str | None = None,
+    *,
+    tenant: str | None = None,
+    detected_intent: str | None = None,
+    primary_intent: str | None = None,
+    is_fallback: bool = False,
+    response_time_ms: int | None = None,
+    tokens_in: int = 0,
+    tokens_out: int = 0,
+    estimated_cost: float = 0.0,
+    resolved: bool = False,
+    trace_id: str | None = None,
+) -> str | None:
+    """
+    Writes a whole turn in one round trip (one statement, one transaction).
+
+    Same effect as the per-call API of a turn: upsert_contact, upsert_session
+    (24h window), save_conversation for every user message
+    ({"text", "message_id"}, in order) and for bot_message,
+    update_session_stats, mark_resolution (resolved=True) and
+    increment_contact_messages.
+
+    bot_message=None stores only the user messages (e.g. the agent failed).
+    primary_intent=None keeps the session's current one.
+    trace_id defaults to the current turn's trace (app/tracing.py).
+
+    Returns the session UUID (str), or None on failure.
+    """
+    pool = await _get_pool()
+    if not pool:
+        return None
+    try:
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(
+                _PERSIST_TURN_SQL[await _conversations_session_id_type(conn)],
+                phone, name, f"{session_key}-{uuid.uuid4().hex[:8]}",
+                [m["text"] for m in user_messages], [m.get("message_id") for m in user_messages],
+                bot_message, tenant,
+                detected_intent, primary_intent,
+                is_fallback and bot_message is not None, response_time_ms,
+                tokens_in or 0, tokens_out or 0,
+                estimated_cost or 0.0, resolved,
+                trace_id or current_trace_id(),
+            )
+            session_id = row["session_id"] if row else None
+            logger.debug(
+                f"[db_writer] persist_turn OK — phone={phone} session={session_id} "
+                f"rows={row['saved'] if row else 0}"
+            )
+            return session_id
+    except Exception as e:
+        logger.error(f"[db_writer] persist_turn failed (phone={phone}): {e}")
+        return None
+
+
 # ─── mark_resolution ────────────────────────────────────────────────────────
 
+@traced("db_writer.mark_resolution", kind="db")
 async def mark_resolution(session_id: str) -> None:
     """
     Marks had_resolution=TRUE on a session.
@@ -284,6 +491,7 @@ async def mark_resolution(session_id: str) -> None:
 
 # ─── close_session ──────────────────────────────────────────────────────────
 
+@traced("db_writer.close_session", kind="db")
 async def close_session(
     session_id: str,
     resolution_type: str = "self_service",  # "self_service" | "timeout" | "abandoned"
@@ -324,6 +532,7 @@ async def close_session(
 
 # ─── update_session_stats ────────────────────────────────────────────────────
 
+@traced("db_writer.update_session_stats", kind="db")
 async def update_session_stats(
     session_id: str,
     *,
@@ -338,8 +547,8 @@ async def update_session_stats(
     """
     Incremental UPDATE of session counters after each conversation turn.
 
-    Called once per bot response in /chat/fake_whatsapp to keep sessions
-    table up-to-date without blocking the chatbot flow.
+    Per-turn counters are written by persist_turn; this is for updates
+    outside a turn.
 
     - Counters (messages, tokens, fallback) are incremented atomically.
     - primary_intent is only written when a non-None value is provided.
@@ -410,12 +619,13 @@ async def update_session_stats(
 
 # ─── increment_contact_messages ─────────────────────────────────────────────
 
+@traced("db_writer.increment_contact_messages", kind="db")
 async def increment_contact_messages(phone: str, count: int = 1) -> None:
     """
     Increments total_messages counter for a WhatsApp contact.
 
-    Called after each full turn (user + bot) in /chat/fake_whatsapp.
-    Uses an atomic UPDATE to avoid race conditions.
+    Per-turn counts are written by persist_turn; this is for updates
+    outside a turn. Uses an atomic UPDATE to avoid race conditions.
     """
     pool = await _get_pool()
     if not pool:
@@ -6,18 +6,48 @@ execution metadata: nodes visited, tool calls, token usage, and timings.
 
 Controlled by the DEBUG_GRAPH environment variable (default: False).
 When disabled, graph.invoke() is used as before with zero overhead.
+
+ASYNC_GRAPH (default: False) selects the end-to-end async execution path:
+the graph runs through graph.ainvoke()/graph.astream() against an async
+checkpointer, so a slow LLM turn never blocks the uvicorn event loop.
+When disabled, async callers run the sync graph on a worker thread.
+
+Every run also gets the trace callbacks of the current turn (see
+app/tracing.py) and the LLM metrics callbacks (app/metrics.py): per-node,
+LLM and tool spans and LLM latency/tokens are recorded regardless of
+DEBUG_GRAPH.
 """
 
 import os
+import asyncio
 import time
 import logging
+from contextvars import ContextVar
 from typing import Any
 
-from langchain_core.messages import AIMessage, ToolMessage, HumanMessage
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage, HumanMessage
+
+from .thread_locks import thread_id_of, thread_lock
+from .metrics import metrics_config
+from .tracing import traced_config
+from .token_counts import count_tokens_cached, history_tokens
 
 logger = logging.getLogger(__name__)
 
 DEBUG_GRAPH = os.getenv("DEBUG_GRAPH", "false").lower() in ("true", "1", "yes")
+ASYNC_GRAPH = os.getenv("ASYNC_GRAPH", "false").lower() in ("true", "1", "yes")
+
+
+def _unpack_chunk(chunk) -> tuple[str, Any] | None:
+    """Normalize a stream_mode="updates" chunk into (node_name, node_output)."""
+    # LangGraph >=0.2 yields dicts {"node_name": output}, not tuples
+    if isinstance(chunk, tuple):
+        return chunk
+    if isinstance(chunk, dict):
+        node_name = next(iter(chunk))
+        return node_name, chunk[node_name]
+    logger.warning(f"[DEBUG] Unexpected stream chunk type: {type(chunk)}")
+    return None
 
 
 def _extract_step_metadata(node_name: str, node_output: dict) -> dict:
@@ -27,11 +57,16 @@ def _extract_step_metadata(node_name: str, node_output: dict) -> dict:
         "tool_calls": [],
         "token_usage": None,
         "messages_delta": 0,
+        "messages_tokens": 0,
     }
 
     messages = node_output.get("messages", [])
+    if isinstance(messages, BaseMessage):  # Assistant nodes return a single message
+        messages = [messages]
     if isinstance(messages, list):
         step_info["messages_delta"] = len(messages)
+        # Counted once per message; the State reducer reuses the cached count
+        step_info["messages_tokens"] = count_tokens_cached(m for m in messages if isinstance(m, BaseMessage))
 
         for msg in messages:
             # Extract tool calls from AI messages
@@ -69,6 +104,8 @@ def _log_step(step_number: int, step_info: dict, duration_ms: int) -> None:
     parts = [f"🔍 Step {step_number}: [{node}]"]
     parts.append(f"⏱️{duration_ms}ms")
     parts.append(f"msgs_delta={msgs}")
+    if msgs:
+        parts.append(f"msgs_tokens≈{step_info['messages_tokens']}")
 
     if tool_calls:
         tool_names = ", ".join(tc["name"] for tc in tool_calls)
@@ -89,7 +126,8 @@ def _log_summary(steps: list, total_ms: int, final_state: dict) -> None:
 
     dialog_state = final_state.get("dialog_state", [])
     context = final_state.get("context", {})
-    has_summary = bool(context.get("summary"))
+    has_summary = bool(context.get("running_summary"))
+    history = final_state.get("messages", [])
 
     logger.info("━" * 60)
     logger.info("📊 GRAPH EXECUTION SUMMARY")
@@ -98,11 +136,40 @@ def _log_summary(steps: list, total_ms: int, final_state: dict) -> None:
     logger.info(f"   Path:          {' → '.join(nodes_visited)}")
     logger.info(f"   Tool calls:    {total_tool_calls}")
     logger.info(f"   Tokens:        in={total_tokens_in}, out={total_tokens_out}, total={total_tokens_in + total_tokens_out}")
+    logger.info(f"   History:       messages={len(history)}, tokens≈{history_tokens(history)}")
     logger.info(f"   Dialog state:  {dialog_state}")
     logger.info(f"   Has summary:   {has_summary}")
     logger.info("━" * 60)
 
 
+def _handle_step(chunk, steps: list, step_number: int, duration_ms: int) -> int:
+    """
+    Record and log one streamed step. Returns the updated step counter.
+
+    duration_ms is the gap since the previous update: the node's execution
+    plus the checkpoint write of the step before it (exact per-node, LLM
+    and DB times are in the turn's trace, see app/tracing.py).
+    """
+    unpacked = _unpack_chunk(chunk)
+    if unpacked is None:
+        return step_number
+    node_name, node_output = unpacked
+
+    # Some nodes (e.g. summarize) may return None or an empty dict
+    # when they have nothing to do.  Skip them to avoid AttributeError
+    # ("'NoneType' object has no attribute 'get'") in _extract_step_metadata.
+    if not node_output:
+        logger.info(f"🔍 Step (skipped): [{node_name}] returned empty/None output ({duration_ms}ms)")
+        return step_number
+
+    step_number += 1
+    step_info = _extract_step_metadata(node_name, node_output)
+    step_info["duration_ms"] = duration_ms
+    steps.append(step_info)
+    _log_step(step_number, step_info, duration_ms)
+    return step_number
+
+
 def stream_graph_with_debug(
     graph,
     inputs: dict,
@@ -132,35 +199,11 @@ def stream_graph_with_debug(
     step_number = 0
     t_total_start = time.monotonic()
 
+    t_prev = t_total_start
     for chunk in graph.stream(inputs, config=config, stream_mode="updates"):
-        # LangGraph >=0.2 yields dicts {"node_name": output}, not tuples
-        if isinstance(chunk, tuple):
-            node_name, node_output = chunk
-        elif isinstance(chunk, dict):
-            node_name = next(iter(chunk))
-            node_output = chunk[node_name]
-        else:
-            logger.warning(f"[DEBUG] Unexpected stream chunk type: {type(chunk)}")
-            continue
-
-        # Some nodes (e.g. summarize) may return None or an empty dict
-        # when they have nothing to do.  Skip them to avoid AttributeError
-        # ("'NoneType' object has no attribute 'get'") in _extract_step_metadata.
-        if not node_output:
-            logger.info(f"🔍 Step (skipped): [{node_name}] returned empty/None output")
-            continue
-
-        step_number += 1
-        t_step_start = time.monotonic()
-
-        step_info = _extract_step_metadata(node_name, node_output)
-        step_duration = int((time.monotonic() - t_step_start) * 1000)
-
-        # The step duration here is just metadata extraction time.
-        # The actual node execution time is the gap between yields.
-        # We measure total time at the end instead.
-        steps.append(step_info)
-        _log_step(step_number, step_info, step_duration)
+        now = time.monotonic()
+        step_number = _handle_step(chunk, steps, step_number, int((now - t_prev) * 1000))
+        t_prev = now
 
     total_ms = int((time.monotonic() - t_total_start) * 1000)
 
@@ -171,3 +214,86 @@ def stream_graph_with_debug(
     _log_summary(steps, total_ms, final_state)
 
     return final_state
+
+
+async def astream_graph_with_debug(
+    graph,
+    inputs: dict,
+    config: dict,
+) -> dict:
+    """
+    Async variant of stream_graph_with_debug().
+
+    Uses graph.ainvoke()/graph.astream() so the event loop stays free while
+    the LLM calls, tools and checkpointer I/O of the turn are awaited.
+    Requires a checkpointer with async support (AsyncPostgresSaver or
+    MemorySaver).
+    """
+    if not DEBUG_GRAPH:
+        return await graph.ainvoke(inputs, config=config)
+
+    thread_id = config.get("configurable", {}).get("thread_id", "unknown")
+    logger.info(f"🐛 [DEBUG] Starting async graph stream for thread={thread_id}")
+
+    steps = []
+    step_number = 0
+    t_total_start = time.monotonic()
+
+    t_prev = t_total_start
+    async for chunk in graph.astream(inputs, config=config, stream_mode="updates"):
+        now = time.monotonic()
+        step_number = _handle_step(chunk, steps, step_number, int((now - t_prev) * 1000))
+        t_prev = now
+
+    total_ms = int((time.monotonic() - t_total_start) * 1000)
+
+    final_state_snapshot = await graph.aget_state(config)
+    final_state = (final_state_snapshot.values or {}) if final_state_snapshot else {}
+
+    _log_summary(steps, total_ms, final_state)
+
+    return final_state
+
+
+async def ainvoke_graph(graph, inputs: dict, config: dict) -> dict:
+    """
+    Run the graph from async code without blocking the event loop.
+
+    With ASYNC_GRAPH the graph is awaited natively; otherwise the sync
+    execution path is moved to a worker thread. Runs of the same thread are
+    serialized with the other checkpoint writers (see thread_locks.py), and
+    traced as part of the current turn (see tracing.py).
+    """
+    config = metrics_config(traced_config(config))
+    async with thread_lock(thread_id_of(config)):
+        if ASYNC_GRAPH:
+            return await astream_graph_with_debug(graph, inputs, config)
+        return await asyncio.to_thread(stream_graph_with_debug, graph, inputs, config)
+
+
+async def aget_graph_state(graph, config: dict):
+    """Read the thread's state snapshot from async code (see ainvoke_graph)."""
+    if ASYNC_GRAPH:
+        return await graph.aget_state(config)
+    return await asyncio.to_thread(graph.get_state, config)
+
+
+# True while aupdate_graph_state writes a checkpoint: update_state re-runs the
+# as_node's conditional edges, which must not count as routing decisions.
+_state_update: ContextVar[bool] = ContextVar("graph_state_update", default=False)
+
+
+def in_state_update() -> bool:
+    return _state_update.get()
+
+
+async def aupdate_graph_state(graph, config: dict, values: dict, as_node: str):
+    """Write values to the thread's checkpoint from async code (see ainvoke_graph)."""
+    async with thread_lock(thread_id_of(config)):
+        token = _state_update.set(True)  # asyncio.to_thread copies it to the worker
+        try:
+            if ASYNC_GRAPH:
+                return await graph.aupdate_state(config, values, as_node=as_node)
+            return await asyncio.to_thread(graph.update_state, config, values, as_node)
+        finally:
+            _state_update.reset(token)
@@ -9,12 +9,11 @@ Conversation history is kept in memory per thread_id using a simple
 list stored in a dict. For production, replace with a DB-backed store.
 """
 
-import os
 import logging
 from collections import defaultdict
 
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
+from ..llm_providers import get_chat_model
 
 logger = logging.getLogger(__name__)
 
@@ -44,11 +43,7 @@ MAX_HISTORY = 20  # keep last N messages to avoid token bloat
 
 
 # Module-level singleton — avoid re-initializing the HTTP client on every message
-_llm = ChatGoogleGenerativeAI(
-    model="gemini-3.1-flash-lite-preview",
-    google_api_key=os.getenv("GEMINI_API_KEY"),
-    temperature=0.7,
-)
+_llm = get_chat_model("gemini-3.1-flash-lite-preview", role="chat", temperature=0.7)
 
 
 async def get_response(text: str, thread_id: str) -> str:
@@ -0,0 +1,118 @@
+"""
+History Compaction — stub out RAG tool outputs once they have been answered.
+
+Each consultar_* call adds a ToolMessage with up to DEFAULT_K formatted
+parent chunks (several KB) to the thread. Once the agent has answered from
+it, that text is only re-sent as input tokens on every later LLM call.
+
+Policy: at the start of each turn, every retrieval ToolMessage followed by
+an AI answer (an AIMessage with text and no tool calls) is replaced, under
+the same message id, by a one-line stub:
+
+    [Resultado compactado] consultar_vivienda (vivienda): <digest>
+    Fragmentos: <chunk ids>. ...
+
+The retrieval tools return content_and_artifact, so the department, chunk
+ids and digest travel in ToolMessage.artifact (checkpointed, not sent to the
+model). The full text is recoverable with the recuperar_fragmentos tool
+(rag.fetch_chunks_by_ids); answering a follow-up with a fresh consultar_*
+call works as well. recuperar_fragmentos returns the same artifact, so its
+output is stubbed again once answered.
+
+Config (env):
+    TOOL_OUTPUT_COMPACTION=true
+"""
+
+import os
+import re
+import logging
+
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+
+logger = logging.getLogger(__name__)
+
+TOOL_OUTPUT_COMPACTION = os.getenv("TOOL_OUTPUT_COMPACTION", "true").lower() in ("true", "1", "yes")
+
+RETRIEVAL_TOOL_PREFIX = "consultar_"
+RECOVERY_TOOL = "recuperar_fragmentos"
+STUB_PREFIX = "[Resultado compactado]"
+DIGEST_CHARS = 160
+
+
+def _digest(chunks: list[dict]) -> str:
+    """First sentence of the best chunk, on one line."""
+    if not chunks:
+        return "sin resultados"
+    text = re.sub(r"\s+", " ", chunks[0].get("content") or "").strip()
+    sentence = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+    return sentence if len(sentence) <= DIGEST_CHARS else sentence[:DIGEST_CHARS].rstrip() + "…"
+
+
+def retrieval_artifact(chunks: list[dict], department: str) -> dict:
+    """ToolMessage.artifact of a consultar_* call: enough to stub and recover it."""
+    return {
+        "department": department,
+        "chunk_ids": [str(c.get("context_id") or c["id"]) for c in chunks],
+        "digest": _digest(chunks),
+    }
+
+
+def _stub(message: ToolMessage) -> str:
+    artifact = message.artifact or {}
+    department = artifact.get("department", "")
+    chunk_ids = artifact.get("chunk_ids") or []
+    lines = [f"{STUB_PREFIX} {message.name} ({department}): {artifact.get('digest', '')}"]
+    if chunk_ids:
+        lines.append(
+            f"Fragmentos: {', '.join(chunk_ids)}. Si necesitas el texto completo, usa "
+            f"{RECOVERY_TOOL}(department=\"{department}\", chunk_ids=[...])."
+        )
+    return "\n".join(lines)
+
+
+def _compactable(message: BaseMessage) -> bool:
+    return (
+        isinstance(message, ToolMessage)
+        and ((message.name or "").startswith(RETRIEVAL_TOOL_PREFIX) or message.name == RECOVERY_TOOL)
+        and isinstance(message.artifact, dict)
+        and not str(message.content).startswith(STUB_PREFIX)
+    )
+
+
+def _is_answer(message: BaseMessage) -> bool:
+    return isinstance(message, AIMessage) and not message.tool_calls and bool(message.content)
+
+
+def compact_answered_tool_outputs(messages: list[BaseMessage]) -> list[ToolMessage]:
+    """
+    Stub replacements (same ids) for the answered retrieval outputs.
+
+    Returned messages go through the add_messages reducer, which replaces
+    the originals in place. Empty when there is nothing to compact.
+    """
+    if not TOOL_OUTPUT_COMPACTION:
+        return []
+    replacements = []
+    answered = False
+    chars_saved = 0
+    # Walk backwards: a tool output is answered when an AI answer comes after it
+    for message in reversed(messages):
+        if _is_answer(message):
+            answered = True
+        elif answered and _compactable(message):
+            stub = _stub(message)
+            if len(stub) >= len(str(message.content)):
+                continue  # e.g. "No se encontró información relevante."
+            chars_saved += len(str(message.content)) - len(stub)
+            # Fresh response_metadata: the token counts are re-stamped by the State reducer
+            replacements.append(message.model_copy(update={"content": stub, "response_metadata": {}}))
+    if replacements:
+        logger.info(f"🗜️ [COMPACTION] Stubbed {len(replacements)} answered tool outputs (-{chars_saved} chars)")
+    return replacements
+
+
+def recovered_text(chunks: list[dict]) -> str:
+    """Text returned by recuperar_fragmentos."""
+    if not chunks:
+        return "No se encontraron los fragmentos solicitados."
+    return "\n\n---\n\n".join(f"[Fragmento {c['id']}]\n{c['content']}" for c in chunks)
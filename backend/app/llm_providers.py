@@ -0,0 +1,419 @@
+"""
+LLM Provider Registry — single place where chat and embedding models are built.
+
+Every module asks for its model here instead of constructing
+ChatGoogleGenerativeAI / GoogleGenerativeAIEmbeddings directly, so the whole
+backend can run against deterministic local stand-ins (CI, load tests,
+offline benchmarks) without cost or network.
+
+Implements:
+1. get_chat_model(model, role, **kwargs): Gemini chat model, or FakeChatModel
+   when LLM_PROVIDER=fake. The role ("agent", "summarizer", "expansion",
+   "rerank", "enrichment", "chat") picks the fake's default behaviour.
+2. get_embeddings(model): Gemini embeddings, or HashEmbeddings when
+   EMBEDDINGS_PROVIDER=fake.
+3. FakeChatModel: scripted or recorded responses, tool calls, and a
+   configurable latency distribution. Without a matching script entry it
+   behaves like a plausible agent: the primary assistant routes to the
+   department whose tool name matches the message, specialists call their
+   consultar_* tool once and then answer from the tool output.
+4. Recording: with LLM_RECORD_PATH set, real Gemini responses are appended
+   as JSONL in the script format, ready to be replayed with the fake.
+
+Configuration (environment):
+    LLM_PROVIDER           google (default) | fake
+    EMBEDDINGS_PROVIDER    google | fake (default: same as LLM_PROVIDER)
+    FAKE_LLM_SCRIPT        JSON/JSONL file with scripted responses
+    FAKE_LLM_LATENCY_MS    Latency distribution of each fake LLM call:
+                           "0" | "fixed:200" | "uniform:100,400" |
+                           "normal:250,60" | "lognormal:250,0.5" (median, sigma)
+    FAKE_EMBEDDING_LATENCY_MS  Same, for each fake embedding request
+    FAKE_EMBEDDING_DIM     Fake embedding size (default 3072, as gemini-embedding-001)
+    FAKE_LLM_SEED          Seed of the latency generator (default 42)
+    LLM_RECORD_PATH        Append real responses here (JSONL, script format)
+
+Script entries (JSON list or one object per line):
+    {"role": "agent", "match": "(?i)vivienda", "content": "",
+     "tool_calls": [{"name": "ToVivienda", "args": {"request": "..."}}]}
+    {"input": "hola", "content": "¡Hola! ¿En qué puedo ayudarte?"}
+    {"content": "respuesta en orden", "repeat": false}
+  "match" is a regex and "input" an exact (normalized) text, both tested
+  against the last human message; entries with neither are served in order
+  (consumed unless "repeat": true).
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+import unicodedata
+from typing import Any, Optional
+
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import Field, PrivateAttr
+
+logger = logging.getLogger(__name__)
+
+# Settings are read when a model is built, not at import: scripts import
+# app modules before load_dotenv(), and .env values must still apply.
+
+def llm_provider() -> str:
+    return os.getenv("LLM_PROVIDER", "google").lower()
+
+
+def embeddings_provider() -> str:
+    return os.getenv("EMBEDDINGS_PROVIDER", llm_provider()).lower()
+
+
+def _google_kwargs(kwargs: dict) -> dict:
+    """kwargs plus the API key, only when one is set (else the library reads the env itself)."""
+    # Support both GEMINI_API_KEY (project convention) and GOOGLE_API_KEY (langchain default)
+    api_key = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+    if api_key is not None:
+        kwargs.setdefault("google_api_key", api_key)
+    return kwargs
+
+
+def _normalize(text: str) -> str:
+    """Lowercase, accent-free, single-spaced (for matching, not display)."""
+    decomposed = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _text_of(message: BaseMessage) -> str:
+    content = message.content
+    if isinstance(content, list):  # Gemini-style content blocks
+        return " ".join(b.get("text", "") for b in content if isinstance(b, dict))
+    return content or ""
+
+
+# --- Latency distributions ---
+
+class LatencyModel:
+    """Samples delays (seconds) from a FAKE_*_LATENCY_MS spec."""
+
+    def __init__(self, spec: str, seed: Optional[int] = None):
+        self.spec = spec or "0"
+        self._rng = random.Random(seed if seed is not None else int(os.getenv("FAKE_LLM_SEED", "42")))
+        self._lock = threading.Lock()
+        kind, _, params = self.spec.partition(":")
+        if not params:
+            kind, params = "fixed", kind
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p.strip()]
+
+    def sample(self) -> float:
+        with self._lock:
+            if self.kind == "fixed":
+                ms = self.params[0]
+            elif self.kind == "uniform":
+                ms = self._rng.uniform(self.params[0], self.params[1])
+            elif self.kind == "normal":
+                ms = self._rng.gauss(self.params[0], self.params[1])
+            elif self.kind == "lognormal":
+                ms = self.params[0] * float(np.exp(self._rng.gauss(0.0, self.params[1])))
+            else:
+                raise ValueError(f"Unknown latency distribution: {self.spec}")
+        return max(ms, 0.0) / 1000
+
+
+# --- Scripted responses ---
+
+class ResponseScript:
+    """Thread-safe store of scripted/recorded responses."""
+
+    def __init__(self, entries: Optional[list[dict]] = None):
+        self.entries = list(entries or [])
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> "ResponseScript":
+        if not path:
+            return cls()
+        with open(path, encoding="utf-8") as f:
+            raw = f.read().strip()
+        if raw.startswith("["):
+            entries = json.loads(raw)
+        else:
+            entries = [json.loads(line) for line in raw.splitlines() if line.strip()]
+        logger.info(f"🎭 [FAKE-LLM] Loaded {len(entries)} scripted responses from {path}")
+        return cls(entries)
+
+    def next_for(self, role: str, last_human: str) -> Optional[dict]:
+        normalized = _normalize(last_human)
+        with self._lock:
+            for i, entry in enumerate(self.entries):
+                if entry.get("role") and entry["role"] != role:
+                    continue
+                if "match" in entry:
+                    if not re.search(entry["match"], last_human):
+                        continue
+                elif "input" in entry:
+                    if _normalize(entry["input"]) != normalized:
+                        continue
+                elif not entry.get("repeat", False):
+                    return self.entries.pop(i)  # Sequential entry, consumed
+                return entry
+        return None
+
+
+_shared_script: Optional[ResponseScript] = None
+
+
+def _get_shared_script() -> ResponseScript:
+    global _shared_script
+    if _shared_script is None:
+        _shared_script = ResponseScript.load(os.getenv("FAKE_LLM_SCRIPT"))
+    return _shared_script
+
+
+# --- Fake chat model ---
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic local chat model (see module docstring)."""
+
+    model: str = "fake-chat"
+    role: str = "agent"
+    latency_ms: str = Field(default_factory=lambda: os.getenv("FAKE_LLM_LATENCY_MS", "0"))
+    tools: list[dict] = Field(default_factory=list)
+
+    _latency: LatencyModel = PrivateAttr()
+    _script: ResponseScript = PrivateAttr()
+
+    def __init__(self, script: Optional[ResponseScript] = None, **kwargs):
+        super().__init__(**kwargs)
+        self._latency = LatencyModel(self.latency_ms)
+        self._script = script if script is not None else _get_shared_script()
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def bind_tools(self, tools: list, **kwargs) -> "FakeChatModel":
+        bound = FakeChatModel(
+            script=self._script,
+            model=self.model,
+            role=self.role,
+            latency_ms=self.latency_ms,
+            tools=[convert_to_openai_tool(t)["function"] for t in tools],
+        )
+        bound._latency = self._latency
+        return bound
+
+    # -- Response selection --
+
+    def _respond(self, messages: list[BaseMessage]) -> AIMessage:
+        last_human_idx = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=-1)
+        last_human = _text_of(messages[last_human_idx]) if last_human_idx >= 0 else ""
+
+        entry = self._script.next_for(self.role, last_human)
+        if entry is not None:
+            return self._message(entry.get("content", ""), entry.get("tool_calls", []))
+
+        # Hand-off confirmations (To* / CompleteOrEscalate) are not tool output to answer from
+        call_names = {
+            call["id"]: call["name"]
+            for m in messages if isinstance(m, AIMessage) for call in (m.tool_calls or [])
+        }
+        tool_outputs = [
+            m for m in messages[last_human_idx + 1:]
+            if isinstance(m, ToolMessage)
+            and not call_names.get(m.tool_call_id, "").startswith(("To", "CompleteOrEscalate"))
+        ]
+        return self._default_response(messages, last_human, tool_outputs)
+
+    def _default_response(self, messages, last_human: str, tool_outputs: list) -> AIMessage:
+        prompt = "\n".join(_text_of(m) for m in messages)
+
+        if self.role == "summarizer":
+            return self._message(
+                "- **Contexto General**: Conversación simulada.\n"
+                "- **Entidades Clave**: Ninguna.\n"
+                f"- **Última Intención Identificada**: {last_human[:120]}"
+            )
+        if self.role == "expansion":
+            query = prompt.split("Pregunta original:", 1)[-1].split("\n", 1)[0].strip()
+            keywords = [w for w in re.findall(r"\w+", _normalize(query)) if len(w) > 3]
+            return self._message(f"{' '.join(keywords)}\n{' '.join(reversed(keywords))}")
+        if self.role == "rerank":
+            count = len(re.findall(r"^\[\d+\]", prompt, flags=re.MULTILINE))
+            return self._message(",".join(str(i) for i in range(1, count + 1)))
+        if self.role == "enrichment":
+            count = len(re.findall(r"---CHUNK \d+---", prompt))
+            return self._message("\n".join(f"{i}: [Simulado > Etiqueta]" for i in range(count)))
+
+        if tool_outputs:
+            return self._message(f"Según la información disponible: {_text_of(tool_outputs[-1])[:300]}")
+
+        names = [t["name"] for t in self.tools]
+        retrieval = [n for n in names if n.startswith("consultar_")]
+        if retrieval:
+            return self._tool_call(retrieval[0], last_human)
+
+        routes = [n for n in names if n.startswith("To")]
+        words = set(re.findall(r"\w+", _normalize(last_human)))
+        for name in routes:
+            stems = [_normalize(p)[:5] for p in re.findall(r"[A-Z][a-z]+", name[2:])]
+            if any(w.startswith(stem) for stem in stems for w in words):
+                return self._tool_call(name, last_human)
+
+        return self._message(f"Respuesta simulada a: {last_human[:200]}")
+
+    def _tool_call(self, name: str, text: str) -> AIMessage:
+        schema = next(t for t in self.tools if t["name"] == name).get("parameters", {})
+        args = {}
+        for arg, spec in schema.get("properties", {}).items():
+            if spec.get("type") == "string":
+                args[arg] = text
+            elif spec.get("type") == "boolean":
+                args[arg] = True
+        return self._message("", [{"name": name, "args": args}])
+
+    def _message(self, content: str, tool_calls: Optional[list[dict]] = None) -> AIMessage:
+        return AIMessage(
+            content=content,
+            tool_calls=[
+                {"name": tc["name"], "args": tc.get("args", {}), "id": tc.get("id") or f"call_{uuid.uuid4().hex[:12]}", "type": "tool_call"}
+                for tc in (tool_calls or [])
+            ],
+        )
+
+    def _result(self, messages: list[BaseMessage], message: AIMessage) -> ChatResult:
+        input_tokens = sum(len(_text_of(m)) for m in messages) // 4
+        output_tokens = max(len(message.content) // 4, 1)
+        message.usage_metadata = {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+        message.response_metadata = {"model_name": self.model, "finish_reason": "STOP"}
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self._latency.sample())
+        return self._result(messages, self._respond(messages))
+
+    async def _agenerate(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self._latency.sample())
+        return self._result(messages, self._respond(messages))
+
+
+# --- Fake embeddings ---
+
+class HashEmbeddings:
+    """
+    Deterministic embedder: signed feature hashing of word tokens and
+    character 4-grams, L2-normalized. Lexically similar texts get similar
+    vectors, which is enough to exercise the vector channel offline.
+    """
+
+    def __init__(self, dim: Optional[int] = None, latency_ms: Optional[str] = None):
+        self.dim = dim or int(os.getenv("FAKE_EMBEDDING_DIM", "3072"))
+        self._latency = LatencyModel(latency_ms if latency_ms is not None else os.getenv("FAKE_EMBEDDING_LATENCY_MS", "0"))
+
+    def _embed(self, text: str) -> list[float]:
+        from .rag_index import tokenize
+
+        vector = np.zeros(self.dim, dtype=np.float32)
+        tokens = tokenize(text)
+        grams = [g for t in tokens for g in (t[i:i + 4] for i in range(max(len(t) - 3, 1)))]
+        for feature, weight in [(t, 1.0) for t in tokens] + [(g, 0.5) for g in grams]:
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            idx = int.from_bytes(digest[:4], "little") % self.dim
+            vector[idx] += weight if digest[4] & 1 else -weight
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_query(self, text: str, **kwargs) -> list[float]:
+        time.sleep(self._latency.sample())
+        return self._embed(text)
+
+    def embed_documents(self, texts: list[str], **kwargs) -> list[list[float]]:
+        time.sleep(self._latency.sample())
+        return [self._embed(t) for t in texts]
+
+    async def aembed_query(self, text: str, **kwargs) -> list[float]:
+        return await asyncio.to_thread(self.embed_query, text)
+
+    async def aembed_documents(self, texts: list[str], **kwargs) -> list[list[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+
+# --- Recording real responses ---
+
+class ResponseRecorder(BaseCallbackHandler):
+    """Appends every chat response to LLM_RECORD_PATH in the script format."""
+
+    def __init__(self, path: str, role: str):
+        self.path = path
+        self.role = role
+        self._inputs: dict = {}
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        humans = [m for m in messages[0] if isinstance(m, HumanMessage)] if messages else []
+        self._inputs[run_id] = _text_of(humans[-1]) if humans else ""
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        last_human = self._inputs.pop(run_id, "")
+        try:
+            message = response.generations[0][0].message
+        except (IndexError, AttributeError):
+            return
+        entry = {
+            "role": self.role,
+            "input": last_human,
+            "content": _text_of(message),
+            "tool_calls": [{"name": tc["name"], "args": tc["args"]} for tc in getattr(message, "tool_calls", [])],
+        }
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.warning(f"🎭 [LLM-RECORD] Could not write {self.path}: {e}")
+
+
+# --- Registry ---
+
+def cache_namespace(model: str, embeddings: bool = False) -> str:
+    """
+    Model key for persistent caches: fake outputs must never be stored under
+    (or served from) the real model's entries.
+    """
+    provider = embeddings_provider() if embeddings else llm_provider()
+    return model if provider == "google" else f"{provider}:{model}"
+
+
+def get_chat_model(model: str, role: str = "agent", **kwargs: Any) -> BaseChatModel:
+    """Chat model for `role` from the configured provider."""
+    if llm_provider() == "fake":
+        return FakeChatModel(model=model, role=role)
+
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    record_path = os.getenv("LLM_RECORD_PATH")
+    if record_path:
+        kwargs.setdefault("callbacks", []).append(ResponseRecorder(record_path, role))
+    return ChatGoogleGenerativeAI(model=model, **_google_kwargs(kwargs))
+
+
+def get_embeddings(model: str, **kwargs: Any):
+    """Embedding model from the configured provider."""
+    if embeddings_provider() == "fake":
+        return HashEmbeddings()
+
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    return GoogleGenerativeAIEmbeddings(model=model, **_google_kwargs(kwargs))
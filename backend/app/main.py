@@ -8,11 +8,16 @@ load_dotenv()
 from typing import Optional, List, Dict, Any
 from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, Response
 from pydantic import BaseModel
 from langchain_core.messages import HumanMessage, AIMessage
 
-from .agent import graph
+from .agent import graph, summarize_in_background
+from .debug import ASYNC_GRAPH, ainvoke_graph, aget_graph_state
+from .smalltalk import answer_smalltalk
+from .db_pools import async_pool, close_pools, open_pools, sync_pool
+from .metrics import observe_turn, record_reply, record_turn, record_webhook, register_stats
+from .tracing import exporter, set_attributes, trace_turn
 
 app = FastAPI(title="Corvus Chatbot API")
 
@@ -52,30 +57,56 @@ async def startup_event():
     except Exception as e:
         logger.warning(f"⚠️ Could not create DB tables (non-fatal): {e}")
 
+    # AsyncConnectionPool must be opened inside the running event loop
+    if ASYNC_GRAPH and pool is not None:
+        await open_pools()
+        logger.info("✅ Async checkpointer pool opened")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_pools()
+    # Flush the spans still queued for the JSONL / OTLP sinks
+    exporter.shutdown()
+
 
 # ── Checkpointer (PostgreSQL → MemorySaver fallback) ────────────────
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 checkpointer = None
+pool = None
 
 if DATABASE_URL:
     try:
-        from psycopg_pool import ConnectionPool
-        from langgraph.checkpoint.postgres import PostgresSaver
-
-        pool = ConnectionPool(
-            conninfo=DATABASE_URL,
-            max_size=10,
-            min_size=1,
-            max_lifetime=3600,
-            reconnect_timeout=30,
-            check=ConnectionPool.check_connection,
-        )
-        checkpointer = PostgresSaver(pool)
-        logger.info("✅ PostgresSaver inicializado correctamente con Cloud SQL")
+        # Hot threads' latest checkpoint served from memory (see app/checkpoint_cache.py)
+        from .checkpoint_cache import cached_checkpointer
+        # Reads zstd-compressed blobs and writes; compresses new ones only with
+        # CHECKPOINT_COMPRESSION=true (one-way, see app/checkpoint_serde.py)
+        from .checkpoint_serde import checkpoint_serde
+
+        # Pools shared with the rest of the process, sized from DB_CONNECTION_BUDGET (see app/db_pools.py)
+        if ASYNC_GRAPH:
+            from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+
+            # Opened in startup_event (needs a running loop)
+            pool = async_pool()
+            checkpointer = cached_checkpointer(AsyncPostgresSaver(pool, serde=checkpoint_serde()))
+            logger.info("✅ AsyncPostgresSaver inicializado correctamente con Cloud SQL")
+        else:
+            from langgraph.checkpoint.postgres import PostgresSaver
+
+            # Same pool as the RAG queries
+            pool = sync_pool()
+            checkpointer = cached_checkpointer(PostgresSaver(pool, serde=checkpoint_serde()))
+            logger.info("✅ PostgresSaver inicializado correctamente con Cloud SQL")
     except Exception as e:
         logger.error(f"❌ Error al conectar PostgresSaver: {e}")
         checkpointer = None
+        pool = None
+
+# Cross-instance thread locks on the checkpointer pool (THREAD_LOCK_MODE=advisory)
+from .thread_locks import ThreadBusyError, configure_thread_locks
+configure_thread_locks(pool)
 
 if checkpointer is None:
     from langgraph.checkpoint.memory import MemorySaver
@@ -159,6 +190,8 @@ async def _get_chat_result(task_id: str) -> Optional[Dict]:
 class ChatRequest(BaseModel):
     message: str
     thread_id: Optional[str] = None
+    phone: Optional[str] = None  # /chat/fake_whatsapp only
+    name: Optional[str] = None   # /chat/fake_whatsapp only
 
 class ChatResponse(BaseModel):
     messages: Optional[List[Dict[str, Any]]] = None
@@ -167,31 +200,38 @@ class ChatResponse(BaseModel):
     status: Optional[str] = None  # "pending" | "completed" | "failed"
 
 
-def _run_graph(thread_id: str, message: str) -> List[Dict[str, Any]]:
-    """Run LangGraph synchronously and return response messages."""
-    from .debug import stream_graph_with_debug
-
-    config = {"configurable": {"thread_id": thread_id}}
-    inputs = {"messages": [HumanMessage(content=message)], "context": {}}
-
-    current_state = graph_with_memory.get_state(config)
-    if current_state and current_state.values:
-        dialog_state = current_state.values.get("dialog_state", [])
-        msg_count = len(current_state.values.get("messages", []))
-        logger.info(f"📊 Current state: dialog_stack={dialog_state}, messages={msg_count}")
-    else:
-        logger.info("📊 No prior state for this thread (new conversation)")
+@trace_turn("chat.turn")
+async def _run_graph(thread_id: str, message: str) -> List[Dict[str, Any]]:
+    """Run LangGraph without blocking the event loop and return response messages."""
+    set_attributes(thread_id=thread_id)
+    with observe_turn("Cootradecun", "web"):
+        config = {"configurable": {"thread_id": thread_id}}
+        inputs = {"messages": [HumanMessage(content=message)]}
+
+        smalltalk_reply = await answer_smalltalk(graph_with_memory, config, message, tenant="Cootradecun")
+        if smalltalk_reply is not None:
+            return [{"role": "assistant", "content": smalltalk_reply.text}]
+
+        # Served by the checkpoint cache for threads active on this instance
+        current_state = await aget_graph_state(graph_with_memory, config)
+        if current_state and current_state.values:
+            dialog_state = current_state.values.get("dialog_state", [])
+            msg_count = len(current_state.values.get("messages", []))
+            logger.info(f"📊 Current state: dialog_stack={dialog_state}, messages={msg_count}")
+        else:
+            logger.info("📊 No prior state for this thread (new conversation)")
 
-    final_state = stream_graph_with_debug(graph_with_memory, inputs, config)
-    messages = final_state.get("messages", [])
-    last_message = messages[-1] if messages else None
+        final_state = await ainvoke_graph(graph_with_memory, inputs, config)
+        summarize_in_background(graph_with_memory, config)
+        messages = final_state.get("messages", [])
+        last_message = messages[-1] if messages else None
 
-    if isinstance(last_message, AIMessage):
-        content = last_message.content
-        if isinstance(content, list):
-            content = content[0].get("text", "") if content else ""
-        return [{"role": "assistant", "content": content or "No pude generar una respuesta."}]
-    return [{"role": "assistant", "content": "Lo siento, hubo un error procesando tu solicitud."}]
+        if isinstance(last_message, AIMessage):
+            content = last_message.content
+            if isinstance(content, list):
+                content = content[0].get("text", "") if content else ""
+            return [{"role": "assistant", "content": content or "No pude generar una respuesta."}]
+        return [{"role": "assistant", "content": "Lo siento, hubo un error procesando tu solicitud."}]
 
 
 @app.post("/chat", response_model=ChatResponse)
@@ -209,9 +249,9 @@ async def chat_endpoint(request: ChatRequest):
         enqueue_chat(task_id, request.message, thread_id)
         return ChatResponse(task_id=task_id, thread_id=thread_id, status="pending")
 
-    # Dev path: process synchronously
+    # Dev path: process inline (the graph itself never blocks the event loop)
     try:
-        response_messages = _run_graph(thread_id, request.message)
+        response_messages = await _run_graph(thread_id, request.message)
         return ChatResponse(messages=response_messages, thread_id=thread_id, status="completed")
     except Exception as e:
         import traceback
@@ -219,6 +259,7 @@ async def chat_endpoint(request: ChatRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/chat/fake_whatsapp", response_model=ChatResponse)
+@trace_turn("chat.fake_whatsapp")
 async def chat_endpoint_fake_whatsapp(request: ChatRequest):
     """
     Simulates a WhatsApp conversation and writes all metadata to the v4.0 DB schema.
@@ -228,55 +269,36 @@ async def chat_endpoint_fake_whatsapp(request: ChatRequest):
     fallback_count, primary_intent, tokens, estimated_cost_usd.
     """
     import time as _time
-    from .db_writer import (
-        upsert_contact,
-        upsert_session,
-        save_conversation,
-        update_session_stats,
-        increment_contact_messages,
-    )
+    from .db_writer import persist_turn
+    from .whatsapp import COST_PER_OUTPUT_TOKEN_USD, _is_fallback
 
     phone = request.phone or "573000000001"
     name  = request.name  or "Usuario Test"
 
-    thread_id = request.thread_id or str(uuid.uuid4())
-    config    = {"configurable": {"thread_id": thread_id}}
-    inputs    = {"messages": [HumanMessage(content=request.message)], "context": {}}
+    thread_id   = request.thread_id or str(uuid.uuid4())
+    session_key = f"fake-{phone}"
+    config      = {"configurable": {"thread_id": thread_id}}
+    inputs      = {"messages": [HumanMessage(content=request.message)]}
+    user_messages = [{"text": request.message}]
 
     logger.info(f"📥 [fake_wa] thread={thread_id} phone={phone} msg='{request.message[:50]}'")
 
-    # ── 1. Ensure contact exists ──────────────────────────────────────────────
-    contact_id = await upsert_contact(phone, name)
-
-    # ── 2. Get or create session (24 h window) ────────────────────────────────
-    session_id = None
-    if contact_id:
-        session_key = f"fake-{phone}"
-        session_id  = await upsert_session(contact_id, session_key)
-
-    # ── 3. Save the USER message ──────────────────────────────────────────────
-    if session_id:
-        await save_conversation(
-            session_id,
-            "user",
-            request.message,
-            user_phone=phone,
-            user_name=name,
-        )
-
-    # ── 4. Invoke agent (measure latency) ────────────────────────────────────
-    from .debug import stream_graph_with_debug
-
+    # ── 1. Invoke agent (measure latency) ────────────────────────────────────
     t0 = _time.perf_counter()
     try:
-        final_state = stream_graph_with_debug(graph_with_memory, inputs, config)
+        final_state = await ainvoke_graph(graph_with_memory, inputs, config)
+        summarize_in_background(graph_with_memory, config)
     except Exception as e:
         import traceback
         logger.error(f"❌ [fake_wa] agent error: {e}\n{traceback.format_exc()}")
+        record_turn("Cootradecun", "fake_whatsapp", _time.perf_counter() - t0, outcome="error")
+        # Keep the user message even though there is no reply
+        await persist_turn(phone, name, session_key, user_messages)
         raise HTTPException(status_code=500, detail=str(e))
     response_ms = int((_time.perf_counter() - t0) * 1000)
+    record_turn("Cootradecun", "fake_whatsapp", response_ms / 1000)
 
-    # ── 5. Extract bot response ───────────────────────────────────────────────
+    # ── 2. Extract bot response ───────────────────────────────────────────────
     messages_out = final_state.get("messages", [])
     last_message = messages_out[-1] if messages_out else None
 
@@ -290,49 +312,32 @@ async def chat_endpoint_fake_whatsapp(request: ChatRequest):
 
     response_messages = [{"role": "assistant", "content": bot_text}]
 
-    # ── 6. Classify the turn ─────────────────────────────────────────────────
-    is_fallback     = _detect_fallback(bot_text)
+    # ── 3. Classify the turn ─────────────────────────────────────────────────
+    is_fallback     = _is_fallback(bot_text)
+    record_reply("Cootradecun", is_fallback)
     dialog_state    = final_state.get("dialog_state", [])
-    detected_intent = _extract_intent(dialog_state)
+    detected_intent = dialog_state[-1] if dialog_state else None
 
     # Token usage from the in‑memory accumulator keyed by thread_id
     from .agent import _token_totals_by_thread
     token_totals    = _token_totals_by_thread.get(thread_id, {})
     tokens_in_turn  = token_totals.get("prompt_tokens", 0)
     tokens_out_turn = token_totals.get("completion_tokens", 0)
-    cost_delta      = tokens_out_turn * _COST_PER_OUTPUT_TOKEN_USD
-
-    # ── 7. Save the ASSISTANT response ────────────────────────────────────────
-    if session_id:
-        await save_conversation(
-            session_id,
-            "assistant",
-            bot_text,
-            user_phone=phone,
-            user_name=name,
-            detected_intent=detected_intent,
-            is_fallback=is_fallback,
-            response_time_ms=response_ms,
-            tokens_in=tokens_in_turn,
-            tokens_out=tokens_out_turn,
-        )
-
-        # ── 8. Update session counters ────────────────────────────────────────
-        await update_session_stats(
-            session_id,
-            user_messages_delta=1,
-            bot_messages_delta=1,
-            fallback_delta=1 if is_fallback else 0,
-            primary_intent=detected_intent,
-            tokens_input_delta=tokens_in_turn,
-            tokens_output_delta=tokens_out_turn,
-            estimated_cost_delta=cost_delta,
-        )
-
-    # ── 9. Update contact message counter ────────────────────────────────────
-    if contact_id:
-        # 2 messages per turn: 1 user + 1 bot
-        await increment_contact_messages(phone, count=2)
+    cost_delta      = tokens_out_turn * COST_PER_OUTPUT_TOKEN_USD
+
+    # ── 4. Persist contact, session, both messages and counters (one round trip)
+    session_id = await persist_turn(
+        phone, name, session_key,
+        user_messages,
+        bot_text,
+        detected_intent=detected_intent,
+        primary_intent=detected_intent,
+        is_fallback=is_fallback,
+        response_time_ms=response_ms,
+        tokens_in=tokens_in_turn,
+        tokens_out=tokens_out_turn,
+        estimated_cost=cost_delta,
+    )
 
     logger.info(
         f"✅ [fake_wa] thread={thread_id} session={session_id} "
@@ -377,9 +382,13 @@ async def internal_process_chat(body: ProcessChatRequest, request: Request):
 
     logger.info(f"⚙️ Processing chat task: task_id={body.task_id} thread_id={body.thread_id}")
     try:
-        response_messages = _run_graph(body.thread_id, body.message)
+        response_messages = await _run_graph(body.thread_id, body.message)
         await _store_chat_result(body.task_id, body.thread_id, "completed", response_messages)
         logger.info(f"✅ Chat task completed: task_id={body.task_id}")
+    except ThreadBusyError as e:
+        # Thread running on another instance: Cloud Tasks retries the task later
+        logger.info(f"🔒 Chat task deferred: task_id={body.task_id} ({e})")
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"❌ Chat task failed: task_id={body.task_id} error={e}")
         await _store_chat_result(body.task_id, body.thread_id, "failed",
@@ -430,6 +439,7 @@ async def whatsapp_webhook_receive(request: Request, background_tasks: Backgroun
 
     if parsed:
         tenant = get_tenant(parsed["phone_number_id"])
+        record_webhook(tenant.name if tenant else None, "accepted" if tenant else "unknown_tenant")
         if tenant:
             is_production = os.getenv("ENVIRONMENT", "development") == "production"
 
@@ -452,6 +462,9 @@ async def whatsapp_webhook_receive(request: Request, background_tasks: Backgroun
             logger.warning(
                 f"⚠️ No tenant found for phone_number_id={parsed['phone_number_id']!r} — message ignored."
             )
+    else:
+        # Status updates (sent/delivered/read) and unsupported message types
+        record_webhook(None, "ignored")
 
     return {"status": "ok"}
 
@@ -507,7 +520,9 @@ async def internal_process_message(
 async def whatsapp_status():
     """List all registered tenants and their configuration status."""
     from .tenants import registered_tenants
+    from .whatsapp import whatsapp_inbox
     return {
+        "inbox": whatsapp_inbox.stats(),
         "tenants": [
             {
                 "name": t.name,
@@ -517,3 +532,96 @@ async def whatsapp_status():
             for t in registered_tenants()
         ]
     }
+
+
+@app.get("/router/stats")
+async def router_stats():
+    """Pre-router confidence and routing-hit metrics (see app/prerouter.py)."""
+    from .prerouter import prerouter
+    return prerouter.stats()
+
+
+@app.get("/prompt_cache/stats")
+async def prompt_cache_stats():
+    """Context caches and cached-token share per agent (see app/prompt_cache.py)."""
+    from . import prompt_cache
+    return prompt_cache.stats()
+
+
+@app.get("/locks/stats")
+async def locks_stats():
+    """Thread lock contention metrics (see app/thread_locks.py)."""
+    from .thread_locks import thread_lock_stats
+    return thread_lock_stats()
+
+
+@app.get("/checkpoint_cache/stats")
+async def checkpoint_cache_stats():
+    """Hit rate and size of the latest-checkpoint cache (see app/checkpoint_cache.py)."""
+    from .checkpoint_cache import CachedCheckpointSaver
+    if isinstance(checkpointer, CachedCheckpointSaver):
+        return checkpointer.stats()
+    return {"enabled": False}
+
+
+@app.get("/tracing/stats")
+async def tracing_endpoint_stats():
+    """Sampling and exporter queue of the turn traces (see app/tracing.py)."""
+    from .tracing import tracing_stats
+    return tracing_stats()
+
+
+@app.get("/db/pools/stats")
+async def db_pools_stats():
+    """Connection budget split and pool utilization / acquire waits (see app/db_pools.py)."""
+    from .db_pools import db_pool_stats
+    return db_pool_stats()
+
+
+# ── Metrics ──────────────────────────────────────────────────────────
+
+def _checkpoint_cache_stats() -> dict:
+    from .checkpoint_cache import CachedCheckpointSaver
+    return checkpointer.stats() if isinstance(checkpointer, CachedCheckpointSaver) else {}
+
+
+def _prerouter_stats() -> dict:
+    from .prerouter import prerouter
+    return prerouter.stats()
+
+
+def _prompt_cache_stats() -> dict:
+    from . import prompt_cache
+    return prompt_cache.stats()
+
+
+def _inbox_stats() -> dict:
+    from .whatsapp import whatsapp_inbox
+    return whatsapp_inbox.stats()
+
+
+def _locks_stats() -> dict:
+    from .thread_locks import thread_lock_stats
+    return thread_lock_stats()
+
+
+def _tracing_stats() -> dict:
+    from .tracing import tracing_stats
+    return tracing_stats()
+
+
+# The /…/stats endpoints above, as chatbot_component_stat gauges
+register_stats("router", _prerouter_stats)
+register_stats("prompt_cache", _prompt_cache_stats)
+register_stats("inbox", _inbox_stats)
+register_stats("locks", _locks_stats)
+register_stats("checkpoint_cache", _checkpoint_cache_stats)
+register_stats("tracing", _tracing_stats)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus exposition: turn/LLM/RAG latency, tokens, ingress, pools (see app/metrics.py)."""
+    from .metrics import render
+    body, content_type = render()
+    return Response(content=body, media_type=content_type)
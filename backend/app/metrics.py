@@ -0,0 +1,272 @@
+"""
+Metrics — Prometheus histograms, counters and pool gauges (GET /metrics).
+
+Latency and token data used to live only in log lines; Cloud Run
+concurrency and the Cloud SQL tier are sized from these series instead:
+
+1. Turns: chatbot_turn_seconds{tenant,channel,outcome} (observe_turn /
+   record_turn) and chatbot_replies_total{tenant,fallback} (record_reply);
+   the fallback rate is replies with fallback="true" over all replies.
+2. LLM: metrics_config(config) adds a LangChain callback handler to the
+   graph run (debug.ainvoke_graph), which records
+   chatbot_llm_seconds{agent,outcome} and chatbot_llm_tokens_total{agent,type}
+   per chat model call. The agent is the graph node the call ran in
+   (primary_assistant, vivienda, vivienda_tools for the query expansion...).
+3. RAG: chatbot_rag_stage_seconds{stage,department} from rag_timing.stage;
+   the department comes from rag_timing.rag_department.
+4. Ingress: chatbot_webhook_messages_total{tenant,result} and
+   chatbot_cloud_tasks_enqueue_total{task,result}.
+5. Pools, read at scrape time: chatbot_db_pool_{size,idle,in_use,max,
+   waiting,utilization}{pool} and the acquire counters
+   chatbot_db_pool_acquires_total / _acquire_wait_seconds_total /
+   _acquire_timeouts_total for every pool registered with register_pool
+   (see db_pools.py). psycopg, asyncpg and SQLAlchemy pools are read
+   through their own stats APIs.
+6. Component stats: the numeric fields of the /…/stats endpoints registered
+   with register_stats, as chatbot_component_stat{component,stat}.
+
+Metrics are per process (one uvicorn worker per Cloud Run instance);
+Prometheus aggregates across instances.
+
+Config (env):
+    METRICS_ENABLED=true
+"""
+
+import os
+import time
+import logging
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("true", "1", "yes")
+
+TURN_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30)
+RAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+turn_seconds = Histogram(
+    "chatbot_turn_seconds", "Turn latency, message in to reply ready",
+    ["tenant", "channel", "outcome"], buckets=TURN_BUCKETS,
+)
+replies_total = Counter("chatbot_replies_total", "Bot replies", ["tenant", "fallback"])
+llm_seconds = Histogram(
+    "chatbot_llm_seconds", "Chat model call latency per agent",
+    ["agent", "outcome"], buckets=LLM_BUCKETS,
+)
+llm_tokens_total = Counter(
+    "chatbot_llm_tokens_total", "Chat model tokens per agent (type: input, output, cached)",
+    ["agent", "type"],
+)
+rag_stage_seconds = Histogram(
+    "chatbot_rag_stage_seconds", "RAG pipeline stage latency per department",
+    ["stage", "department"], buckets=RAG_BUCKETS,
+)
+webhook_messages_total = Counter(
+    "chatbot_webhook_messages_total", "WhatsApp webhook deliveries",
+    ["tenant", "result"],
+)
+cloud_tasks_enqueue_total = Counter(
+    "chatbot_cloud_tasks_enqueue_total", "Cloud Tasks enqueue attempts",
+    ["task", "result"],
+)
+
+
+# --- Turns, replies, ingress ---
+
+def record_turn(tenant: str, channel: str, seconds: float, outcome: str = "ok") -> None:
+    if METRICS_ENABLED:
+        turn_seconds.labels(tenant, channel, outcome).observe(seconds)
+
+
+@contextmanager
+def observe_turn(tenant: str, channel: str) -> Iterator[None]:
+    """Record the block as one turn (outcome="error" when it raises)."""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        record_turn(tenant, channel, time.perf_counter() - started, outcome)
+
+
+def record_reply(tenant: str, is_fallback: bool) -> None:
+    if METRICS_ENABLED:
+        replies_total.labels(tenant, "true" if is_fallback else "false").inc()
+
+
+def record_webhook(tenant: Optional[str], result: str) -> None:
+    if METRICS_ENABLED:
+        webhook_messages_total.labels(tenant or "", result).inc()
+
+
+def record_enqueue(task: str, ok: bool) -> None:
+    if METRICS_ENABLED:
+        cloud_tasks_enqueue_total.labels(task, "ok" if ok else "error").inc()
+
+
+def record_rag_stage(stage: str, department: Optional[str], seconds: float) -> None:
+    if METRICS_ENABLED:
+        rag_stage_seconds.labels(stage, department or "").observe(seconds)
+
+
+# --- LLM calls (LangChain callbacks) ---
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Latency and tokens of every chat model call, labelled by graph node."""
+
+    run_inline = True  # No executor hop per event
+
+    def __init__(self):
+        # run_id -> (agent, start); run ids are unique, so one shared handler is enough
+        self._started: dict = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs) -> None:
+        self._started[run_id] = ((metadata or {}).get("langgraph_node") or "other", time.perf_counter())
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs) -> None:
+        self._started[run_id] = ((metadata or {}).get("langgraph_node") or "other", time.perf_counter())
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        started = self._started.pop(run_id, None)
+        if started is None:
+            return
+        agent, t0 = started
+        llm_seconds.labels(agent, "ok").observe(time.perf_counter() - t0)
+        try:
+            usage = getattr(response.generations[0][0].message, "usage_metadata", None) or {}
+        except (AttributeError, IndexError):
+            return
+        cached = (usage.get("input_token_details") or {}).get("cache_read")
+        for type_, value in (("input", usage.get("input_tokens")), ("output", usage.get("output_tokens")), ("cached", cached)):
+            if value:
+                llm_tokens_total.labels(agent, type_).inc(value)
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            llm_seconds.labels(started[0], "error").observe(time.perf_counter() - started[1])
+
+
+metrics_handler = MetricsCallbackHandler()
+
+
+def metrics_config(config: dict) -> dict:
+    """config with the metrics callback handler added (see tracing.traced_config)."""
+    if not METRICS_ENABLED:
+        return config
+    callbacks = config.get("callbacks")
+    if callbacks is not None and not isinstance(callbacks, list):
+        return config  # A CallbackManager set by the caller: leave it alone
+    return {**config, "callbacks": [*(callbacks or []), metrics_handler]}
+
+
+# --- Pools and component stats (read at scrape time) ---
+
+_pools: dict[str, Callable[[], Any]] = {}
+_stats: dict[str, Callable[[], dict]] = {}
+
+
+def register_pool(name: str, get_pool: Callable[[], Any]) -> None:
+    """get_pool returns the (lazily created) pool, or None while there is none."""
+    _pools[name] = get_pool
+
+
+def register_stats(component: str, get_stats: Callable[[], dict]) -> None:
+    _stats[component] = get_stats
+
+
+def pool_stats(pool) -> Optional[dict]:
+    """
+    size / idle / in_use / max / waiting / utilization of a psycopg, asyncpg
+    or SQLAlchemy pool, plus cumulative acquire requests / wait_seconds /
+    timeouts where the pool measures them (psycopg; asyncpg through
+    db_pools.TimedAsyncpgPool).
+    """
+    if hasattr(pool, "get_stats"):  # psycopg_pool (sync and async)
+        s = pool.get_stats()
+        size, idle = s.get("pool_size", 0), s.get("pool_available", 0)
+        stats = {
+            "size": size, "idle": idle, "in_use": size - idle, "max": s.get("pool_max", pool.max_size),
+            "waiting": s.get("requests_waiting", 0), "requests": s.get("requests_num", 0),
+            "wait_seconds": s.get("requests_wait_ms", 0) / 1000, "timeouts": s.get("requests_errors", 0),
+        }
+    elif hasattr(pool, "get_idle_size"):  # asyncpg
+        size, idle = pool.get_size(), pool.get_idle_size()
+        stats = {"size": size, "idle": idle, "in_use": size - idle, "max": pool.get_max_size()}
+        if hasattr(pool, "acquire_stats"):
+            stats.update(pool.acquire_stats())
+    elif hasattr(pool, "checkedout"):  # SQLAlchemy QueuePool
+        in_use, idle = pool.checkedout(), pool.checkedin()
+        stats = {"size": in_use + idle, "idle": idle, "in_use": in_use, "max": pool.size() + max(pool._max_overflow, 0)}
+    else:
+        return None
+    stats["utilization"] = round(stats["in_use"] / stats["max"], 3) if stats["max"] else 0.0
+    return stats
+
+
+POOL_GAUGES = ("size", "idle", "in_use", "max", "waiting", "utilization")
+# Cumulative since the pool was created
+POOL_COUNTERS = {
+    "requests": "chatbot_db_pool_acquires",
+    "wait_seconds": "chatbot_db_pool_acquire_wait_seconds",
+    "timeouts": "chatbot_db_pool_acquire_timeouts",
+}
+
+
+def _flatten(prefix: str, value, out: dict) -> None:
+    if isinstance(value, bool):
+        out[prefix] = int(value)
+    elif isinstance(value, (int, float)):
+        out[prefix] = value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(f"{prefix}.{key}" if prefix else str(key), item, out)
+
+
+class _ScrapeCollector:
+    def collect(self):
+        pool_families = {
+            field: GaugeMetricFamily(f"chatbot_db_pool_{field}", f"Connection pool {field.replace('_', ' ')}", labels=["pool"])
+            for field in POOL_GAUGES
+        }
+        pool_families.update({
+            field: CounterMetricFamily(name, f"Connection pool acquire {field.replace('_', ' ')}", labels=["pool"])
+            for field, name in POOL_COUNTERS.items()
+        })
+        for name, get_pool in _pools.items():
+            try:
+                pool = get_pool()
+                stats = pool_stats(pool) if pool is not None else None
+            except Exception as e:
+                logger.warning(f"📈 [METRICS] Could not read pool {name}: {e}")
+                continue
+            for field, value in (stats or {}).items():
+                pool_families[field].add_metric([name], value)
+        yield from pool_families.values()
+
+        component = GaugeMetricFamily("chatbot_component_stat", "Numeric fields of the /…/stats endpoints", labels=["component", "stat"])
+        for name, get_stats in _stats.items():
+            values: dict = {}
+            try:
+                _flatten("", get_stats(), values)
+            except Exception as e:
+                logger.warning(f"📈 [METRICS] Could not read {name} stats: {e}")
+                continue
+            for stat, value in values.items():
+                component.add_metric([name, stat], value)
+        yield component
+
+
+REGISTRY.register(_ScrapeCollector())
+
+
+def render() -> tuple[bytes, str]:
+    """Exposition body and content type for GET /metrics."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
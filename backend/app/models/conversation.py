@@ -45,6 +45,8 @@ class Conversation(Base):
     response_time_ms: Mapped[int | None] = mapped_column(Integer, nullable=True)
     tokens_input: Mapped[int | None] = mapped_column(Integer, default=0)
     tokens_output: Mapped[int | None] = mapped_column(Integer, default=0)
+    # Trace of the turn that wrote the row (app/tracing.py)
+    trace_id: Mapped[str | None] = mapped_column(String(32), nullable=True, index=True)
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now(), index=True,
     )
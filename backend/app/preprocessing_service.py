@@ -196,12 +196,12 @@ def enrich_chunks_with_context(
       Before: "Desprendible de pago, Doc. de identidad..."
       After:  "[Crédito > Requisitos > Documentación] Desprendible de pago..."
     """
-    from langchain_google_genai import ChatGoogleGenerativeAI
+    from .llm_providers import get_chat_model
 
     if not chunks:
         return chunks
 
-    llm = ChatGoogleGenerativeAI(model=model_name, temperature=0)
+    llm = get_chat_model(model_name, role="enrichment", temperature=0)
 
     # Process in batches to reduce API calls
     BATCH_SIZE = 10
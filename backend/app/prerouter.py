@@ -0,0 +1,432 @@
+"""
+Zero-LLM Pre-Router — routes obvious turns to a department without calling
+the primary assistant.
+
+Every turn used to go START → summarize → primary_assistant, a full Gemini
+call with eight bound transfer tools, even for "precio Pedregal". The
+pre-router runs first and, when it is confident, the graph jumps straight to
+enter_<dept>:
+
+1. Keyword rules: accent-folded regexes per department (PREROUTER_RULES
+   below, overridable with PREROUTER_RULES_PATH). A single matching
+   department is decisive only with two or more distinct rule hits; one hit
+   stays below the threshold unless the centroid agrees, and several
+   matching departments are ambiguous.
+2. Nearest centroid: the user message is embedded with the RAG query
+   embeddings and compared to one centroid per department built from
+     - the indexed corpus (mean of the department's child chunk embeddings)
+     - logged intents (user messages whose turn ended in that department)
+   Confidence grows with the cosine margin between the two best departments.
+3. Fallback: below PREROUTER_THRESHOLD the turn goes to primary_assistant as
+   before. Its choice is recorded against the pre-router's best guess
+   (shadow agreement) to tune the threshold; at most MAX_PENDING_GUESSES
+   guesses wait for their LLM route.
+
+Routing is off by default: with PREROUTER_SHADOW the pre-router classifies
+every turn but only records its guess, and the primary assistant routes as
+before. Enable PREROUTER_ENABLED once the shadow agreement of the confident
+guesses (stats()["shadow"]["confident_agreement"]) is good enough.
+
+Stats (stats()): decisions by source, fallbacks, confidence histogram,
+shadow agreement with the LLM and escalations (CompleteOrEscalate right
+after a pre-routed hand-off, i.e. misroutes).
+
+Config (env):
+    PREROUTER_ENABLED=false           (true = confident turns skip primary_assistant)
+    PREROUTER_SHADOW=true             (classify and record only, while routing is off)
+    PREROUTER_THRESHOLD=0.8
+    PREROUTER_CENTROIDS=true          (false = keyword rules only)
+    PREROUTER_CENTROID_MARGIN=0.04    (cosine margin that counts as confidence 1.0)
+    PREROUTER_MIN_SIMILARITY=0.55
+    PREROUTER_INTENT_SAMPLES=50       (logged messages per department)
+    PREROUTER_REFRESH_SECONDS=3600
+    PREROUTER_RULES_PATH=             (JSON {department: [regex, ...]})
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import numpy as np
+
+from . import rag
+from .rag_index import fold, parse_vector
+
+logger = logging.getLogger(__name__)
+
+PREROUTER_ENABLED = os.getenv("PREROUTER_ENABLED", "false").lower() in ("true", "1", "yes")
+PREROUTER_SHADOW = os.getenv("PREROUTER_SHADOW", "true").lower() in ("true", "1", "yes")
+PREROUTER_THRESHOLD = float(os.getenv("PREROUTER_THRESHOLD", "0.8"))
+PREROUTER_CENTROIDS = os.getenv("PREROUTER_CENTROIDS", "true").lower() in ("true", "1", "yes")
+PREROUTER_CENTROID_MARGIN = float(os.getenv("PREROUTER_CENTROID_MARGIN", "0.04"))
+PREROUTER_MIN_SIMILARITY = float(os.getenv("PREROUTER_MIN_SIMILARITY", "0.55"))
+PREROUTER_INTENT_SAMPLES = int(os.getenv("PREROUTER_INTENT_SAMPLES", "50"))
+PREROUTER_REFRESH_SECONDS = int(os.getenv("PREROUTER_REFRESH_SECONDS", "3600"))
+PREROUTER_RULES_PATH = os.getenv("PREROUTER_RULES_PATH", "")
+
+KEYWORD_CONFIDENCE = 0.85      # A single department matched by two or more distinct rules
+KEYWORD_HIT_CONFIDENCE = 0.6   # A single rule hit: below the threshold without the centroid
+CENTROID_WEIGHT = 0.9          # Centroid-only decisions never reach 1.0
+MAX_PENDING_GUESSES = 1024     # Oldest guesses are dropped (turns that never reach the LLM router)
+
+# Patterns run on accent-folded lowercase text (see rag_index.fold).
+# Keep them specific: generic words ("credito", "pago", "retencion") appear in
+# several departments and are better left to the centroid or the LLM.
+PREROUTER_RULES = {
+    "vivienda": [
+        r"\bvivienda", r"\bpedregal\b", r"\brancho grande\b", r"\barr?ayanes\b", r"\bpenalisa\b",
+        r"\blotes?\b", r"\bapartamentos?\b", r"\bcasa propia\b", r"\bmelgar\b", r"\bricaurte\b",
+    ],
+    "nominas": [
+        r"\bdesprendibles?\b", r"\bnomina", r"\blibranzas?\b", r"\bporcentaje de aporte",
+    ],
+    "atencion_asociado": [
+        r"\basociar(me|se)?\b", r"\bafiliar(me|se)?\b", r"\bauxilios?\b", r"\bretir(o|arme)\b.*\bcooperativa\b",
+    ],
+    "convenios": [
+        r"\bconvenios? con\b", r"\bempresas? aliadas?\b", r"\bfisioterapia\b", r"\bgimnasios?\b",
+        r"\bpaquetes? turistic", r"\bexequia",
+    ],
+    "cartera": [
+        r"\bdeudas?\b", r"\bestado de cuenta\b", r"\bacuerdos? de pago\b", r"\ben mora\b", r"\bamparos?\b",
+        r"\bsaldos?\b",
+    ],
+    "contabilidad": [
+        r"\bproveedor(es)?\b", r"\bfacturas?\b", r"\brut\b", r"\bcuentas? de cobro\b",
+    ],
+    "tesoreria": [
+        r"\bpse\b", r"\bcorresponsal(es)?\b", r"\befecty\b", r"\bmedios? de pago\b", r"\bgiro empresarial\b",
+        r"\bdebito automatico\b", r"\bdesembolso", r"\bnumero de convenio\b",
+    ],
+    "credito": [
+        r"\bprestamos?\b", r"\blibre inversion\b", r"\bsimula(r|dor|cion)\b",
+        r"\bcompra de cartera\b",
+    ],
+}
+
+
+# --- Corpus / intent SQL ---
+CORPUS_CENTROIDS_SQL = """
+SELECT d.title, AVG(c.embedding)::text
+FROM rag_chunk c
+JOIN rag_document d ON c.document_id = d.id
+WHERE d.status = 'indexed'
+  AND (c.is_parent = FALSE OR c.is_parent IS NULL)
+GROUP BY d.title
+"""
+
+# User message of each turn whose assistant reply was tagged with a department
+INTENT_SAMPLES_SQL = """
+SELECT intent, message FROM (
+    SELECT a.detected_intent AS intent, u.message,
+           ROW_NUMBER() OVER (PARTITION BY a.detected_intent ORDER BY a.created_at DESC) AS rn
+    FROM conversations a
+    JOIN conversations u
+      ON u.session_id = a.session_id AND u.position = a.position - 1 AND u.role = 'user'
+    WHERE a.role = 'assistant'
+      AND a.detected_intent = ANY(%(departments)s)
+      AND a.is_fallback = FALSE
+) t
+WHERE rn <= %(limit)s
+"""
+
+
+@dataclass
+class RouteDecision:
+    department: Optional[str]
+    confidence: float
+    source: str                    # keywords | centroid | keywords+centroid | none
+    keyword_matches: tuple = ()
+
+    @property
+    def confident(self) -> bool:
+        return self.department is not None and self.confidence >= PREROUTER_THRESHOLD
+
+
+def _load_rules() -> dict[str, list[str]]:
+    if not PREROUTER_RULES_PATH:
+        return PREROUTER_RULES
+    try:
+        with open(PREROUTER_RULES_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"🧭 [PREROUTER] Could not read {PREROUTER_RULES_PATH}, using built-in rules: {e}")
+        return PREROUTER_RULES
+
+
+class PreRouter:
+    """
+    Keyword + nearest-centroid department classifier.
+
+    embed_query(text) must return a vector in the same space as the corpus
+    embeddings; fetch_centroids() returns {department: [vector, ...]} (one or
+    more centroids per department). Centroids are built in a background
+    thread; until they are ready (or when they cannot be built) only the
+    keyword rules are used.
+    """
+
+    def __init__(
+        self,
+        departments: list[str],
+        embed_query: Optional[Callable[[str], list[float]]] = None,
+        fetch_centroids: Optional[Callable[[], dict[str, list[np.ndarray]]]] = None,
+        rules: Optional[dict[str, list[str]]] = None,
+        refresh_seconds: int = PREROUTER_REFRESH_SECONDS,
+    ):
+        self.departments = list(departments)
+        self._embed_query = embed_query
+        self._fetch_centroids = fetch_centroids
+        self._rules = {
+            dept: [re.compile(p) for p in patterns]
+            for dept, patterns in (rules or _load_rules()).items()
+            if dept in self.departments
+        }
+        self._refresh_seconds = refresh_seconds
+        self._centroid_labels: list[str] = []
+        self._centroid_matrix: Optional[np.ndarray] = None
+        self._built_at = 0.0
+        self._building = False
+        self._lock = threading.Lock()
+
+        self._decisions = Counter()
+        self._routed = Counter()
+        self._fallbacks = 0
+        self._confidence_buckets = Counter()
+        self._shadow = Counter()
+        self._escalations = Counter()
+        self._pending_guess: "OrderedDict[str, tuple[Optional[str], bool]]" = OrderedDict()
+
+    # -- Centroids --
+
+    def set_centroids(self, centroids: dict[str, list[np.ndarray]]) -> None:
+        labels, rows = [], []
+        for dept, vectors in centroids.items():
+            if dept not in self.departments:
+                continue
+            for vector in vectors:
+                norm = np.linalg.norm(vector)
+                if norm > 0:
+                    labels.append(dept)
+                    rows.append(np.asarray(vector, dtype=np.float32) / norm)
+        with self._lock:
+            self._centroid_labels = labels
+            self._centroid_matrix = np.stack(rows) if rows else None
+            self._built_at = time.time()
+        logger.info(f"🧭 [PREROUTER] {len(rows)} centroids for {len(set(labels))} departments")
+
+    def _build(self) -> None:
+        try:
+            self.set_centroids(self._fetch_centroids())
+        except Exception as e:
+            logger.warning(f"🧭 [PREROUTER] Could not build centroids, keyword rules only: {e}")
+            with self._lock:
+                self._built_at = time.time()
+        finally:
+            self._building = False
+
+    def _ensure_centroids(self) -> None:
+        if not PREROUTER_CENTROIDS or self._fetch_centroids is None:
+            return
+        with self._lock:
+            if self._building or time.time() - self._built_at < self._refresh_seconds:
+                return
+            self._building = True
+        threading.Thread(target=self._build, name="prerouter-centroids", daemon=True).start()
+
+    # -- Classification --
+
+    def _keyword_hits(self, folded: str) -> dict[str, int]:
+        """{department: number of distinct rules matched} for the departments with a match."""
+        hits = {dept: sum(1 for p in patterns if p.search(folded)) for dept, patterns in self._rules.items()}
+        return {dept: n for dept, n in hits.items() if n}
+
+    def _centroid_scores(self, text: str) -> Optional[tuple[str, float]]:
+        """(best department, confidence) from the centroid margin, or None."""
+        with self._lock:
+            matrix, labels = self._centroid_matrix, self._centroid_labels
+        if matrix is None or self._embed_query is None:
+            return None
+        query = np.asarray(self._embed_query(text), dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return None
+        sims = matrix @ (query / norm)
+        best: dict[str, float] = {}
+        for label, sim in zip(labels, sims.tolist()):
+            best[label] = max(best.get(label, -1.0), sim)
+        ranked = sorted(best.items(), key=lambda kv: kv[1], reverse=True)
+        top_dept, top_sim = ranked[0]
+        second_sim = ranked[1][1] if len(ranked) > 1 else -1.0
+        if top_sim < PREROUTER_MIN_SIMILARITY:
+            return top_dept, 0.0
+        return top_dept, min(1.0, (top_sim - second_sim) / PREROUTER_CENTROID_MARGIN)
+
+    def classify(self, text: str) -> RouteDecision:
+        folded = fold(text or "").strip()
+        if not folded:
+            return RouteDecision(None, 0.0, "none")
+        hits = self._keyword_hits(folded)
+        matches = list(hits)
+        if len(matches) == 1 and hits[matches[0]] >= 2:
+            # Two distinct rules of a single department are decisive: skip the embedding call
+            return RouteDecision(matches[0], KEYWORD_CONFIDENCE, "keywords", tuple(matches))
+
+        self._ensure_centroids()
+        try:
+            centroid = self._centroid_scores(text)
+        except Exception as e:
+            logger.warning(f"🧭 [PREROUTER] Centroid scoring failed: {e}")
+            centroid = None
+        if centroid is None:
+            if len(matches) == 1:
+                return RouteDecision(matches[0], KEYWORD_HIT_CONFIDENCE, "keywords", tuple(matches))
+            return RouteDecision(matches[0] if matches else None, 0.0, "none", tuple(matches))
+
+        dept, confidence = centroid
+        if matches and dept not in matches:
+            # Several keyword departments and the centroid picks none of them
+            return RouteDecision(dept, 0.0, "none", tuple(matches))
+        if matches:
+            # The centroid confirms a single rule hit, or breaks the tie between keyword departments
+            prior = (KEYWORD_CONFIDENCE if hits[dept] >= 2 else KEYWORD_HIT_CONFIDENCE) / len(matches)
+            confidence = 1 - (1 - prior) * (1 - confidence)
+            return RouteDecision(dept, confidence, "keywords+centroid", tuple(matches))
+        return RouteDecision(dept, confidence * CENTROID_WEIGHT, "centroid")
+
+    # -- Stats --
+
+    def record_decision(self, thread_id: str, decision: RouteDecision) -> None:
+        """Count a decision; unless it was routed, keep it as a guess for record_llm_route."""
+        routed = PREROUTER_ENABLED and decision.confident
+        bucket = min(int(decision.confidence * 10), 9) / 10
+        with self._lock:
+            self._confidence_buckets[f"{bucket:.1f}"] += 1
+            if routed:
+                self._decisions[decision.source] += 1
+                self._routed[decision.department] += 1
+                self._pending_guess.pop(thread_id, None)
+            else:
+                if decision.confident:
+                    self._shadow["would_route"] += 1
+                else:
+                    self._fallbacks += 1
+                self._pending_guess[thread_id] = (decision.department, decision.confident)
+                self._pending_guess.move_to_end(thread_id)
+                while len(self._pending_guess) > MAX_PENDING_GUESSES:
+                    self._pending_guess.popitem(last=False)
+        if routed:
+            logger.info(
+                f"🧭 [PREROUTER] → {decision.department} (confidence={decision.confidence:.2f}, "
+                f"source={decision.source})"
+            )
+        elif decision.confident:
+            logger.info(
+                f"🧭 [PREROUTER] shadow guess {decision.department} (confidence={decision.confidence:.2f}, "
+                f"source={decision.source}), routing left to the LLM"
+            )
+        else:
+            logger.info(
+                f"🧭 [PREROUTER] fallback to LLM (best={decision.department}, "
+                f"confidence={decision.confidence:.2f})"
+            )
+
+    def record_llm_route(self, thread_id: str, department: Optional[str]) -> None:
+        """Compare the primary assistant's choice with the pre-router's guess."""
+        with self._lock:
+            if thread_id not in self._pending_guess:
+                return
+            guess, confident = self._pending_guess.pop(thread_id)
+            if department is None:
+                outcome = "llm_answered"
+            elif guess == department:
+                outcome = "agree"
+            else:
+                outcome = "disagree"
+            self._shadow[outcome] += 1
+            if confident:
+                self._shadow[f"confident_{outcome}"] += 1
+
+    def record_escalation(self, department: str) -> None:
+        with self._lock:
+            self._escalations[department] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            routed = sum(self._routed.values())
+            total = routed + self._fallbacks + self._shadow["would_route"]
+            escalations = sum(self._escalations.values())
+            compared = self._shadow["agree"] + self._shadow["disagree"]
+            confident_compared = self._shadow["confident_agree"] + self._shadow["confident_disagree"]
+            return {
+                "enabled": PREROUTER_ENABLED,
+                "shadow_only": not PREROUTER_ENABLED and PREROUTER_SHADOW,
+                "threshold": PREROUTER_THRESHOLD,
+                "centroids": len(self._centroid_labels),
+                "turns": total,
+                "routed": routed,
+                "fallbacks": self._fallbacks,
+                "routing_rate": round(routed / total, 4) if total else 0.0,
+                "routing_hit_rate": round(1 - escalations / routed, 4) if routed else 0.0,
+                "by_source": dict(self._decisions),
+                "by_department": dict(self._routed),
+                "escalations": dict(self._escalations),
+                "confidence_histogram": dict(sorted(self._confidence_buckets.items())),
+                "shadow": {
+                    **self._shadow,
+                    "agreement": round(self._shadow["agree"] / compared, 4) if compared else 0.0,
+                    "confident_agreement": (
+                        round(self._shadow["confident_agree"] / confident_compared, 4) if confident_compared else 0.0
+                    ),
+                },
+            }
+
+
+# --- Wiring to the RAG corpus ---
+
+def _fetch_centroids() -> dict[str, list[np.ndarray]]:
+    """One corpus centroid and one logged-intent centroid per department."""
+    centroids: dict[str, list[np.ndarray]] = {}
+    if rag.memory_index is not None:
+        for dept in rag.DEPT_TO_TITLE:
+            index = rag.memory_index.get(dept)
+            if index is not None and len(index.ids):
+                centroids.setdefault(dept, []).append(np.asarray(index.matrix).mean(axis=0))
+    if not centroids:
+        title_to_dept = {title: dept for dept, title in rag.DEPT_TO_TITLE.items()}
+        with rag._get_pool().connection() as conn:
+            for title, vector in conn.execute(CORPUS_CENTROIDS_SQL).fetchall():
+                if title in title_to_dept and vector:
+                    centroids.setdefault(title_to_dept[title], []).append(parse_vector(vector))
+
+    if PREROUTER_INTENT_SAMPLES > 0:
+        try:
+            with rag._get_pool().connection() as conn:
+                rows = conn.execute(
+                    INTENT_SAMPLES_SQL,
+                    {"departments": list(rag.DEPT_TO_TITLE), "limit": PREROUTER_INTENT_SAMPLES},
+                ).fetchall()
+        except Exception as e:
+            logger.warning(f"🧭 [PREROUTER] Could not read logged intents: {e}")
+            rows = []
+        by_dept: dict[str, list[str]] = {}
+        for intent, message in rows:
+            if message:
+                by_dept.setdefault(intent, []).append(message)
+        for dept, messages in by_dept.items():
+            vectors = np.asarray(rag.query_embeddings.embed_queries(messages), dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            centroids.setdefault(dept, []).append(vectors.mean(axis=0))
+    return centroids
+
+
+prerouter = PreRouter(
+    list(rag.DEPT_TO_TITLE),
+    embed_query=lambda text: rag.query_embeddings.embed_query(text),
+    fetch_centroids=_fetch_centroids,
+)
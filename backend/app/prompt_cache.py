@@ -0,0 +1,290 @@
+"""
+Prompt Caching — cache-stable agent prompts and Gemini context caching.
+
+Every agent prompt is a long static instruction block plus the tool schemas
+bound to the model. The only volatile value is the current date, which goes
+at the very END of the system instruction and changes once a day
+(prompt_date), so the request prefix — instructions, tools and the thread's
+history — is byte-identical across the turns of a day:
+
+1. implicit (default): the stable prefix lets Gemini's implicit prefix
+   caching discount repeated input tokens; no extra API calls.
+2. explicit: the system instruction + tool schemas of each agent are stored
+   as a CachedContent (one per agent, model and day) and requests send only
+   the conversation with cached_content=<name>. The TTL is extended when
+   less than PROMPT_CACHE_REFRESH_SECONDS remain. If a cache cannot be
+   created (e.g. the prefix is below the model's minimum cacheable size) or
+   a cached call fails, the agent falls back to the plain request.
+3. off: plain requests (same prompts).
+
+The cached-token share per agent (usage_metadata.input_token_details
+.cache_read / input_tokens) is tracked by prompt_cache_usage and exposed
+at GET /prompt_cache/stats.
+
+Config (env):
+    PROMPT_CACHE_MODE=implicit          (implicit | explicit | off)
+    PROMPT_CACHE_TTL_SECONDS=3600
+    PROMPT_CACHE_REFRESH_SECONDS=300
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+logger = logging.getLogger(__name__)
+
+PROMPT_CACHE_MODE = os.getenv("PROMPT_CACHE_MODE", "implicit").lower()
+PROMPT_CACHE_TTL_SECONDS = int(os.getenv("PROMPT_CACHE_TTL_SECONDS", "3600"))
+PROMPT_CACHE_REFRESH_SECONDS = int(os.getenv("PROMPT_CACHE_REFRESH_SECONDS", "300"))
+
+
+def prompt_date() -> str:
+    """Volatile prompt value at day granularity: the prefix changes once a day."""
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+# --- Explicit context caches ---
+
+def _genai_tools(tools: list) -> list:
+    """
+    bind_tools' OpenAI-style schemas as google-genai Tools.
+
+    Uses the public FunctionDeclaration.parameters_json_schema, which takes
+    the JSON schema as is, instead of langchain_google_genai's private
+    converter (its module and signature change between releases).
+    """
+    from google.genai import types
+
+    declarations = []
+    for tool in tools:
+        function = tool.get("function", tool)
+        declarations.append(types.FunctionDeclaration(
+            name=function["name"],
+            description=function.get("description", ""),
+            parameters_json_schema=function.get("parameters"),
+        ))
+    return [types.Tool(function_declarations=declarations)]
+
+
+@dataclass
+class _CacheEntry:
+    name: str
+    expires_at: float
+
+
+class ContextCacheManager:
+    """CachedContent names keyed by (model, system instruction, tools)."""
+
+    def __init__(self, ttl_seconds: int = PROMPT_CACHE_TTL_SECONDS, refresh_seconds: int = PROMPT_CACHE_REFRESH_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.refresh_seconds = refresh_seconds
+        self._entries: dict[str, _CacheEntry] = {}
+        self._retry_after: dict[str, float] = {}
+        self._in_flight: set[str] = set()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.refreshed = 0
+        self.failures = 0
+
+    @staticmethod
+    def key(model: str, system_text: str, tools: list) -> str:
+        payload = json.dumps([model, system_text, tools], sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def fresh(self, key: str) -> Optional[str]:
+        """Cache name when it exists and does not need a TTL refresh (no I/O)."""
+        entry = self._entries.get(key)
+        if entry and entry.expires_at - time.time() > self.refresh_seconds:
+            return entry.name
+        return None
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def ensure(self, llm, agent: str, key: str, system_text: str, tools: list) -> Optional[str]:
+        """
+        Create or refresh the cache for this prefix; None when unavailable.
+
+        The API call runs outside the lock (only the bookkeeping is locked), so
+        a slow create never blocks the other agents' fresh lookups. While a
+        prefix is being created, concurrent callers use plain requests.
+        """
+        from google.genai import types
+
+        with self._lock:
+            now = time.time()
+            # Drop expired entries (e.g. yesterday's prefixes)
+            for stale in [k for k, e in self._entries.items() if e.expires_at <= now]:
+                del self._entries[stale]
+
+            entry = self._entries.get(key)
+            if entry and (entry.expires_at - now > self.refresh_seconds or key in self._in_flight):
+                return entry.name
+            if not entry and (key in self._in_flight or self._retry_after.get(key, 0) > now):
+                return None
+            self._in_flight.add(key)
+
+        try:
+            if entry:
+                try:
+                    llm.client.caches.update(
+                        name=entry.name,
+                        config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"),
+                    )
+                except Exception as e:
+                    logger.warning(f"💾 [PROMPT-CACHE] TTL refresh failed for {agent}: {e}")
+                    return entry.name
+                with self._lock:
+                    entry.expires_at = now + self.ttl_seconds
+                    self.refreshed += 1
+                return entry.name
+
+            try:
+                cache = llm.client.caches.create(
+                    model=llm.model,
+                    config=types.CreateCachedContentConfig(
+                        display_name=f"{agent}-{key[:12]}",
+                        system_instruction=system_text,
+                        tools=_genai_tools(tools) if tools else None,
+                        ttl=f"{self.ttl_seconds}s",
+                    ),
+                )
+            except Exception as e:
+                with self._lock:
+                    # Not retried before the TTL: usually a prefix below the minimum cacheable size
+                    self._retry_after[key] = now + self.ttl_seconds
+                    self.failures += 1
+                logger.warning(f"💾 [PROMPT-CACHE] Could not create cache for {agent}, using plain requests: {e}")
+                return None
+            with self._lock:
+                self._entries[key] = _CacheEntry(cache.name, now + self.ttl_seconds)
+                self.created += 1
+            logger.info(f"💾 [PROMPT-CACHE] Created {cache.name} for {agent} (ttl={self.ttl_seconds}s)")
+            return cache.name
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self._entries),
+            "created": self.created,
+            "refreshed": self.refreshed,
+            "failures": self.failures,
+        }
+
+
+context_caches = ContextCacheManager()
+
+
+# --- Cached-token share per agent ---
+
+class PromptCacheUsage:
+    def __init__(self):
+        self._totals = defaultdict(lambda: {"calls": 0, "input_tokens": 0, "cached_tokens": 0})
+        self._lock = threading.Lock()
+
+    def record(self, agent: str, message) -> None:
+        usage = getattr(message, "usage_metadata", None) or {}
+        input_tokens = usage.get("input_tokens") or 0
+        if not input_tokens:
+            return
+        cached = (usage.get("input_token_details") or {}).get("cache_read") or 0
+        with self._lock:
+            totals = self._totals[agent]
+            totals["calls"] += 1
+            totals["input_tokens"] += input_tokens
+            totals["cached_tokens"] += cached
+        logger.info(
+            f"💾 [PROMPT-CACHE] agent={agent}: cached={cached}/{input_tokens} input tokens "
+            f"({cached / input_tokens:.0%})"
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                agent: {**totals, "cached_share": round(totals["cached_tokens"] / totals["input_tokens"], 4)}
+                for agent, totals in self._totals.items()
+            }
+
+
+prompt_cache_usage = PromptCacheUsage()
+
+
+def stats() -> dict:
+    return {"mode": PROMPT_CACHE_MODE, "caches": context_caches.stats(), "agents": prompt_cache_usage.stats()}
+
+
+# --- Agent runnables ---
+
+def _supports_explicit_cache(llm) -> bool:
+    return getattr(getattr(llm, "client", None), "caches", None) is not None
+
+
+def _split_system(messages: list[BaseMessage]) -> tuple[str, list[BaseMessage]]:
+    if messages and isinstance(messages[0], SystemMessage) and isinstance(messages[0].content, str):
+        return messages[0].content, messages[1:]
+    return "", messages
+
+
+def cached_agent_runnable(agent: str, prompt: ChatPromptTemplate, llm, tools: list) -> Runnable:
+    """
+    Equivalent of `prompt | llm.bind_tools(tools)`.
+
+    With PROMPT_CACHE_MODE=explicit and a Gemini model, the system instruction
+    and tool schemas are served from a CachedContent and only the
+    conversation is sent.
+    """
+    bound = llm.bind_tools(tools)
+    if PROMPT_CACHE_MODE != "explicit" or not _supports_explicit_cache(llm):
+        return prompt | bound
+    tool_schemas = bound.kwargs.get("tools", [])
+
+    def _prepare(prompt_value) -> tuple[list[BaseMessage], str, list[BaseMessage], str]:
+        messages = prompt_value.to_messages()
+        system_text, conversation = _split_system(messages)
+        if any(isinstance(m, SystemMessage) for m in conversation):
+            # Extra system messages (e.g. the running summary) would be merged into
+            # system_instruction, which cannot be sent with cached content
+            system_text = ""
+        return messages, system_text, conversation, ContextCacheManager.key(llm.model, system_text, tool_schemas)
+
+    def invoke(prompt_value, config: RunnableConfig):
+        messages, system_text, conversation, key = _prepare(prompt_value)
+        name = system_text and context_caches.ensure(llm, agent, key, system_text, tool_schemas)
+        if name:
+            try:
+                return llm.invoke(conversation, config, cached_content=name)
+            except Exception as e:
+                logger.warning(f"💾 [PROMPT-CACHE] Cached call failed for {agent}, retrying uncached: {e}")
+                context_caches.invalidate(key)
+        return bound.invoke(messages, config)
+
+    async def ainvoke(prompt_value, config: RunnableConfig):
+        messages, system_text, conversation, key = _prepare(prompt_value)
+        name = system_text and (
+            context_caches.fresh(key)
+            or await asyncio.to_thread(context_caches.ensure, llm, agent, key, system_text, tool_schemas)
+        )
+        if name:
+            try:
+                return await llm.ainvoke(conversation, config, cached_content=name)
+            except Exception as e:
+                logger.warning(f"💾 [PROMPT-CACHE] Cached call failed for {agent}, retrying uncached: {e}")
+                context_caches.invalidate(key)
+        return await bound.ainvoke(messages, config)
+
+    return prompt | RunnableLambda(invoke, afunc=ainvoke, name=f"{agent}_cached_llm")
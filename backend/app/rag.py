@@ -5,30 +5,51 @@ Implements:
 1. Hybrid Search: cosine similarity (vector) + full-text search (BM25/tsvector)
    fused via Reciprocal Rank Fusion (RRF)
 2. Parent Chunk Expansion: retrieves child chunks for precision, returns
-   parent chunks for richer LLM context (Small-to-Big Retrieval)
-3. Re-Ranking: uses Gemini to re-order chunks by actual relevance
-4. Connection Pooling: lazy ConnectionPool instead of per-query connections
+   parent chunks for richer LLM context (Small-to-Big Retrieval). Parents
+   are fetched in one batch and children sharing a parent are collapsed
+3. Re-Ranking: pluggable reranker (RERANKER=feature|gemini|none) with a
+   latency budget and fallback to RRF order, see reranker.py
+4. Connection Pooling: the process-wide sync pool (db_pools.sync_pool)
+   instead of per-query connections
 5. Contextual Output: includes source, page, and similarity in returned text
+6. Query-Embedding Cache: LRU+TTL (+ optional PostgreSQL tier) in front of
+   embed_query, see rag_cache.py
+7. Semantic Cache: reuses the final chunks of a recent, similar query in the
+   same department (invalidated when the department is re-indexed)
+8. Multi-query search: all query-expansion variants are embedded in one
+   batched call and searched in one SQL round trip, with per-variant RRF
+   summed server-side (HYBRID_SEARCH_MANY_SQL)
+9. Backend switch: RAG_BACKEND=pgvector (default) runs HYBRID_SEARCH_SQL,
+   RAG_BACKEND=memory runs the same fusion in-process (see rag_index.py),
+   falling back to pgvector for a department whose index is not loaded
+10. Lookup by id: fetch_chunks_by_ids re-reads chunks whose tool output was
+    compacted out of the thread history (see history_compaction.py)
 """
 
 import os
 import logging
-from typing import Optional
 
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
-from psycopg_pool import ConnectionPool
+from .rag_cache import (
+    EmbeddingCache,
+    PostgresEmbeddingStore,
+    SemanticCache,
+    EMBEDDING_CACHE_PERSIST,
+    EMBEDDING_CACHE_TTL_SECONDS,
+    SEMANTIC_CACHE_ENABLED,
+)
+from .rag_index import DepartmentIndex, MemoryIndex
+from .reranker import create_reranker
+from .rag_timing import rag_department, stage
+from .llm_providers import cache_namespace, get_embeddings
+from .db_pools import sync_pool
 
 logger = logging.getLogger(__name__)
 
 # --- Configuration ---
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-# Support both GEMINI_API_KEY (project convention) and GOOGLE_API_KEY (langchain default)
-_GOOGLE_API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
-embeddings = GoogleGenerativeAIEmbeddings(
-    model="models/gemini-embedding-001",
-    google_api_key=_GOOGLE_API_KEY,
-)
+EMBEDDING_MODEL = "models/gemini-embedding-001"
+embeddings = get_embeddings(EMBEDDING_MODEL)  # See llm_providers.py (EMBEDDINGS_PROVIDER)
 
 # Retrieval parameters
 DEFAULT_K = 4              # Final number of chunks returned to LLM
@@ -36,8 +57,11 @@ HYBRID_K_VECTOR = 8        # Candidates from vector search
 HYBRID_K_FTS = 8           # Candidates from full-text search
 MIN_SIMILARITY = 0.25      # Minimum cosine similarity threshold
 RERANK_CANDIDATES = 8      # Chunks sent to re-ranker
-ENABLE_RERANK = False      # Toggle re-ranking (disable for lower latency)
+# "feature" (local CPU) | "gemini" | "none". Off until fitted feature weights are committed.
+RERANKER = os.getenv("RERANKER", "none").lower()
+ENABLE_RERANK = RERANKER != "none"  # Toggle re-ranking
 ENABLE_PARENT_EXPANSION = True  # Toggle parent chunk expansion
+RAG_BACKEND = os.getenv("RAG_BACKEND", "pgvector").lower()  # "pgvector" | "memory"
 
 # Department → document title mapping
 DEPT_TO_TITLE = {
@@ -51,24 +75,54 @@ DEPT_TO_TITLE = {
     "credito": "Crédito",
 }
 
-# --- Connection Pool (lazy) ---
-_pool: Optional[ConnectionPool] = None
+reranker = create_reranker(RERANKER)
 
+# --- Connection Pool (shared, sized from the connection budget) ---
+def _get_pool():
+    """The process-wide sync psycopg pool (see db_pools.py)."""
+    if not DATABASE_URL:
+        raise RuntimeError("RAG: DATABASE_URL not configured")
+    return sync_pool()
 
-def _get_pool() -> ConnectionPool:
-    """Lazy-initialize a connection pool for pgvector queries."""
-    global _pool
-    if _pool is None:
-        if not DATABASE_URL:
-            raise RuntimeError("RAG: DATABASE_URL not configured")
-        _pool = ConnectionPool(
-            conninfo=DATABASE_URL,
-            min_size=1,
-            max_size=5,
-            max_lifetime=3600,
-            reconnect_timeout=30,
-        )
-    return _pool
+
+# --- Query-Embedding Cache ---
+query_embeddings = EmbeddingCache(
+    embeddings,
+    model_name=cache_namespace(EMBEDDING_MODEL, embeddings=True),
+    store=(
+        PostgresEmbeddingStore(_get_pool, ttl_seconds=EMBEDDING_CACHE_TTL_SECONDS)
+        if DATABASE_URL and EMBEDDING_CACHE_PERSIST else None
+    ),
+)
+
+
+# --- Corpus fingerprint (detects re-indexed documents) ---
+CORPUS_VERSIONS_SQL = """
+SELECT title, string_agg(id::text || ':' || COALESCE(total_chunks, 0)::text, ',' ORDER BY id)
+FROM rag_document
+WHERE status = 'indexed'
+GROUP BY title
+"""
+
+
+def _fetch_corpus_versions() -> dict[str, str]:
+    """
+    Return {department: fingerprint} for the indexed corpus.
+
+    script_index.py deletes and re-inserts a document under a new id when it
+    re-indexes it, so any re-index changes the department's fingerprint.
+    """
+    title_to_dept = {title: dept for dept, title in DEPT_TO_TITLE.items()}
+    with _get_pool().connection() as conn:
+        rows = conn.execute(CORPUS_VERSIONS_SQL).fetchall()
+    return {title_to_dept.get(title, title): version for title, version in rows}
+
+
+# --- Semantic Cache ---
+semantic_cache = SemanticCache(_fetch_corpus_versions) if SEMANTIC_CACHE_ENABLED else None
+
+# --- In-process index (RAG_BACKEND=memory) ---
+memory_index = MemoryIndex(_get_pool, _fetch_corpus_versions, DEPT_TO_TITLE) if RAG_BACKEND == "memory" else None
 
 
 # --- Hybrid Search SQL ---
@@ -118,38 +172,202 @@ ORDER BY rrf_score DESC
 LIMIT %(k)s
 """
 
-# --- Parent Chunk Lookup SQL ---
-PARENT_CHUNK_SQL = """
-SELECT content FROM rag_chunk WHERE id = %s AND is_parent = TRUE
+# --- Multi-Query Hybrid Search SQL ---
+# One round trip for all query variants: each variant runs the same
+# vector/FTS top-k as HYBRID_SEARCH_SQL (LATERAL, so the HNSW and GIN
+# indexes are still used), its RRF is computed per variant, and a chunk's
+# final score is the sum over variants. Parent content comes back in the
+# same query.
+HYBRID_SEARCH_MANY_SQL = """
+WITH queries AS (
+    SELECT q.ord, q.vec_txt::vector AS vec, q.query_text
+    FROM unnest(%(query_vectors)s::text[], %(query_texts)s::text[])
+         WITH ORDINALITY AS q(vec_txt, query_text, ord)
+),
+vector_results AS (
+    SELECT q.ord, v.id, v.vec_score, v.vec_rank
+    FROM queries q
+    CROSS JOIN LATERAL (
+        SELECT c.id,
+               1 - (c.embedding <=> q.vec) AS vec_score,
+               ROW_NUMBER() OVER (ORDER BY c.embedding <=> q.vec) AS vec_rank
+        FROM rag_chunk c
+        JOIN rag_document d ON c.document_id = d.id
+        WHERE d.title = %(title)s AND d.status = 'indexed'
+          AND (c.is_parent = FALSE OR c.is_parent IS NULL)
+        ORDER BY c.embedding <=> q.vec
+        LIMIT %(k_vector)s
+    ) v
+),
+fts_results AS (
+    SELECT q.ord, f.id, f.fts_score, f.fts_rank
+    FROM queries q
+    CROSS JOIN LATERAL (
+        SELECT c.id,
+               ts_rank(c.content_tsvector, plainto_tsquery('spanish', q.query_text)) AS fts_score,
+               ROW_NUMBER() OVER (
+                   ORDER BY ts_rank(c.content_tsvector, plainto_tsquery('spanish', q.query_text)) DESC
+               ) AS fts_rank
+        FROM rag_chunk c
+        JOIN rag_document d ON c.document_id = d.id
+        WHERE d.title = %(title)s AND d.status = 'indexed'
+          AND c.content_tsvector @@ plainto_tsquery('spanish', q.query_text)
+          AND (c.is_parent = FALSE OR c.is_parent IS NULL)
+        ORDER BY fts_score DESC
+        LIMIT %(k_fts)s
+    ) f
+),
+per_variant AS (
+    SELECT
+        COALESCE(v.id, f.id) AS id,
+        COALESCE(v.vec_score, 0) AS vec_score,
+        COALESCE(f.fts_score, 0) AS fts_score,
+        COALESCE(1.0 / (60 + v.vec_rank), 0) + COALESCE(1.0 / (60 + f.fts_rank), 0) AS rrf_score
+    FROM vector_results v
+    FULL OUTER JOIN fts_results f
+        ON v.ord = f.ord AND v.id = f.id
+),
+fused AS (
+    SELECT id,
+           MAX(vec_score) AS vec_score,
+           MAX(fts_score) AS fts_score,
+           SUM(rrf_score) AS rrf_score
+    FROM per_variant
+    WHERE vec_score >= %(min_similarity)s OR fts_score > 0
+    GROUP BY id
+)
+SELECT c.id, c.content, c.parent_chunk_id, c.page_number,
+       f.vec_score, f.fts_score, f.rrf_score, p.content AS parent_content
+FROM fused f
+JOIN rag_chunk c ON c.id = f.id
+LEFT JOIN rag_chunk p ON p.id = c.parent_chunk_id AND p.is_parent = TRUE
+ORDER BY f.rrf_score DESC
+LIMIT %(k)s
+"""
+
+# --- Parent Chunk Lookup SQL (one batch per search) ---
+PARENT_CHUNKS_SQL = """
+SELECT id, content FROM rag_chunk WHERE id = ANY(%s) AND is_parent = TRUE
+"""
+
+# --- Chunk Lookup by Id (compacted tool outputs) ---
+CHUNKS_BY_ID_SQL = """
+SELECT c.id::text, c.content, c.page_number
+FROM rag_chunk c
+JOIN rag_document d ON c.document_id = d.id
+WHERE c.id = ANY(%s::uuid[]) AND d.title = %s AND d.status = 'indexed'
 """
 
 
+def _collapse_by_parent(chunks: list[dict]) -> list[dict]:
+    """
+    Keep one chunk per parent (the best-ranked child; input is in RRF order).
+
+    Sibling children would otherwise expand to the same parent text and send
+    it to the LLM several times. The surviving chunk keeps the best scores of
+    its siblings and lists their ids in child_ids.
+    """
+    collapsed = {}
+    for chunk in chunks:
+        key = chunk["context_id"]
+        kept = collapsed.get(key)
+        if kept is None:
+            chunk["child_ids"] = [chunk["id"]]
+            collapsed[key] = chunk
+            continue
+        kept["child_ids"].append(chunk["id"])
+        kept["vec_score"] = max(kept["vec_score"], chunk["vec_score"])
+        kept["fts_score"] = max(kept["fts_score"], chunk["fts_score"])
+    return list(collapsed.values())
+
+
+def _apply_parents(chunks: list[dict], parents: dict) -> list[dict]:
+    """Replace child content with its parent's content, then collapse siblings."""
+    for chunk in chunks:
+        parent_content = parents.get(chunk["parent_chunk_id"])
+        if parent_content:
+            chunk["content"] = parent_content  # Use parent's richer content
+            chunk["context_id"] = chunk["parent_chunk_id"]
+    return _collapse_by_parent(chunks)
+
+
+def _expand_parents(conn, chunks: list[dict]) -> list[dict]:
+    """Fetch all parents of the result set in a single query."""
+    parent_ids = list({c["parent_chunk_id"] for c in chunks if c["parent_chunk_id"]})
+    if not parent_ids:
+        return chunks
+
+    parents = dict(conn.execute(PARENT_CHUNKS_SQL, (parent_ids,)).fetchall())
+    return _apply_parents(chunks, parents)
+
+
+def _memory_index_for(department: str):
+    """The department's in-process index, or None to fall back to pgvector (not loaded or load failed)."""
+    if memory_index is None:
+        return None
+    index = memory_index.get(department)
+    if index is None:
+        if not DATABASE_URL:
+            # Nothing to load from and no pgvector to fall back to (offline runs)
+            logger.warning(f"🗂️ [MEM-INDEX] {department} not loaded and DATABASE_URL not configured")
+            return DepartmentIndex.empty()
+        logger.warning(f"🗂️ [MEM-INDEX] {department} not loaded; falling back to pgvector")
+    return index
+
+
+def _memory_search(index, queries: list[str], query_vectors: list, k: int) -> list[dict]:
+    """Hybrid search + parent expansion against the in-process index."""
+    with stage("search"):
+        chunks = index.search_many(
+            query_vectors,
+            queries,
+            k_vector=HYBRID_K_VECTOR,
+            k_fts=HYBRID_K_FTS,
+            min_similarity=MIN_SIMILARITY,
+            k=k,
+        )
+    if ENABLE_PARENT_EXPANSION:
+        with stage("parents"):
+            parents = {
+                c["parent_chunk_id"]: index.parent_content(c["parent_chunk_id"])
+                for c in chunks if c["parent_chunk_id"]
+            }
+            chunks = _apply_parents(chunks, parents)
+    return chunks
+
+
 def _hybrid_search(query: str, department: str, k: int = RERANK_CANDIDATES) -> list[dict]:
     """
     Hybrid search: vector cosine similarity + BM25 full-text search.
     Returns top-k candidate chunks with scores.
     """
-    pool = _get_pool()
-    
-    # Generate query embedding
-    query_vector = embeddings.embed_query(query)
+    # Generate query embedding (cached)
+    with stage("embed"):
+        query_vector = query_embeddings.embed_query(query)
+
+    index = _memory_index_for(department)
+    if index is not None:
+        chunks = _memory_search(index, [query], [query_vector], k)
+        _log_hybrid_stats(query, department, chunks)
+        return chunks
+
     query_vector_str = str(query_vector)
-    
     title = DEPT_TO_TITLE.get(department, department)
     
-    with pool.connection() as conn:
-        results = conn.execute(
-            HYBRID_SEARCH_SQL,
-            {
-                "query_vector": query_vector_str,
-                "query_text": query,
-                "title": title,
-                "k_vector": HYBRID_K_VECTOR,
-                "k_fts": HYBRID_K_FTS,
-                "min_similarity": MIN_SIMILARITY,
-                "k": k,
-            }
-        ).fetchall()
+    with _get_pool().connection() as conn:
+        with stage("search"):
+            results = conn.execute(
+                HYBRID_SEARCH_SQL,
+                {
+                    "query_vector": query_vector_str,
+                    "query_text": query,
+                    "title": title,
+                    "k_vector": HYBRID_K_VECTOR,
+                    "k_fts": HYBRID_K_FTS,
+                    "min_similarity": MIN_SIMILARITY,
+                    "k": k,
+                }
+            ).fetchall()
         
         chunks = []
         for row in results:
@@ -161,87 +379,95 @@ def _hybrid_search(query: str, department: str, k: int = RERANK_CANDIDATES) -> l
                 "vec_score": float(row[4]),
                 "fts_score": float(row[5]),
                 "rrf_score": float(row[6]),
+                # Identity of the text sent to the LLM (parent id once expanded)
+                "context_id": row[0],
             }
             chunks.append(chunk)
         
         # Expand parent chunks if enabled
         if ENABLE_PARENT_EXPANSION:
-            for chunk in chunks:
-                if chunk["parent_chunk_id"]:
-                    parent = conn.execute(
-                        PARENT_CHUNK_SQL, (str(chunk["parent_chunk_id"]),)
-                    ).fetchone()
-                    if parent:
-                        chunk["content"] = parent[0]  # Use parent's richer content
+            with stage("parents"):
+                chunks = _expand_parents(conn, chunks)
     
-    # Log search statistics
+    _log_hybrid_stats(query, department, chunks)
+    return chunks
+
+
+def _hybrid_search_many(queries: list[str], department: str, k: int = RERANK_CANDIDATES) -> list[dict]:
+    """
+    Hybrid search for several query variants (original + expansions).
+
+    One batched embedding request for the uncached variants and one search
+    round trip; candidates are fused by summed per-variant RRF.
+    """
+    with stage("embed"):
+        query_vectors = query_embeddings.embed_queries(queries)
+
+    index = _memory_index_for(department)
+    if index is not None:
+        chunks = _memory_search(index, queries, query_vectors, k)
+        _log_hybrid_stats(queries[0], department, chunks, variants=len(queries))
+        return chunks
+
+    title = DEPT_TO_TITLE.get(department, department)
+    with _get_pool().connection() as conn, stage("search"):
+        rows = conn.execute(
+            HYBRID_SEARCH_MANY_SQL,
+            {
+                "query_vectors": [str(v) for v in query_vectors],
+                "query_texts": queries,
+                "title": title,
+                "k_vector": HYBRID_K_VECTOR,
+                "k_fts": HYBRID_K_FTS,
+                "min_similarity": MIN_SIMILARITY,
+                "k": k,
+            }
+        ).fetchall()
+
+    chunks = [
+        {
+            "id": row[0],
+            "content": row[1],
+            "parent_chunk_id": row[2],
+            "page_number": row[3],
+            "vec_score": float(row[4]),
+            "fts_score": float(row[5]),
+            "rrf_score": float(row[6]),
+            "context_id": row[0],
+        }
+        for row in rows
+    ]
+    if ENABLE_PARENT_EXPANSION:
+        with stage("parents"):  # Parent content came back with the search
+            parents = {row[2]: row[7] for row in rows if row[7]}
+            chunks = _apply_parents(chunks, parents)
+
+    _log_hybrid_stats(queries[0], department, chunks, variants=len(queries))
+    return chunks
+
+
+def _log_hybrid_stats(query: str, department: str, chunks: list[dict], variants: int = 1) -> None:
+    """Log how many results came from each retrieval channel."""
     vec_hits = sum(1 for c in chunks if c["vec_score"] > 0)
     fts_hits = sum(1 for c in chunks if c["fts_score"] > 0)
     both_hits = sum(1 for c in chunks if c["vec_score"] > 0 and c["fts_score"] > 0)
     logger.info(
         f"📚 [HYBRID] {department}: query='{query[:50]}...', "
-        f"results={len(chunks)} (vec={vec_hits}, fts={fts_hits}, both={both_hits})"
+        f"results={len(chunks)} (vec={vec_hits}, fts={fts_hits}, both={both_hits}, variants={variants}, backend={RAG_BACKEND})"
     )
-    
-    return chunks
 
 
 def _rerank_chunks(query: str, chunks: list[dict], top_k: int = DEFAULT_K) -> list[dict]:
     """
-    Re-rank chunks using Gemini as a cross-encoder.
-    Sends the query + chunk contents to Gemini and asks it to rank by relevance.
+    Re-rank chunks with the configured reranker (see reranker.py).
+    Falls back to RRF order when disabled, failing or over its latency budget.
     """
     if not chunks:
         return []
-    
-    if len(chunks) <= top_k:
-        return chunks  # No need to re-rank if fewer than top_k
-    
-    try:
-        llm = ChatGoogleGenerativeAI(model="gemini-3.1-flash-lite-preview", temperature=0)
-        
-        numbered_chunks = "\n\n".join([
-            f"[{i+1}] {c['content'][:500]}" for i, c in enumerate(chunks)
-        ])
-        
-        prompt = (
-            f"Eres un evaluador de relevancia para un chatbot de COOTRADECUN (cooperativa colombiana). "
-            f"Dada la pregunta del usuario y los fragmentos de documentos, selecciona los {top_k} "
-            f"fragmentos MÁS relevantes para responder la pregunta.\n\n"
-            f"Pregunta: {query}\n\n"
-            f"Fragmentos:\n{numbered_chunks}\n\n"
-            f"Responde SOLO con los números de los {top_k} fragmentos más relevantes, "
-            f"ordenados de mayor a menor relevancia, separados por comas. "
-            f"Ejemplo: 3,1,5,2"
-        )
-        
-        result = llm.invoke(prompt)
-        response_text = result.content.strip()
-        
-        # Parse the ranking
-        indices = []
-        for part in response_text.replace(" ", "").split(","):
-            try:
-                idx = int(part) - 1  # Convert 1-indexed to 0-indexed
-                if 0 <= idx < len(chunks):
-                    indices.append(idx)
-            except ValueError:
-                continue
-        
-        if indices:
-            reranked = [chunks[i] for i in indices[:top_k]]
-            logger.info(
-                f"📊 [RERANK] Reordered {len(chunks)} → {len(reranked)} chunks. "
-                f"Order: {[i+1 for i in indices[:top_k]]}"
-            )
-            return reranked
-        else:
-            logger.warning(f"📊 [RERANK] Could not parse ranking: '{response_text}'. Using original order.")
-            return chunks[:top_k]
-    
-    except Exception as e:
-        logger.warning(f"📊 [RERANK] Error during re-ranking: {e}. Using original order.")
+    if reranker is None:
         return chunks[:top_k]
+    with stage("rerank"):
+        return reranker.rerank(query, chunks, top_k)
 
 
 def _format_output(chunks: list[dict], department: str) -> str:
@@ -266,43 +492,83 @@ def _format_output(chunks: list[dict], department: str) -> str:
     return "\n\n---\n\n".join(formatted)
 
 
-def search_by_department(query: str, department: str, k: int = DEFAULT_K) -> str:
+def fetch_chunks_by_ids(chunk_ids: list[str], department: str) -> list[dict]:
+    """
+    Chunks (parents or children) by id, in the requested order.
+
+    Used to recover the text of a retrieval result after its ToolMessage
+    was replaced by a stub. Unknown ids, and ids of another department's
+    documents, are skipped.
+    """
+    if not chunk_ids:
+        return []
+    index = _memory_index_for(department)
+    if index is not None:
+        found = [index.chunk(cid) for cid in chunk_ids]
+        return [c for c in found if c is not None]
+
+    title = DEPT_TO_TITLE.get(department, department)
+    with _get_pool().connection() as conn:
+        rows = conn.execute(CHUNKS_BY_ID_SQL, ([str(cid) for cid in chunk_ids], title)).fetchall()
+    by_id = {row[0]: {"id": row[0], "content": row[1], "page_number": row[2]} for row in rows}
+    return [by_id[str(cid)] for cid in chunk_ids if str(cid) in by_id]
+
+
+def retrieve_chunks(query: str, department: str, k: int = DEFAULT_K) -> list[dict]:
     """
-    Advanced RAG search pipeline:
+    Advanced RAG retrieval pipeline:
+    0. Semantic cache lookup (skips steps 1-2 on a hit)
     1. Hybrid search (vector + BM25) → get RERANK_CANDIDATES chunks
-    2. Re-rank with Gemini → keep top k
-    3. Format with source attribution
+    2. Re-rank with the configured RERANKER → keep top k (RERANKER=none,
+       the default, keeps the top k in RRF order)
+
+    Returns the final chunks (see search_by_department for the LLM text).
+    """
+    # Step 0: Semantic cache (similar query already answered)
+    if semantic_cache is not None:
+        with stage("semantic_cache"):
+            query_vector = query_embeddings.embed_query(query)
+            cached = semantic_cache.lookup(department, query_vector, variant=f"plain:k={k}")
+        if cached is not None:
+            return cached
+
+    # Step 1: Hybrid search
+    candidates = _hybrid_search(query, department, k=RERANK_CANDIDATES)
+    
+    if not candidates:
+        logger.info(f"📚 [RAG] {department}: query='{query[:50]}...', chunks=0 (no results)")
+        return []
     
+    # Step 2: Re-rank (if enabled)
+    if ENABLE_RERANK and len(candidates) > k:
+        final_chunks = _rerank_chunks(query, candidates, top_k=k)
+    else:
+        final_chunks = candidates[:k]
+    
+    if semantic_cache is not None:
+        semantic_cache.store(department, query_vector, final_chunks, variant=f"plain:k={k}")
+
+    # Log final stats
+    total_chars = sum(len(c["content"]) for c in final_chunks)
+    avg_sim = sum(c["vec_score"] for c in final_chunks) / len(final_chunks)
+    logger.info(
+        f"📚 [RAG] {department}: query='{query[:50]}...', "
+        f"final_chunks={len(final_chunks)}, total_chars={total_chars}, "
+        f"avg_similarity={avg_sim:.3f}"
+    )
+    return final_chunks
+
+
+def search_by_department(query: str, department: str, k: int = DEFAULT_K) -> str:
+    """
+    retrieve_chunks + format with source attribution.
+
     Returns formatted context string for the LLM agent.
     """
     try:
-        # Step 1: Hybrid search
-        candidates = _hybrid_search(query, department, k=RERANK_CANDIDATES)
-        
-        if not candidates:
-            logger.info(f"📚 [RAG] {department}: query='{query[:50]}...', chunks=0 (no results)")
-            return "No se encontró información relevante."
-        
-        # Step 2: Re-rank (if enabled)
-        if ENABLE_RERANK and len(candidates) > k:
-            final_chunks = _rerank_chunks(query, candidates, top_k=k)
-        else:
-            final_chunks = candidates[:k]
-        
-        # Step 3: Format output
-        result = _format_output(final_chunks, department)
-        
-        # Log final stats
-        total_chars = sum(len(c["content"]) for c in final_chunks)
-        avg_sim = sum(c["vec_score"] for c in final_chunks) / len(final_chunks)
-        logger.info(
-            f"📚 [RAG] {department}: query='{query[:50]}...', "
-            f"final_chunks={len(final_chunks)}, total_chars={total_chars}, "
-            f"avg_similarity={avg_sim:.3f}"
-        )
-        
-        return result
-    
+        with rag_department(department):
+            chunks = retrieve_chunks(query, department, k)
+        return _format_output(chunks, department)
     except Exception as e:
         logger.error(f"RAG: Error querying {department}: {e}")
         return f"Error retrieving information: {e}"
@@ -0,0 +1,542 @@
+"""
+RAG Caches — in-process caches in front of the expensive RAG calls.
+
+Implements:
+1. LRUTTLCache: bounded, thread-safe LRU with per-entry TTL and
+   hit/miss/eviction counters (tools run on ToolNode worker threads).
+2. EmbeddingCache: query-embedding cache keyed by (model, normalized query)
+   in front of embeddings.embed_query, with an optional persistent tier in
+   PostgreSQL (table rag_embedding_cache, see docs/embedding_cache.sql) so
+   warm entries survive restarts and are shared across instances.
+3. ExpansionCache: LLM query expansions keyed by (model + prompt version,
+   normalized query), in memory and in PostgreSQL (rag_query_expansion_cache,
+   see docs/query_expansion_cache.sql).
+4. SemanticCache: per-department retrieval cache keyed by query-embedding
+   similarity. A query within SEMANTIC_CACHE_THRESHOLD cosine of a recent
+   one reuses its final chunks, skipping the hybrid SQL and the expansion
+   LLM call. Entries are invalidated when the department's indexed
+   rag_document rows change (e.g. a re-index by script_index.py).
+   Off by default: near-identical questions about different projects can
+   be within the threshold and would be served each other's chunks.
+
+Configuration (environment):
+    EMBEDDING_CACHE_SIZE          Max in-memory entries (default 2048)
+    EMBEDDING_CACHE_TTL_SECONDS   Entry lifetime (default 7 days)
+    EMBEDDING_CACHE_PERSIST       Enable the PostgreSQL tier (default true)
+    EXPANSION_CACHE_SIZE          Max in-memory expansions (default 1024)
+    EXPANSION_CACHE_TTL_SECONDS   Expansion lifetime (default 30 days)
+    EXPANSION_CACHE_PERSIST       Enable the PostgreSQL tier (default true)
+    CACHE_PERSIST_RETRY_SECONDS   Pause of a persistent tier after a DB error;
+                                  doubles per consecutive failure up to 10 min
+                                  (default 30)
+    SEMANTIC_CACHE_ENABLED        Enable the semantic cache (default false)
+    SEMANTIC_CACHE_THRESHOLD      Min cosine similarity for a hit (default 0.93)
+    SEMANTIC_CACHE_SIZE           Max entries per department (default 256)
+    SEMANTIC_CACHE_TTL_SECONDS    Entry lifetime (default 6 hours)
+    SEMANTIC_CACHE_VERSION_CHECK_SECONDS
+                                  How often the corpus fingerprint is re-read
+                                  to detect re-indexed documents (default 30)
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+EMBEDDING_CACHE_TTL_SECONDS = int(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+EMBEDDING_CACHE_PERSIST = os.getenv("EMBEDDING_CACHE_PERSIST", "true").lower() in ("true", "1", "yes")
+
+EXPANSION_CACHE_SIZE = int(os.getenv("EXPANSION_CACHE_SIZE", "1024"))
+EXPANSION_CACHE_TTL_SECONDS = int(os.getenv("EXPANSION_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+EXPANSION_CACHE_PERSIST = os.getenv("EXPANSION_CACHE_PERSIST", "true").lower() in ("true", "1", "yes")
+
+CACHE_PERSIST_RETRY_SECONDS = float(os.getenv("CACHE_PERSIST_RETRY_SECONDS", "30"))
+CACHE_PERSIST_MAX_RETRY_SECONDS = 600.0
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() in ("true", "1", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "256"))
+SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(6 * 3600)))
+SEMANTIC_CACHE_VERSION_CHECK_SECONDS = int(os.getenv("SEMANTIC_CACHE_VERSION_CHECK_SECONDS", "30"))
+
+
+def normalize_query(text: str) -> str:
+    """Canonical cache key for a user query: NFKC, casefolded, single-spaced."""
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+# --- Generic LRU + TTL cache ---
+
+class LRUTTLCache:
+    """Bounded LRU cache whose entries also expire after ttl_seconds."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+# --- Persistent tier (PostgreSQL) ---
+
+EMBEDDING_CACHE_GET_SQL = """
+SELECT embedding FROM rag_embedding_cache
+WHERE model = %s AND query_key = %s
+  AND created_at > NOW() - make_interval(secs => %s)
+"""
+
+EMBEDDING_CACHE_PUT_SQL = """
+INSERT INTO rag_embedding_cache (model, query_key, embedding, created_at)
+VALUES (%s, %s, %s, NOW())
+ON CONFLICT (model, query_key) DO UPDATE
+   SET embedding = EXCLUDED.embedding, created_at = NOW()
+"""
+
+
+class _PostgresCacheStore:
+    """
+    Base for cache tables accessed through the RAG psycopg pool.
+
+    A failure (pool timeout, restart, table not migrated yet) pauses the
+    tier for CACHE_PERSIST_RETRY_SECONDS, doubling per consecutive failure
+    up to CACHE_PERSIST_MAX_RETRY_SECONDS; the first success resets it.
+    It must never break retrieval.
+    """
+
+    log_tag = "CACHE"
+
+    def __init__(self, get_pool: Callable[[], Any], ttl_seconds: float):
+        self._get_pool = get_pool
+        self.ttl_seconds = ttl_seconds
+        self._failures = 0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """False while paused after a failure."""
+        return time.monotonic() >= self._retry_at
+
+    def _disable(self, e: Exception) -> None:
+        with self._lock:
+            self._failures += 1
+            pause = min(CACHE_PERSIST_RETRY_SECONDS * 2 ** (self._failures - 1), CACHE_PERSIST_MAX_RETRY_SECONDS)
+            self._retry_at = time.monotonic() + pause
+        logger.warning(f"🧊 [{self.log_tag}] Persistent tier paused for {pause:.0f}s: {e}")
+
+    def _succeeded(self) -> None:
+        if self._failures:
+            with self._lock:
+                self._failures = 0
+            logger.info(f"🧊 [{self.log_tag}] Persistent tier available again")
+
+    def _fetchone(self, sql: str, params: tuple) -> Optional[tuple]:
+        if not self.enabled:
+            return None
+        try:
+            with self._get_pool().connection() as conn:
+                row = conn.execute(sql, params).fetchone()
+        except Exception as e:
+            self._disable(e)
+            return None
+        self._succeeded()
+        return row
+
+    def _execute(self, sql: str, params: tuple) -> None:
+        if not self.enabled:
+            return
+        try:
+            with self._get_pool().connection() as conn:
+                conn.execute(sql, params)
+        except Exception as e:
+            self._disable(e)
+            return
+        self._succeeded()
+
+
+class PostgresEmbeddingStore(_PostgresCacheStore):
+    """rag_embedding_cache table (see docs/embedding_cache.sql)."""
+
+    log_tag = "EMBED-CACHE"
+
+    def get(self, model: str, key: str) -> Optional[list[float]]:
+        row = self._fetchone(EMBEDDING_CACHE_GET_SQL, (model, key, self.ttl_seconds))
+        return list(row[0]) if row else None
+
+    def put(self, model: str, key: str, vector: list[float]) -> None:
+        self._execute(EMBEDDING_CACHE_PUT_SQL, (model, key, vector))
+
+
+EXPANSION_CACHE_GET_SQL = """
+SELECT alternatives FROM rag_query_expansion_cache
+WHERE model = %s AND query_key = %s
+  AND created_at > NOW() - make_interval(secs => %s)
+"""
+
+EXPANSION_CACHE_PUT_SQL = """
+INSERT INTO rag_query_expansion_cache (model, query_key, alternatives, created_at)
+VALUES (%s, %s, %s, NOW())
+ON CONFLICT (model, query_key) DO UPDATE
+   SET alternatives = EXCLUDED.alternatives, created_at = NOW()
+"""
+
+
+class PostgresExpansionStore(_PostgresCacheStore):
+    """rag_query_expansion_cache table (see docs/query_expansion_cache.sql)."""
+
+    log_tag = "EXPAND-CACHE"
+
+    def get(self, model: str, key: str) -> Optional[list[str]]:
+        row = self._fetchone(EXPANSION_CACHE_GET_SQL, (model, key, self.ttl_seconds))
+        return list(row[0]) if row else None
+
+    def put(self, model: str, key: str, alternatives: list[str]) -> None:
+        self._execute(EXPANSION_CACHE_PUT_SQL, (model, key, alternatives))
+
+
+# --- Query-embedding cache ---
+
+class EmbeddingCache:
+    """
+    Cache in front of an Embeddings model's embed_query() / batched queries.
+
+    Lookup order: in-memory LRU → persistent store → embedding API.
+    Entries are keyed by (model_name, normalize_query(text)).
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        model_name: str,
+        max_entries: int = EMBEDDING_CACHE_SIZE,
+        ttl_seconds: float = EMBEDDING_CACHE_TTL_SECONDS,
+        store: Optional[PostgresEmbeddingStore] = None,
+    ):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.store = store
+        self._memory = LRUTTLCache(max_entries, ttl_seconds)
+        self.persistent_hits = 0
+        self.api_calls = 0
+
+    def _lookup(self, key: str) -> Optional[list[float]]:
+        vector = self._memory.get((self.model_name, key))
+        if vector is not None:
+            return vector
+
+        if self.store is not None:
+            vector = self.store.get(self.model_name, key)
+            if vector is not None:
+                self.persistent_hits += 1
+                self._memory.put((self.model_name, key), vector)
+                return vector
+        return None
+
+    def _remember(self, key: str, vector: list[float]) -> None:
+        self._memory.put((self.model_name, key), vector)
+        if self.store is not None:
+            self.store.put(self.model_name, key, vector)
+
+    def embed_query(self, text: str) -> list[float]:
+        key = normalize_query(text)
+        vector = self._lookup(key)
+        if vector is not None:
+            return vector
+
+        self.api_calls += 1
+        vector = self.embeddings.embed_query(text)
+        self._remember(key, vector)
+        return vector
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embed several queries, sending all cache misses in one batched request.
+
+        Uses embed_documents with the RETRIEVAL_QUERY task type so the vectors
+        match what embed_query returns (and can share cache entries).
+        """
+        keys = [normalize_query(t) for t in texts]
+        vectors = [self._lookup(key) for key in keys]
+
+        misses = {}  # normalized key → original text (dedupes equal variants)
+        for text, key, vector in zip(texts, keys, vectors):
+            if vector is None:
+                misses.setdefault(key, text)
+
+        if misses:
+            self.api_calls += 1
+            miss_texts = list(misses.values())
+            try:
+                embedded = self.embeddings.embed_documents(miss_texts, task_type="RETRIEVAL_QUERY")
+            except TypeError:
+                # Embeddings without task types (e.g. test doubles)
+                embedded = self.embeddings.embed_documents(miss_texts)
+            fresh = dict(zip(misses, embedded))
+            for key, vector in fresh.items():
+                self._remember(key, vector)
+            vectors = [v if v is not None else fresh[key] for key, v in zip(keys, vectors)]
+
+        return vectors
+
+    def stats(self) -> dict:
+        stats = self._memory.stats()
+        stats["persistent_hits"] = self.persistent_hits
+        stats["api_calls"] = self.api_calls
+        stats["persistent_enabled"] = bool(self.store and self.store.enabled)
+        return stats
+
+
+# --- Query-expansion cache ---
+
+class ExpansionCache:
+    """
+    Cache of LLM query expansions (alternative phrasings).
+
+    Keyed by (model, normalize_query(query)); model should include the
+    prompt version so a prompt change never serves stale expansions.
+    Lookup order: in-memory LRU → persistent store.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        max_entries: int = EXPANSION_CACHE_SIZE,
+        ttl_seconds: float = EXPANSION_CACHE_TTL_SECONDS,
+        store: Optional[PostgresExpansionStore] = None,
+    ):
+        self.model_name = model_name
+        self.store = store
+        self._memory = LRUTTLCache(max_entries, ttl_seconds)
+        self.persistent_hits = 0
+
+    def get(self, query: str) -> Optional[list[str]]:
+        key = normalize_query(query)
+        alternatives = self._memory.get((self.model_name, key))
+        if alternatives is not None:
+            return alternatives
+
+        if self.store is not None:
+            alternatives = self.store.get(self.model_name, key)
+            if alternatives is not None:
+                self.persistent_hits += 1
+                self._memory.put((self.model_name, key), alternatives)
+                return alternatives
+        return None
+
+    def put(self, query: str, alternatives: list[str]) -> None:
+        key = normalize_query(query)
+        self._memory.put((self.model_name, key), alternatives)
+        if self.store is not None:
+            self.store.put(self.model_name, key, alternatives)
+
+    def stats(self) -> dict:
+        stats = self._memory.stats()
+        stats["persistent_hits"] = self.persistent_hits
+        stats["persistent_enabled"] = bool(self.store and self.store.enabled)
+        return stats
+
+
+# --- Semantic retrieval cache ---
+
+class _SemanticBucket:
+    """Entries of one (department, variant) bucket plus a lazily stacked matrix."""
+
+    def __init__(self):
+        self.entries: "OrderedDict[int, tuple[float, np.ndarray, list[dict]]]" = OrderedDict()
+        self.matrix: Optional[np.ndarray] = None
+        self.expires_at: Optional[np.ndarray] = None
+        self.keys: list[int] = []
+
+    def rebuild(self) -> None:
+        self.keys = list(self.entries)
+        self.matrix = np.stack([self.entries[k][1] for k in self.keys]) if self.keys else None
+        self.expires_at = np.array([self.entries[k][0] for k in self.keys]) if self.keys else None
+
+
+class SemanticCache:
+    """
+    Per-department cache of (query_vector, final_chunks) pairs.
+
+    Buckets are keyed by (department, variant), where variant identifies the
+    retrieval pipeline and k (expanded vs plain search) so their results are
+    never mixed. Each bucket is an LRU bounded by max_entries.
+
+    fetch_versions() must return {department: fingerprint} for the indexed
+    corpus; it is polled every version_check_seconds and any department
+    whose fingerprint changed is dropped.
+    """
+
+    def __init__(
+        self,
+        fetch_versions: Callable[[], dict],
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_entries: int = SEMANTIC_CACHE_SIZE,
+        ttl_seconds: float = SEMANTIC_CACHE_TTL_SECONDS,
+        version_check_seconds: float = SEMANTIC_CACHE_VERSION_CHECK_SECONDS,
+    ):
+        self.fetch_versions = fetch_versions
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version_check_seconds = version_check_seconds
+        self._buckets: dict[tuple[str, str], _SemanticBucket] = {}
+        self._versions: dict[str, str] = {}
+        self._versions_checked_at = float("-inf")
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def _check_versions(self) -> None:
+        # Called WITHOUT self._lock: fetch_versions() is a DB round trip and
+        # must not block lookups. The check is claimed under the lock (one
+        # caller per interval fetches); comparing and dropping happen under it.
+        with self._lock:
+            now = time.monotonic()
+            if now - self._versions_checked_at < self.version_check_seconds:
+                return
+            first_check = self._versions_checked_at == float("-inf")
+            self._versions_checked_at = now
+        try:
+            versions = self.fetch_versions()
+        except Exception as e:
+            logger.warning(f"🧠 [SEM-CACHE] Could not read corpus versions: {e}")
+            return
+        with self._lock:
+            if first_check:
+                self._versions = versions
+                return
+            for department in set(self._versions) | set(versions):
+                if self._versions.get(department) != versions.get(department):
+                    self._drop(department)
+            self._versions = versions
+
+    def lookup(self, department: str, query_vector, variant: str = "") -> Optional[list[dict]]:
+        """Return cached chunks for a similar query, or None."""
+        self._check_versions()
+        with self._lock:
+            bucket = self._buckets.get((department, variant))
+            if bucket is None or not bucket.entries:
+                self.misses += 1
+                return None
+            if bucket.matrix is None:
+                bucket.rebuild()
+            scores = bucket.matrix @ self._unit(query_vector)
+            scores[bucket.expires_at < time.monotonic()] = -np.inf  # Expired entries never match
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            entry_id = bucket.keys[best]
+            _, _, chunks = bucket.entries[entry_id]
+            bucket.entries.move_to_end(entry_id)
+            self.hits += 1
+        logger.info(f"🧠 [SEM-CACHE] HIT {department}/{variant}: similarity={scores[best]:.3f}")
+        return [dict(c) for c in chunks]
+
+    def store(self, department: str, query_vector, chunks: list[dict], variant: str = "") -> None:
+        self._check_versions()
+        with self._lock:
+            bucket = self._buckets.setdefault((department, variant), _SemanticBucket())
+            self._next_id += 1
+            bucket.entries[self._next_id] = (
+                time.monotonic() + self.ttl_seconds,
+                self._unit(query_vector),
+                [dict(c) for c in chunks],
+            )
+            while len(bucket.entries) > self.max_entries:
+                bucket.entries.popitem(last=False)
+                self.evictions += 1
+            bucket.matrix = None
+
+    def invalidate(self, department: Optional[str] = None) -> None:
+        """Drop all entries for a department (or every department)."""
+        with self._lock:
+            self._drop(department)
+
+    def _drop(self, department: Optional[str]) -> None:
+        # self._lock held
+        for key in [k for k in self._buckets if department is None or k[0] == department]:
+            del self._buckets[key]
+        self.invalidations += 1
+        logger.info(f"🧠 [SEM-CACHE] Invalidated department={department or '*'}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": sum(len(b.entries) for b in self._buckets.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,438 @@
+"""
+In-Process Hybrid Retrieval Index — alternative backend to pgvector.
+
+The corpus (eight PDFs, a few thousand rag_chunk rows) fits in memory, so
+retrieval can run without a DB round trip:
+
+1. Vector search: per-department float32 matrix of L2-normalized child
+   embeddings, saved as .npy under RAG_INDEX_DIR and memory-mapped so
+   several uvicorn workers share the same pages.
+2. Keyword search: in-memory BM25 over the same child chunks (accent-folded
+   Spanish tokens, AND semantics like plainto_tsquery).
+3. Fusion: the Reciprocal Rank Fusion of HYBRID_SEARCH_SQL, vectorized;
+   search_many() scores all query-expansion variants in one matrix product.
+4. Parent store: parent contents kept in a compact array-backed TextStore
+   (one joined string + offsets) for parent expansion.
+5. Incremental refresh: every RAG_INDEX_REFRESH_SECONDS the corpus
+   fingerprint (see rag._fetch_corpus_versions) is compared and only the
+   departments whose rag_document rows changed are reloaded. A department
+   that could not be loaded is searched with pgvector instead (rag.py).
+
+Selected with RAG_BACKEND=memory (default: pgvector).
+"""
+
+import os
+import re
+import json
+import math
+import time
+import uuid
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Callable, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RAG_INDEX_DIR = os.getenv("RAG_INDEX_DIR", "/tmp/rag_index")
+RAG_INDEX_REFRESH_SECONDS = int(os.getenv("RAG_INDEX_REFRESH_SECONDS", "60"))
+
+RRF_K = 60          # Same constant as HYBRID_SEARCH_SQL
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+# --- Tokenization (BM25) ---
+
+_SPANISH_STOPWORDS = frozenset("""
+a al algo algunas algunos ante antes como con contra cual cuando de del desde donde durante e el
+ella ellas ellos en entre era es esa esas ese eso esos esta estas este esto estos fue ha hay la las
+le les lo los mas me mi mis mucho muy nada ni no nos o os otra otras otro otros para pero poco por
+porque que quien se ser si sin sobre son su sus tambien te tiene tu tus un una uno unos y ya yo
+""".split())
+
+
+def fold(text: str) -> str:
+    """Lowercase and strip accents (ñ → n), like an unaccented tsvector."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def tokenize(text: str) -> list[str]:
+    """Accent-folded word tokens without stopwords and with plurals stripped."""
+    tokens = []
+    for token in re.findall(r"[a-z0-9]+", fold(text or "")):
+        if token in _SPANISH_STOPWORDS:
+            continue
+        if len(token) > 4 and token.endswith("es"):
+            token = token[:-2]
+        elif len(token) > 3 and token.endswith("s"):
+            token = token[:-1]
+        if token not in _SPANISH_STOPWORDS:
+            tokens.append(token)
+    return tokens
+
+
+class BM25Index:
+    """Inverted index with vectorized BM25 scoring."""
+
+    def __init__(self, docs_tokens: list[list[str]], k1: float = BM25_K1, b: float = BM25_B):
+        self.n_docs = len(docs_tokens)
+        self.doc_len = np.array([len(t) for t in docs_tokens], dtype=np.float32)
+        avgdl = float(self.doc_len.mean()) if self.n_docs else 0.0
+        # Precomputed per-document length normalization
+        self._norm = k1 * (1 - b + b * self.doc_len / avgdl) if avgdl else np.full(self.n_docs, k1, dtype=np.float32)
+        self.k1 = k1
+
+        postings = defaultdict(list)
+        for doc_idx, tokens in enumerate(docs_tokens):
+            for term, tf in Counter(tokens).items():
+                postings[term].append((doc_idx, tf))
+        self.postings = {
+            term: (
+                np.array([d for d, _ in pairs], dtype=np.int32),
+                np.array([tf for _, tf in pairs], dtype=np.float32),
+            )
+            for term, pairs in postings.items()
+        }
+
+    def score(self, terms: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return (scores, matched) over all documents.
+
+        matched is True only for documents containing every query term,
+        mirroring plainto_tsquery's AND semantics.
+        """
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        matched = np.ones(self.n_docs, dtype=bool) if terms else np.zeros(self.n_docs, dtype=bool)
+        for term in set(terms):
+            posting = self.postings.get(term)
+            if posting is None:
+                return scores, np.zeros(self.n_docs, dtype=bool)
+            docs, tf = posting
+            idf = math.log(1 + (self.n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + self._norm[docs])
+            present = np.zeros(self.n_docs, dtype=bool)
+            present[docs] = True
+            matched &= present
+        return scores, matched
+
+
+# --- Compact text storage ---
+
+class TextStore:
+    """Many strings kept as one joined string plus an offsets array."""
+
+    def __init__(self, texts: list[str]):
+        self._data = "".join(texts)
+        self._offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([len(t) for t in texts], out=self._offsets[1:])
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        return self._data[self._offsets[idx]:self._offsets[idx + 1]]
+
+
+# --- Per-department index ---
+
+class DepartmentIndex:
+    """Child-chunk vectors + BM25 + parent store for one department."""
+
+    def __init__(
+        self,
+        ids: list[str],
+        parent_ids: list[Optional[str]],
+        page_numbers: list[Optional[int]],
+        contents: list[str],
+        matrix: np.ndarray,
+        parents: dict[str, str],
+    ):
+        self.ids = ids
+        self.parent_ids = parent_ids
+        self.page_numbers = page_numbers
+        self.contents = TextStore(contents)
+        self.matrix = matrix
+        self.bm25 = BM25Index([tokenize(c) for c in contents])
+        self._parent_pos = {pid: i for i, pid in enumerate(parents)}
+        self._parents = TextStore(list(parents.values()))
+        self._child_pos = {cid: i for i, cid in enumerate(ids)}
+
+    @classmethod
+    def empty(cls) -> "DepartmentIndex":
+        return cls(ids=[], parent_ids=[], page_numbers=[], contents=[], matrix=np.zeros((0, 0), dtype=np.float32), parents={})
+
+    @staticmethod
+    def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def parent_content(self, parent_id) -> Optional[str]:
+        pos = self._parent_pos.get(str(parent_id))
+        return self._parents[pos] if pos is not None else None
+
+    def chunk(self, chunk_id) -> Optional[dict]:
+        """Parent or child chunk by id (content + page)."""
+        content = self.parent_content(chunk_id)
+        if content is not None:
+            return {"id": str(chunk_id), "content": content, "page_number": None}
+        pos = self._child_pos.get(str(chunk_id))
+        if pos is None:
+            return None
+        return {"id": str(chunk_id), "content": self.contents[pos], "page_number": self.page_numbers[pos]}
+
+    def _variant_scores(self, sims: np.ndarray, query_text: str, k_vector: int, k_fts: int, min_similarity: float):
+        """
+        Candidates of one query variant: (indices, vec_score, fts_score, rrf).
+
+        Same semantics as HYBRID_SEARCH_SQL: top k_vector by cosine, top k_fts
+        BM25 among documents matching all terms, RRF over the union, and the
+        min_similarity / fts filter.
+        """
+        n = len(sims)
+        vec_score = np.zeros(n, dtype=np.float32)
+        fts_score = np.zeros(n, dtype=np.float32)
+        rrf = np.zeros(n, dtype=np.float64)
+
+        kv = min(k_vector, n)
+        top_vec = np.argpartition(-sims, kv - 1)[:kv]
+        top_vec = top_vec[np.argsort(-sims[top_vec], kind="stable")]
+        vec_score[top_vec] = sims[top_vec]
+        rrf[top_vec] += 1.0 / (RRF_K + np.arange(1, kv + 1))
+
+        bm25, matched = self.bm25.score(tokenize(query_text))
+        fts_docs = np.flatnonzero(matched)
+        if len(fts_docs):
+            fts_docs = fts_docs[np.argsort(-bm25[fts_docs], kind="stable")][:k_fts]
+            fts_score[fts_docs] = bm25[fts_docs]
+            rrf[fts_docs] += 1.0 / (RRF_K + np.arange(1, len(fts_docs) + 1))
+
+        candidates = np.union1d(top_vec, fts_docs).astype(np.int64)
+        keep = (vec_score[candidates] >= min_similarity) | (fts_score[candidates] > 0)
+        candidates = candidates[keep]
+        return candidates, vec_score[candidates], fts_score[candidates], rrf[candidates]
+
+    def search_many(
+        self,
+        query_vectors,
+        query_texts: list[str],
+        k_vector: int,
+        k_fts: int,
+        min_similarity: float,
+        k: int,
+    ) -> list[dict]:
+        """
+        Hybrid search for several query variants at once.
+
+        All variants are scored with one matrix product; a chunk's final RRF is
+        the sum of its per-variant RRF (best vec/fts score is kept), matching
+        HYBRID_SEARCH_MANY_SQL.
+        """
+        n = len(self.ids)
+        if n == 0 or not query_texts:
+            return []
+
+        queries = self.normalize_rows(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+        sims = self.matrix @ queries.T  # (chunks, variants)
+
+        vec_score = np.zeros(n, dtype=np.float32)
+        fts_score = np.zeros(n, dtype=np.float32)
+        rrf = np.zeros(n, dtype=np.float64)
+        seen = np.zeros(n, dtype=bool)
+        for j, text in enumerate(query_texts):
+            idx, v, f, r = self._variant_scores(sims[:, j], text, k_vector, k_fts, min_similarity)
+            vec_score[idx] = np.maximum(vec_score[idx], v)
+            fts_score[idx] = np.maximum(fts_score[idx], f)
+            rrf[idx] += r
+            seen[idx] = True
+
+        candidates = np.flatnonzero(seen)
+        candidates = candidates[np.argsort(-rrf[candidates], kind="stable")][:k]
+
+        chunks = []
+        for i in candidates:
+            chunk_id = uuid.UUID(self.ids[i])
+            parent_id = self.parent_ids[i]
+            chunks.append({
+                "id": chunk_id,
+                "content": self.contents[i],
+                "parent_chunk_id": uuid.UUID(parent_id) if parent_id else None,
+                "page_number": self.page_numbers[i],
+                "vec_score": float(vec_score[i]),
+                "fts_score": float(fts_score[i]),
+                "rrf_score": float(rrf[i]),
+                "context_id": chunk_id,
+            })
+        return chunks
+
+    def search(
+        self,
+        query_vector,
+        query_text: str,
+        k_vector: int,
+        k_fts: int,
+        min_similarity: float,
+        k: int,
+    ) -> list[dict]:
+        """Vectorized equivalent of HYBRID_SEARCH_SQL for one query."""
+        return self.search_many([query_vector], [query_text], k_vector, k_fts, min_similarity, k)
+
+
+# --- Loading from PostgreSQL ---
+
+CHILD_ROWS_SQL = """
+SELECT c.id::text, c.parent_chunk_id::text, c.page_number, c.content, c.embedding::text
+FROM rag_chunk c
+JOIN rag_document d ON c.document_id = d.id
+WHERE d.title = %s AND d.status = 'indexed'
+  AND (c.is_parent = FALSE OR c.is_parent IS NULL)
+ORDER BY c.id
+"""
+
+PARENT_ROWS_SQL = """
+SELECT c.id::text, c.content
+FROM rag_chunk c
+JOIN rag_document d ON c.document_id = d.id
+WHERE d.title = %s AND d.status = 'indexed' AND c.is_parent = TRUE
+"""
+
+
+def parse_vector(text: str) -> np.ndarray:
+    """Parse pgvector's text form '[0.1,0.2,...]'."""
+    return np.array(text.strip("[]").split(","), dtype=np.float32)
+
+
+class MemoryIndex:
+    """
+    All departments' DepartmentIndex objects, refreshed incrementally.
+
+    Snapshots are persisted under RAG_INDEX_DIR keyed by the department's
+    corpus fingerprint: the first worker to load a version writes the files,
+    the others memory-map them without querying rag_chunk again.
+    """
+
+    def __init__(
+        self,
+        get_pool: Callable,
+        fetch_versions: Callable[[], dict],
+        dept_to_title: dict[str, str],
+        index_dir: str = RAG_INDEX_DIR,
+        refresh_seconds: float = RAG_INDEX_REFRESH_SECONDS,
+    ):
+        self._get_pool = get_pool
+        self.fetch_versions = fetch_versions
+        self.dept_to_title = dept_to_title
+        self.index_dir = index_dir
+        self.refresh_seconds = refresh_seconds
+        self._departments: dict[str, DepartmentIndex] = {}
+        self._versions: dict[str, str] = {}
+        self._refreshed_at = float("-inf")
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def set_department(self, department: str, index: DepartmentIndex, version: str = "static") -> None:
+        """Install an index built elsewhere (offline benchmarks, tests)."""
+        self._departments[department] = index
+        self._versions[department] = version
+
+    def get(self, department: str) -> Optional[DepartmentIndex]:
+        self.refresh()
+        return self._departments.get(department)
+
+    def refresh(self, force: bool = False) -> None:
+        """Reload the departments whose corpus fingerprint changed."""
+        if not force and time.monotonic() - self._refreshed_at < self.refresh_seconds:
+            return
+        with self._lock:
+            if not force and time.monotonic() - self._refreshed_at < self.refresh_seconds:
+                return
+            self._refreshed_at = time.monotonic()
+            try:
+                versions = self.fetch_versions()
+            except Exception as e:
+                logger.warning(f"🗂️ [MEM-INDEX] Could not read corpus versions: {e}")
+                return
+
+            for department in list(self._departments):
+                if department not in versions:
+                    del self._departments[department]
+                    self._versions.pop(department, None)
+                    logger.info(f"🗂️ [MEM-INDEX] Dropped {department} (no indexed document)")
+
+            for department, version in versions.items():
+                if self._versions.get(department) == version:
+                    continue
+                t0 = time.monotonic()
+                try:
+                    self._departments[department] = self._load(department, version)
+                except Exception as e:
+                    logger.error(f"🗂️ [MEM-INDEX] Could not load {department}: {e}")
+                    continue
+                self._versions[department] = version
+                self.reloads += 1
+                logger.info(
+                    f"🗂️ [MEM-INDEX] Loaded {department}: "
+                    f"chunks={len(self._departments[department].ids)} "
+                    f"({int((time.monotonic() - t0) * 1000)}ms)"
+                )
+
+    def _snapshot_base(self, department: str, version: str) -> str:
+        digest = hashlib.sha1(version.encode()).hexdigest()[:16]
+        return os.path.join(self.index_dir, f"{department}-{digest}")
+
+    def _load(self, department: str, version: str) -> DepartmentIndex:
+        base = self._snapshot_base(department, version)
+        if not (os.path.exists(base + ".npy") and os.path.exists(base + ".json")):
+            self._write_snapshot(department, base)
+
+        with open(base + ".json", encoding="utf-8") as f:
+            meta = json.load(f)
+        matrix = np.load(base + ".npy", mmap_mode="r")
+        return DepartmentIndex(
+            ids=meta["ids"],
+            parent_ids=meta["parent_ids"],
+            page_numbers=meta["page_numbers"],
+            contents=meta["contents"],
+            matrix=matrix,
+            parents=meta["parents"],
+        )
+
+    def _write_snapshot(self, department: str, base: str) -> None:
+        title = self.dept_to_title.get(department, department)
+        with self._get_pool().connection() as conn:
+            children = conn.execute(CHILD_ROWS_SQL, (title,)).fetchall()
+            parents = conn.execute(PARENT_ROWS_SQL, (title,)).fetchall()
+
+        if children:
+            matrix = DepartmentIndex.normalize_rows(np.stack([parse_vector(row[4]) for row in children]))
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        meta = {
+            "ids": [row[0] for row in children],
+            "parent_ids": [row[1] for row in children],
+            "page_numbers": [row[2] for row in children],
+            "contents": [row[3] for row in children],
+            "parents": {row[0]: row[1] for row in parents},
+        }
+
+        # Write to temp files then rename, so concurrent workers never map a partial file
+        os.makedirs(self.index_dir, exist_ok=True)
+        tmp = f"{base}.{os.getpid()}.tmp"
+        np.save(tmp + ".npy", matrix)
+        with open(tmp + ".json", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp + ".npy", base + ".npy")
+        os.replace(tmp + ".json", base + ".json")
+
+    def stats(self) -> dict:
+        return {
+            "departments": {d: len(idx.ids) for d, idx in self._departments.items()},
+            "reloads": self.reloads,
+        }
@@ -0,0 +1,68 @@
+"""
+RAG Stage Timing — per-stage latency collection for the retrieval pipeline.
+
+Stages are wrapped with `with stage("embed"): ...`. Every stage is
+observed in the chatbot_rag_stage_seconds histogram (app/metrics.py),
+labelled with the department set by rag_department() at the retrieval
+entry points. Per-request timings are only collected when the caller
+opened a collection with collect_stage_timings(). Inside a sampled trace
+(app/tracing.py) every stage is also a span ("rag.<stage>") under the
+retrieval tool's span.
+
+Stage names: semantic_cache, expand_llm, embed, search (SQL or in-memory
+index), parents, rerank.
+
+The collector dict lives in a ContextVar: asyncio.to_thread copies the
+context automatically; work submitted to a ThreadPoolExecutor must be wrapped
+with contextvars.copy_context().run to report into the same collector.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from .metrics import record_rag_stage
+from .tracing import span
+
+_stage_timings: ContextVar[Optional[dict]] = ContextVar("rag_stage_timings", default=None)
+_department: ContextVar[Optional[str]] = ContextVar("rag_department", default=None)
+
+# Span kind per stage (tracing.py); the rest are "internal"
+STAGE_SPAN_KINDS = {"search": "db", "parents": "db", "expand_llm": "llm", "embed": "llm"}
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Record the wall time of the block (metrics and the active collector, if any)."""
+    with span(f"rag.{name}", kind=STAGE_SPAN_KINDS.get(name, "internal")):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            record_rag_stage(name, _department.get(), elapsed)
+            timings = _stage_timings.get()
+            if timings is not None:
+                timings[name] = timings.get(name, 0.0) + elapsed * 1000
+
+
+@contextmanager
+def rag_department(department: str) -> Iterator[None]:
+    """Label the stages run inside the block with their department."""
+    token = _department.set(department)
+    try:
+        yield
+    finally:
+        _department.reset(token)
+
+
+@contextmanager
+def collect_stage_timings() -> Iterator[dict]:
+    """Collect {stage: ms} for everything run inside the block."""
+    timings: dict = {}
+    token = _stage_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _stage_timings.reset(token)
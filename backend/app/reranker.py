@@ -0,0 +1,374 @@
+"""
+Re-Rankers — pluggable second-stage ordering of hybrid-search candidates.
+
+Implements:
+1. Reranker: abstract base with a strict latency budget. score() gets the
+   deadline and stops at it; if scoring fails or runs out of budget, the
+   candidates keep their RRF order.
+2. FeatureReranker: local CPU scorer (a few microseconds per chunk), a
+   linear model over:
+     - bm25:        BM25 of the query against the candidate pool
+     - overlap:     share of query terms present in the chunk
+     - proximity:   how tightly the matched terms cluster in the chunk
+     - vec_score:   cosine similarity from the vector search
+     - rrf:         RRF score relative to the best candidate
+     - label_match: share of query terms in the enrichment label
+                    ("[Crédito > Requisitos] ..." from preprocessing_service)
+   Weights are loaded from RERANK_WEIGHTS_PATH (JSON) and fit offline with
+   script_fit_reranker.py from logged queries (RERANK_LOG_PATH). The
+   built-in DEFAULT_WEIGHTS are hand-set, not fitted, which is why
+   RERANKER defaults to none (rag.py).
+3. GeminiReranker: the original LLM-as-judge ranking, with one shared
+   client. The call runs on a worker thread and is abandoned at the
+   deadline, so a slow response never holds the turn.
+
+Configuration (environment):
+    RERANK_BUDGET_MS      Latency budget of the local reranker (default 25)
+    RERANK_LLM_BUDGET_MS  Latency budget of the Gemini reranker (default 3000)
+    RERANK_WEIGHTS_PATH   JSON weights produced by script_fit_reranker.py
+    RERANK_LOG_PATH       Append candidates of every rerank call as JSONL
+                          (training data for script_fit_reranker.py)
+"""
+
+import os
+import re
+import json
+import math
+import time
+import logging
+import threading
+import contextvars
+from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Optional
+
+import numpy as np
+
+from .rag_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "25"))
+RERANK_LLM_BUDGET_MS = float(os.getenv("RERANK_LLM_BUDGET_MS", "3000"))
+RERANK_WEIGHTS_PATH = os.getenv("RERANK_WEIGHTS_PATH")
+RERANK_LOG_PATH = os.getenv("RERANK_LOG_PATH")
+
+FEATURES = ["bm25", "overlap", "proximity", "vec_score", "rrf", "label_match"]
+
+# Hand-set starting point, never fitted: RRF order dominates, lexical evidence breaks ties.
+DEFAULT_WEIGHTS = {
+    "bias": 0.0,
+    "weights": {
+        "bm25": 0.6,
+        "overlap": 0.8,
+        "proximity": 0.4,
+        "vec_score": 1.0,
+        "rrf": 2.0,
+        "label_match": 0.6,
+    },
+}
+
+_LABEL_RE = re.compile(r"^\s*\[([^\]]{1,200})\]")
+
+
+class RerankBudgetExceeded(Exception):
+    pass
+
+
+class Reranker(ABC):
+    """Base class: subclasses implement score(); rerank() enforces the budget."""
+
+    name = "base"
+
+    def __init__(self, budget_ms: float):
+        self.budget_ms = budget_ms
+        self.calls = 0
+        self.fallbacks = 0
+        self.budget_exceeded = 0
+        self.total_ms = 0.0
+        self._log_lock = threading.Lock()
+
+    @abstractmethod
+    def score(self, query: str, chunks: list[dict], deadline: float) -> list[float]:
+        """
+        One score per chunk (higher is better). deadline is a time.perf_counter()
+        value; raise RerankBudgetExceeded instead of working past it.
+        """
+
+    def rerank(self, query: str, chunks: list[dict], top_k: int) -> list[dict]:
+        if len(chunks) <= top_k:
+            return chunks  # No need to re-rank if fewer than top_k
+
+        self.calls += 1
+        started = time.perf_counter()
+        deadline = started + self.budget_ms / 1000
+        try:
+            scores = self.score(query, chunks, deadline)
+            if time.perf_counter() > deadline:
+                raise RerankBudgetExceeded(f"{(time.perf_counter() - started) * 1000:.1f}ms")
+        except RerankBudgetExceeded as e:
+            self.budget_exceeded += 1
+            self.fallbacks += 1
+            logger.warning(f"📊 [RERANK] {self.name} over budget ({e} > {self.budget_ms:.0f}ms). Using RRF order.")
+            return chunks[:top_k]
+        except Exception as e:
+            self.fallbacks += 1
+            logger.warning(f"📊 [RERANK] {self.name} failed: {e}. Using RRF order.")
+            return chunks[:top_k]
+        finally:
+            self.total_ms += (time.perf_counter() - started) * 1000
+
+        order = sorted(range(len(chunks)), key=lambda i: (-scores[i], i))
+        self._log_call(query, chunks, order[:top_k])
+        logger.info(
+            f"📊 [RERANK] {self.name}: reordered {len(chunks)} → {top_k} chunks. "
+            f"Order: {[i + 1 for i in order[:top_k]]}"
+        )
+        return [chunks[i] for i in order[:top_k]]
+
+    def _log_call(self, query: str, chunks: list[dict], selected: list[int]) -> None:
+        """Append the call to RERANK_LOG_PATH (training data for the feature model)."""
+        if not RERANK_LOG_PATH:
+            return
+        record = {
+            "query": query,
+            "reranker": self.name,
+            "selected": selected,
+            "candidates": [
+                {
+                    "id": str(c.get("id")),
+                    "content": c["content"],
+                    "vec_score": c.get("vec_score", 0.0),
+                    "fts_score": c.get("fts_score", 0.0),
+                    "rrf_score": c.get("rrf_score", 0.0),
+                }
+                for c in chunks
+            ],
+        }
+        try:
+            with self._log_lock, open(RERANK_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.warning(f"📊 [RERANK] Could not write rerank log: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "reranker": self.name,
+            "calls": self.calls,
+            "fallbacks": self.fallbacks,
+            "budget_exceeded": self.budget_exceeded,
+            "avg_ms": round(self.total_ms / self.calls, 2) if self.calls else 0.0,
+        }
+
+
+# --- Local feature-based reranker ---
+
+def _min_window(positions: dict[str, list[int]]) -> int:
+    """Length of the shortest token window containing every matched term."""
+    events = sorted((pos, term) for term, plist in positions.items() for pos in plist)
+    need = len(positions)
+    counts: Counter = Counter()
+    have = 0
+    best = math.inf
+    left = 0
+    for pos, term in events:
+        counts[term] += 1
+        if counts[term] == 1:
+            have += 1
+        while have == need:
+            best = min(best, pos - events[left][0] + 1)
+            left_term = events[left][1]
+            counts[left_term] -= 1
+            if counts[left_term] == 0:
+                have -= 1
+            left += 1
+    return int(best)
+
+
+def extract_features(query: str, chunks: list[dict], deadline: Optional[float] = None) -> np.ndarray:
+    """
+    Feature matrix (len(chunks) × len(FEATURES)), see module docstring.
+    Raises RerankBudgetExceeded once time.perf_counter() passes deadline.
+    """
+    q_terms = set(tokenize(query))
+    docs = [tokenize(c["content"]) for c in chunks]
+    n = len(chunks)
+    max_rrf = max((c.get("rrf_score", 0.0) for c in chunks), default=0.0) or 1.0
+
+    # BM25 over the candidate pool (idf from the candidates themselves)
+    doc_freq = Counter(t for tokens in docs for t in set(tokens) & q_terms)
+    avgdl = (sum(len(d) for d in docs) / n) if n else 1.0
+    features = np.zeros((n, len(FEATURES)), dtype=np.float32)
+
+    for i, (chunk, tokens) in enumerate(zip(chunks, docs)):
+        if deadline is not None and time.perf_counter() > deadline:
+            raise RerankBudgetExceeded(f"features stopped at chunk {i}/{n}")
+        tf = Counter(tokens)
+        bm25 = 0.0
+        for term in q_terms:
+            if tf[term]:
+                idf = math.log(1 + (n - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+                norm = 1.2 * (1 - 0.75 + 0.75 * len(tokens) / (avgdl or 1.0))
+                bm25 += idf * tf[term] * 2.2 / (tf[term] + norm)
+
+        matched = {t for t in q_terms if tf[t]}
+        overlap = len(matched) / len(q_terms) if q_terms else 0.0
+
+        proximity = 0.0
+        if len(matched) > 1:
+            positions = {t: [] for t in matched}
+            for pos, token in enumerate(tokens):
+                if token in positions:
+                    positions[token].append(pos)
+            proximity = len(matched) / _min_window(positions)
+        elif matched:
+            proximity = 1.0
+
+        label = _LABEL_RE.match(chunk["content"])
+        label_terms = set(tokenize(label.group(1))) if label else set()
+        label_match = len(q_terms & label_terms) / len(q_terms) if q_terms else 0.0
+
+        features[i] = (
+            bm25,
+            overlap,
+            proximity,
+            chunk.get("vec_score", 0.0),
+            chunk.get("rrf_score", 0.0) / max_rrf,
+            label_match,
+        )
+
+    # Scale BM25 to [0, 1] within the pool so weights transfer across queries
+    max_bm25 = features[:, 0].max() if n else 0.0
+    if max_bm25 > 0:
+        features[:, 0] /= max_bm25
+    return features
+
+
+class FeatureReranker(Reranker):
+    """Linear model over extract_features(); runs in-process on CPU."""
+
+    name = "feature"
+
+    def __init__(self, budget_ms: float = RERANK_BUDGET_MS, weights_path: Optional[str] = RERANK_WEIGHTS_PATH):
+        super().__init__(budget_ms)
+        model = DEFAULT_WEIGHTS
+        if not weights_path:
+            logger.warning("📊 [RERANK] No RERANK_WEIGHTS_PATH: using hand-set, unfitted weights")
+        else:
+            try:
+                with open(weights_path, encoding="utf-8") as f:
+                    model = json.load(f)
+                logger.info(f"📊 [RERANK] Loaded feature weights from {weights_path}")
+            except (OSError, ValueError) as e:
+                logger.warning(f"📊 [RERANK] Could not load weights {weights_path}: {e}. Using defaults.")
+        self.bias = float(model.get("bias", 0.0))
+        self.weights = np.array([model["weights"].get(f, 0.0) for f in FEATURES], dtype=np.float32)
+
+    def score(self, query: str, chunks: list[dict], deadline: float) -> list[float]:
+        features = extract_features(query, chunks, deadline)
+        return (features @ self.weights + self.bias).tolist()
+
+
+def fit_weights(examples: list[tuple[str, list[dict], set[int]]], epochs: int = 500, lr: float = 0.5, l2: float = 1e-3) -> dict:
+    """
+    Fit FeatureReranker weights by logistic regression (numpy, full batch).
+
+    examples: (query, candidate chunks, indices of the relevant candidates).
+    Returns the JSON-serializable model loaded through RERANK_WEIGHTS_PATH.
+    """
+    X = np.concatenate([extract_features(q, chunks) for q, chunks, _ in examples])
+    y = np.concatenate([
+        np.array([1.0 if i in relevant else 0.0 for i in range(len(chunks))], dtype=np.float32)
+        for _, chunks, relevant in examples
+    ])
+
+    w = np.zeros(X.shape[1], dtype=np.float64)
+    b = 0.0
+    pos_weight = (len(y) - y.sum()) / max(y.sum(), 1.0)  # Balance the rare positives
+    sample_weight = np.where(y == 1, pos_weight, 1.0)
+    for _ in range(epochs):
+        p = 1 / (1 + np.exp(-(X @ w + b)))
+        grad = sample_weight * (p - y)
+        w -= lr * (X.T @ grad / len(y) + l2 * w)
+        b -= lr * grad.mean()
+
+    return {
+        "bias": round(float(b), 6),
+        "weights": {f: round(float(v), 6) for f, v in zip(FEATURES, w)},
+        "trained_on": int(len(examples)),
+    }
+
+
+# --- Gemini (LLM-as-judge) reranker ---
+
+class GeminiReranker(Reranker):
+    """Asks Gemini for the most relevant fragments (one shared client)."""
+
+    name = "gemini"
+
+    def __init__(self, budget_ms: float = RERANK_LLM_BUDGET_MS, model: str = "gemini-3.1-flash-lite-preview"):
+        super().__init__(budget_ms)
+        self.model = model
+        self._llm = None
+        # Calls past the deadline are abandoned here; the client timeout ends them
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rerank")
+
+    def _get_llm(self):
+        if self._llm is None:
+            from .llm_providers import get_chat_model
+            self._llm = get_chat_model(
+                self.model, role="rerank", temperature=0, timeout=self.budget_ms / 1000, max_retries=0
+            )
+        return self._llm
+
+    def score(self, query: str, chunks: list[dict], deadline: float) -> list[float]:
+        numbered_chunks = "\n\n".join([
+            f"[{i+1}] {c['content'][:500]}" for i, c in enumerate(chunks)
+        ])
+        prompt = (
+            f"Eres un evaluador de relevancia para un chatbot de COOTRADECUN (cooperativa colombiana). "
+            f"Dada la pregunta del usuario y los fragmentos de documentos, ordena los fragmentos "
+            f"de MÁS a MENOS relevante para responder la pregunta.\n\n"
+            f"Pregunta: {query}\n\n"
+            f"Fragmentos:\n{numbered_chunks}\n\n"
+            f"Responde SOLO con los números de los fragmentos más relevantes, "
+            f"ordenados de mayor a menor relevancia, separados por comas. "
+            f"Ejemplo: 3,1,5,2"
+        )
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            raise RerankBudgetExceeded("no budget left for the LLM call")
+        context = contextvars.copy_context()  # Keep the trace/metrics context on the worker
+        future = self._executor.submit(context.run, self._get_llm().invoke, prompt)
+        try:
+            response_text = future.result(timeout=remaining if math.isfinite(remaining) else None).content.strip()
+        except FutureTimeoutError:
+            future.cancel()
+            raise RerankBudgetExceeded(f"LLM call still running after {self.budget_ms:.0f}ms")
+
+        indices = []
+        for part in response_text.replace(" ", "").split(","):
+            try:
+                idx = int(part) - 1  # Convert 1-indexed to 0-indexed
+            except ValueError:
+                continue
+            if 0 <= idx < len(chunks) and idx not in indices:
+                indices.append(idx)
+        if not indices:
+            raise ValueError(f"could not parse ranking '{response_text}'")
+
+        # Ranked fragments first (in Gemini's order), the rest keep RRF order
+        scores = [-1.0] * len(chunks)
+        for position, idx in enumerate(indices):
+            scores[idx] = float(len(indices) - position)
+        return scores
+
+
+def create_reranker(kind: str) -> Optional[Reranker]:
+    """Factory for the RERANKER setting: 'feature', 'gemini' or 'none'."""
+    if kind == "feature":
+        return FeatureReranker()
+    if kind == "gemini":
+        return GeminiReranker()
+    return None
@@ -27,6 +27,7 @@ class MessageResponse(BaseModel):
     tokens_input: Optional[int] = None
     tokens_output: Optional[int] = None
     response_time_ms: Optional[int] = None
+    trace_id: Optional[str] = None
     created_at: Optional[datetime] = None
 
 
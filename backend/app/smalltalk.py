@@ -0,0 +1,187 @@
+"""
+Small-Talk Fast Path — canned replies for greetings, thanks and farewells.
+
+"hola", "gracias" or "buenos días" are a large share of WhatsApp traffic and
+used to cost a full graph turn (summarize + primary_assistant LLM call +
+one checkpoint write per node). When the WHOLE message is small talk, the
+caller answers from a per-tenant template set instead and appends the
+exchange to the thread's checkpoint with a single update_state, so the next
+turn sees the same history as if the graph had answered.
+
+A message qualifies only when nothing but small-talk phrases, fillers and
+punctuation/emojis remain: "hola, quiero info de Pedregal" goes to the graph.
+
+Templates: SMALLTALK_TEMPLATES below, keyed by lowercase tenant name with a
+"default" fallback. SMALLTALK_TEMPLATES_PATH points to a JSON file with the
+same shape; its tenants replace (per intent) the built-in ones.
+
+Config (env):
+    SMALLTALK_ENABLED=true
+    SMALLTALK_TEMPLATES_PATH=
+"""
+
+import os
+import re
+import json
+import random
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from .debug import aupdate_graph_state
+from .rag_index import fold
+
+logger = logging.getLogger(__name__)
+
+SMALLTALK_ENABLED = os.getenv("SMALLTALK_ENABLED", "true").lower() in ("true", "1", "yes")
+SMALLTALK_TEMPLATES_PATH = os.getenv("SMALLTALK_TEMPLATES_PATH", "")
+
+# Intents in priority order: "gracias, chao" is a farewell, not a thanks
+INTENTS = ("farewell", "thanks", "greeting")
+
+# Words that may accompany small talk without adding a request
+_FILLERS = r"\b(muy|muchas?|mil|tan|super|senor(a|ita)?|amig[oa]|bot|asistente|ok|okay|vale|listo|perfecto|bien|y|a|todos|usted(es)?|ti|que|tal|como|esta[s]?|le|te|por|todo|la|el)\b"
+
+# Patterns run on accent-folded lowercase text (see rag_index.fold)
+SMALLTALK_TEMPLATES = {
+    "default": {
+        "greeting": {
+            "patterns": [r"\bh+o+l+a+\b", r"\bbuen(os|as)? (dias?|tardes?|noches?)\b", r"\bbuenas\b",
+                         r"\bsaludos\b", r"\bhey\b", r"\bque mas\b"],
+            "responses": ["¡Hola{name}! 👋 ¿En qué te puedo ayudar?"],
+        },
+        "thanks": {
+            # "genial" / "excelente" are thanks only as the whole message ("excelente servicio" is not)
+            "patterns": [r"\bgracias\b", r"\bmuchas gracias\b", r"\bte agradezco\b", r"\bmil gracias\b",
+                         r"^\W*(genial|excelente)\W*$"],
+            "responses": ["¡Con gusto{name}! 😊 ¿Hay algo más en lo que te pueda ayudar?"],
+        },
+        "farewell": {
+            "patterns": [r"\bchao\b", r"\badios\b", r"\bhasta (luego|pronto|manana)\b", r"\bnos vemos\b",
+                         r"\bfeliz (dia|tarde|noche)\b", r"\bbye\b"],
+            "responses": ["¡Hasta pronto{name}! 👋"],
+        },
+    },
+    "cootradecun": {
+        "greeting": {
+            "responses": [
+                "¡Hola{name}! 👋 Soy el asistente virtual de COOTRADECUN. Puedo ayudarte con vivienda, "
+                "créditos, convenios, nóminas, cartera, tesorería, contabilidad y atención al asociado. "
+                "¿En qué te puedo ayudar hoy?",
+            ],
+        },
+        "thanks": {
+            "responses": [
+                "¡Con gusto{name}! 😊 Si tienes otra consulta sobre COOTRADECUN, aquí estoy.",
+                "¡Para servirte{name}! ¿Hay algo más en lo que te pueda ayudar?",
+            ],
+        },
+        "farewell": {
+            "responses": ["¡Hasta pronto{name}! 👋 Gracias por comunicarte con COOTRADECUN."],
+        },
+    },
+}
+
+
+@dataclass
+class SmallTalkReply:
+    intent: str
+    text: str
+
+
+def _load_templates() -> dict:
+    templates = {tenant: {intent: dict(spec) for intent, spec in intents.items()}
+                 for tenant, intents in SMALLTALK_TEMPLATES.items()}
+    if not SMALLTALK_TEMPLATES_PATH:
+        return templates
+    try:
+        with open(SMALLTALK_TEMPLATES_PATH, encoding="utf-8") as f:
+            overrides = json.load(f)
+        for tenant, intents in overrides.items():
+            for intent, spec in intents.items():
+                templates.setdefault(tenant.lower(), {}).setdefault(intent, {}).update(spec)
+    except Exception as e:
+        logger.warning(f"💬 [SMALLTALK] Could not read {SMALLTALK_TEMPLATES_PATH}, using built-in templates: {e}")
+    return templates
+
+
+class SmallTalkResponder:
+    """Matches whole-message small talk and renders the tenant's template."""
+
+    def __init__(self, templates: Optional[dict] = None):
+        self._templates = templates or _load_templates()
+        self._patterns: dict[str, dict[str, list[re.Pattern]]] = {}
+
+    def _spec(self, tenant: str, intent: str, key: str) -> list:
+        tenant_spec = self._templates.get(tenant, {}).get(intent, {})
+        return tenant_spec.get(key) or self._templates["default"][intent][key]
+
+    def _tenant_patterns(self, tenant: str) -> dict[str, list[re.Pattern]]:
+        if tenant not in self._patterns:
+            self._patterns[tenant] = {
+                intent: [re.compile(p) for p in self._spec(tenant, intent, "patterns")] for intent in INTENTS
+            }
+        return self._patterns[tenant]
+
+    def classify(self, text: str, tenant: str = "default") -> Optional[str]:
+        """Small-talk intent when the whole message is small talk, else None."""
+        folded = fold(text or "")
+        if not folded.strip() or len(folded) > 80:
+            return None
+        matched = []
+        remainder = folded
+        for intent, patterns in self._tenant_patterns(tenant.lower()).items():
+            for pattern in patterns:
+                if pattern.search(remainder):
+                    matched.append(intent)
+                    remainder = pattern.sub(" ", remainder)
+        if not matched:
+            return None
+        remainder = re.sub(_FILLERS, " ", remainder)
+        if re.search(r"\w", remainder):  # Something besides small talk: let the graph answer
+            return None
+        return next(intent for intent in INTENTS if intent in matched)
+
+    def reply(self, text: str, tenant: str = "default", name: Optional[str] = None) -> Optional[SmallTalkReply]:
+        intent = self.classify(text, tenant)
+        if intent is None:
+            return None
+        first_name = (name or "").split()[0] if name and name != "Usuario" else ""
+        template = random.choice(self._spec(tenant.lower(), intent, "responses"))
+        return SmallTalkReply(intent, template.format(name=f" {first_name}" if first_name else ""))
+
+
+smalltalk = SmallTalkResponder()
+
+
+async def answer_smalltalk(
+    graph,
+    config: dict,
+    text: str,
+    tenant: str = "default",
+    name: Optional[str] = None,
+) -> Optional[SmallTalkReply]:
+    """
+    Answer small talk without running the graph.
+
+    Appends the HumanMessage/AIMessage pair to the thread's checkpoint as if
+    primary_assistant had answered (so the next turn routes from END as
+    usual). Returns None when the message is not small talk or the fast path
+    is disabled; the caller then runs the graph.
+    """
+    if not SMALLTALK_ENABLED:
+        return None
+    result = smalltalk.reply(text, tenant, name)
+    if result is None:
+        return None
+
+    await aupdate_graph_state(
+        graph,
+        config,
+        {"messages": [HumanMessage(content=text), AIMessage(content=result.text)]},
+        as_node="primary_assistant",
+    )
+    logger.info(f"💬 [SMALLTALK] {result.intent} answered without LLM (tenant={tenant})")
+    return result
@@ -0,0 +1,122 @@
+"""
+Per-thread inbox: debounce, coalesce and serialize turns of one thread.
+
+WhatsApp users often send a burst of short messages ("hola", "quiero",
+"info de vivienda"). Without an inbox each one runs its own graph turn
+against the same thread, concurrently. Here every message of a thread is
+queued and a single worker per thread drains the queue:
+
+1. Debounce: the worker waits until no new message arrived for
+   INBOX_DEBOUNCE_MS (at most INBOX_MAX_WAIT_MS after the first one).
+   The wait is added to every reply, small talk included, so it is kept
+   short: long enough for a burst typed in quick succession.
+2. Coalesce: everything queued by then is processed as ONE turn.
+3. Order: batches run one after another; messages that arrive while a
+   turn is running form the next batch.
+
+Every submit() resolves with the result of the batch its message joined.
+The inbox is per process; the thread_locks (and, across instances, the
+checkpointer) still guard the checkpoint itself.
+
+Config (env):
+    INBOX_DEBOUNCE_MS=250      (0 = no debounce, only serialization)
+    INBOX_MAX_WAIT_MS=4000
+"""
+
+import os
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+INBOX_DEBOUNCE_MS = int(os.getenv("INBOX_DEBOUNCE_MS", "250"))
+INBOX_MAX_WAIT_MS = int(os.getenv("INBOX_MAX_WAIT_MS", "4000"))
+
+BatchProcessor = Callable[[list], Awaitable[Any]]
+
+
+@dataclass
+class _Entry:
+    item: Any
+    process: BatchProcessor
+    future: asyncio.Future
+    arrived: float = field(default_factory=time.monotonic)
+
+
+class ThreadInbox:
+    """Queues items per thread and hands them to their processor in batches."""
+
+    def __init__(self, debounce_ms: int = INBOX_DEBOUNCE_MS, max_wait_ms: int = INBOX_MAX_WAIT_MS):
+        self.debounce = debounce_ms / 1000
+        self.max_wait = max(max_wait_ms, debounce_ms) / 1000
+        self._pending: dict[str, list[_Entry]] = {}
+        self._workers: dict[str, asyncio.Task] = {}
+        self.messages = 0
+        self.batches = 0
+        self.coalesced = 0
+
+    async def submit(self, thread_id: str, item: Any, process: BatchProcessor) -> Any:
+        """
+        Queue item for thread_id; resolves with process(batch) of its batch.
+
+        process receives the items of the batch in arrival order. The
+        processor of the batch's first item runs the batch.
+        """
+        entry = _Entry(item, process, asyncio.get_running_loop().create_future())
+        self._pending.setdefault(thread_id, []).append(entry)
+        self.messages += 1
+        if thread_id not in self._workers:
+            self._workers[thread_id] = asyncio.create_task(self._drain(thread_id))
+        return await entry.future
+
+    async def _wait_for_quiet(self, thread_id: str) -> None:
+        while True:
+            pending = self._pending[thread_id]
+            deadline = min(pending[-1].arrived + self.debounce, pending[0].arrived + self.max_wait)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    async def _drain(self, thread_id: str) -> None:
+        try:
+            while self._pending.get(thread_id):
+                if self.debounce > 0:
+                    await self._wait_for_quiet(thread_id)
+                batch = self._pending.pop(thread_id)
+                self.batches += 1
+                self.coalesced += len(batch) - 1
+                if len(batch) > 1:
+                    logger.info(f"📥 [INBOX] thread={thread_id}: coalesced {len(batch)} messages into one turn")
+                try:
+                    result = await batch[0].process([entry.item for entry in batch])
+                except asyncio.CancelledError:
+                    for entry in batch:
+                        entry.future.cancel()
+                    raise
+                except Exception as e:
+                    for entry in batch:
+                        if not entry.future.done():
+                            entry.future.set_exception(e)
+                    continue
+                for entry in batch:
+                    if not entry.future.done():
+                        entry.future.set_result(result)
+        finally:
+            self._workers.pop(thread_id, None)
+            # Only left behind when the worker was cancelled (shutdown)
+            for entry in self._pending.pop(thread_id, []):
+                entry.future.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "debounce_ms": int(self.debounce * 1000),
+            "max_wait_ms": int(self.max_wait * 1000),
+            "messages": self.messages,
+            "turns": self.batches,
+            "coalesced": self.coalesced,
+            "active_threads": len(self._workers),
+        }
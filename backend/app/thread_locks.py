@@ -0,0 +1,245 @@
+"""
+Per-thread locks for checkpoint writers.
+
+A graph run and any out-of-band write to the same thread's checkpoint
+(small-talk update_state, deferred summarization) must not interleave: a
+run keeps its channels in memory and its next checkpoint would silently
+overwrite a concurrent update. Every writer takes thread_lock(thread_id).
+
+1. Local (always): one asyncio.Lock per thread_id in this process, dropped
+   when no longer referenced.
+2. Advisory (THREAD_LOCK_MODE=advisory): with several Cloud Run instances
+   behind Cloud Tasks, the same thread can also run on another instance.
+   The lock then also takes a PostgreSQL session advisory lock keyed by
+   thread_id (pg_try_advisory_lock, polled every THREAD_LOCK_POLL_MS for
+   up to THREAD_LOCK_WAIT_MS) on a connection of the checkpointer pool,
+   held until the turn ends. When the wait runs out ThreadBusyError is
+   raised and the caller requeues the work (see THREAD_LOCK_ON_BUSY in
+   whatsapp.py; /internal/process-chat answers 503 so Cloud Tasks retries).
+   At most THREAD_LOCK_MAX_CONNECTIONS pool connections hold locks at once
+   (default: half the pool), so the checkpointer itself is never starved.
+   Session locks need a dedicated server connection: with
+   DB_POOL_PROFILE=pgbouncer (transaction pooling) only local locks are used.
+
+thread_lock is reentrant within a task: a caller holding the lock for a
+whole turn can still call ainvoke_graph / aupdate_graph_state.
+Contention metrics: thread_lock_stats() (GET /locks/stats).
+
+Config (env):
+    THREAD_LOCK_MODE=local              (local | advisory)
+    THREAD_LOCK_WAIT_MS=10000
+    THREAD_LOCK_POLL_MS=250
+    THREAD_LOCK_MAX_CONNECTIONS=        (default: pool max_size // 2)
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import weakref
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Optional
+
+from psycopg_pool import AsyncConnectionPool
+
+from .db_pools import PGBOUNCER
+
+logger = logging.getLogger(__name__)
+
+THREAD_LOCK_MODE = os.getenv("THREAD_LOCK_MODE", "local").lower()
+THREAD_LOCK_WAIT_MS = int(os.getenv("THREAD_LOCK_WAIT_MS", "10000"))
+THREAD_LOCK_POLL_MS = int(os.getenv("THREAD_LOCK_POLL_MS", "250"))
+THREAD_LOCK_MAX_CONNECTIONS = os.getenv("THREAD_LOCK_MAX_CONNECTIONS", "")
+
+TRY_LOCK_SQL = "SELECT pg_try_advisory_lock(%s)"
+UNLOCK_SQL = "SELECT pg_advisory_unlock(%s)"
+
+_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+_held: ContextVar[frozenset] = ContextVar("held_thread_locks", default=frozenset())
+
+
+class ThreadBusyError(RuntimeError):
+    """The thread is running on another instance and the lock wait ran out."""
+
+
+def get_thread_lock(thread_id: str) -> asyncio.Lock:
+    lock = _locks.get(thread_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _locks[thread_id] = lock
+    return lock
+
+
+def advisory_key(thread_id: str) -> int:
+    """Signed 64-bit advisory lock key for a thread_id."""
+    return int.from_bytes(hashlib.blake2b(thread_id.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+# --- Distributed lock (PostgreSQL advisory locks) ---
+
+class AdvisoryLocks:
+    """Session advisory locks on the checkpointer pool (sync or async psycopg pool)."""
+
+    def __init__(self, wait_ms: int = THREAD_LOCK_WAIT_MS, poll_ms: int = THREAD_LOCK_POLL_MS):
+        self.wait = wait_ms / 1000
+        self.poll = poll_ms / 1000
+        self._pool = None
+        self._is_async = False
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.requeued = 0
+        self.wait_ms_total = 0
+        self.wait_ms_max = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._pool is not None
+
+    def configure(self, pool, max_connections: Optional[int] = None) -> None:
+        self._pool = pool
+        self._is_async = isinstance(pool, AsyncConnectionPool)
+        limit = max_connections or max(1, getattr(pool, "max_size", 2) // 2)
+        self._slots = asyncio.Semaphore(limit)
+        logger.info(f"🔒 [THREAD-LOCK] Advisory locks enabled (max {limit} connections, wait {int(self.wait * 1000)}ms)")
+
+    async def _getconn(self, timeout: float):
+        if self._is_async:
+            return await self._pool.getconn(timeout=timeout)
+        return await asyncio.to_thread(self._pool.getconn, timeout)
+
+    async def _putconn(self, conn) -> None:
+        if self._is_async:
+            await self._pool.putconn(conn)
+        else:
+            await asyncio.to_thread(self._pool.putconn, conn)
+
+    async def _execute(self, conn, sql: str, key: int) -> bool:
+        if self._is_async:
+            row = await (await conn.execute(sql, (key,))).fetchone()
+            await conn.commit()  # Session lock: do not stay idle in transaction
+        else:
+            def run():
+                row = conn.execute(sql, (key,)).fetchone()
+                conn.commit()
+                return row
+            row = await asyncio.to_thread(run)
+        return bool(row and row[0])
+
+    def _record_wait(self, started: float) -> None:
+        waited = int((time.monotonic() - started) * 1000)
+        self.wait_ms_total += waited
+        self.wait_ms_max = max(self.wait_ms_max, waited)
+
+    @asynccontextmanager
+    async def hold(self, thread_id: str) -> AsyncIterator[None]:
+        key = advisory_key(thread_id)
+        started = time.monotonic()
+        deadline = started + self.wait
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.wait)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise ThreadBusyError(f"No lock connection available for thread {thread_id}")
+        conn = None
+        try:
+            conn = await self._getconn(max(deadline - time.monotonic(), 0.1))
+            attempts = 0
+            while not await self._execute(conn, TRY_LOCK_SQL, key):
+                attempts += 1
+                if attempts == 1:
+                    self.contended += 1
+                    logger.info(f"🔒 [THREAD-LOCK] thread={thread_id} is running elsewhere, waiting")
+                if time.monotonic() + self.poll > deadline:
+                    self.timeouts += 1
+                    self._record_wait(started)
+                    raise ThreadBusyError(f"Thread {thread_id} is locked by another instance")
+                await asyncio.sleep(self.poll)
+            self.acquired += 1
+            self._record_wait(started)
+            try:
+                yield
+            finally:
+                try:
+                    await self._execute(conn, UNLOCK_SQL, key)
+                except Exception as e:
+                    # Closing the session releases its advisory locks
+                    logger.warning(f"🔒 [THREAD-LOCK] Unlock failed for thread={thread_id}, dropping connection: {e}")
+                    await _maybe_await(conn.close())
+        finally:
+            if conn is not None:
+                await self._putconn(conn)
+            self._slots.release()
+
+    def stats(self) -> dict:
+        return {
+            "mode": THREAD_LOCK_MODE,
+            "enabled": self.enabled,
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "timeouts": self.timeouts,
+            "requeued": self.requeued,
+            "wait_ms_avg": round(self.wait_ms_total / self.acquired, 1) if self.acquired else 0,
+            "wait_ms_max": self.wait_ms_max,
+        }
+
+
+async def _maybe_await(result) -> None:
+    if asyncio.iscoroutine(result):
+        await result
+
+
+advisory_locks = AdvisoryLocks()
+
+
+def configure_thread_locks(pool) -> None:
+    """Enable advisory locks on the checkpointer pool when THREAD_LOCK_MODE=advisory."""
+    if THREAD_LOCK_MODE != "advisory":
+        return
+    if pool is None:
+        logger.warning("🔒 [THREAD-LOCK] THREAD_LOCK_MODE=advisory needs the PostgreSQL checkpointer; using local locks")
+        return
+    if PGBOUNCER:
+        # pgbouncer hands the server connection to other clients between transactions
+        logger.warning("🔒 [THREAD-LOCK] Session advisory locks do not work with DB_POOL_PROFILE=pgbouncer; using local locks")
+        return
+    advisory_locks.configure(pool, int(THREAD_LOCK_MAX_CONNECTIONS) if THREAD_LOCK_MAX_CONNECTIONS else None)
+
+
+def thread_lock_stats() -> dict:
+    return advisory_locks.stats()
+
+
+@asynccontextmanager
+async def thread_lock(thread_id: str, distributed: bool = True) -> AsyncIterator[None]:
+    """
+    Serialize checkpoint writers of one thread (this process and, with
+    advisory locks, across instances). Raises ThreadBusyError when the
+    distributed lock cannot be taken within THREAD_LOCK_WAIT_MS.
+
+    distributed=False takes only the local lock (fallback after a
+    ThreadBusyError when requeueing is not possible).
+    """
+    # Keyed by task: tasks spawned while holding the lock inherit the context, not the lock
+    holder = (thread_id, asyncio.current_task())
+    held = _held.get()
+    if holder in held:  # Reentrant: the caller already holds it for this turn
+        yield
+        return
+    async with get_thread_lock(thread_id):
+        token = _held.set(held | {holder})
+        try:
+            if distributed and advisory_locks.enabled:
+                async with advisory_locks.hold(thread_id):
+                    yield
+            else:
+                yield
+        finally:
+            _held.reset(token)
+
+
+def thread_id_of(config: dict) -> str:
+    return (config or {}).get("configurable", {}).get("thread_id", "unknown")
@@ -0,0 +1,65 @@
+"""
+Incremental token counting for the graph's message history.
+
+count_tokens_approximately() stringifies every message it is given, so
+counting a whole thread on every turn (and again before/after summarizing)
+costs O(history). Instead the `messages` reducer of the graph State
+(add_messages_counted) stamps each message once, in its response_metadata
+(persisted with the checkpoint, never sent to the model):
+
+    token_count    approximate tokens of the message itself
+    tokens_through cumulative tokens of the thread up to this message
+
+so the size of the whole history is messages[-1]'s tokens_through (O(1))
+and any list of messages is counted by summing stamps (no re-tokenizing).
+Messages replaced or removed mid-history re-stamp the suffix after them;
+messages from checkpoints written before this module are stamped lazily.
+"""
+
+from typing import Iterable
+
+from langchain_core.messages import AnyMessage, BaseMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langgraph.graph.message import add_messages
+
+TOKEN_COUNT_KEY = "token_count"
+TOKENS_THROUGH_KEY = "tokens_through"
+
+
+def message_tokens(message: BaseMessage) -> int:
+    """Approximate token count of one message, computed once and cached on it."""
+    metadata = message.response_metadata
+    count = metadata.get(TOKEN_COUNT_KEY)
+    if count is None:
+        count = count_tokens_approximately([message])
+        metadata[TOKEN_COUNT_KEY] = count
+    return count
+
+
+def count_tokens_cached(messages: Iterable[BaseMessage]) -> int:
+    """Drop-in token_counter for SummarizationNode using the cached per-message counts."""
+    return sum(message_tokens(m) for m in messages)
+
+
+def history_tokens(messages: list[BaseMessage]) -> int:
+    """Tokens of a whole thread history stamped by add_messages_counted (O(1))."""
+    if not messages:
+        return 0
+    through = messages[-1].response_metadata.get(TOKENS_THROUGH_KEY)
+    return through if through is not None else count_tokens_cached(messages)
+
+
+def add_messages_counted(left: list[AnyMessage], right) -> list[AnyMessage]:
+    """add_messages reducer that also keeps the token stamps up to date."""
+    merged = add_messages(left, right)
+    # Unchanged prefix (same objects, same positions) keeps its stamps
+    start = 0
+    for old, new in zip(left if isinstance(left, list) else [], merged):
+        if old is not new or TOKENS_THROUGH_KEY not in new.response_metadata:
+            break
+        start += 1
+    running = merged[start - 1].response_metadata[TOKENS_THROUGH_KEY] if start else 0
+    for message in merged[start:]:
+        running += message_tokens(message)
+        message.response_metadata[TOKENS_THROUGH_KEY] = running
+    return merged
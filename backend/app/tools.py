@@ -1,5 +1,10 @@
+import os
+import time
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from typing import Annotated, Literal
-from langchain_core.tools import tool
+from langchain_core.tools import tool, StructuredTool
 from pydantic import BaseModel, Field
 from .rag import _invoke_retriever_with_logging
 import logging
@@ -65,24 +70,64 @@ class CompleteOrEscalate(BaseModel):
 # --- Retrieval Tools ---
 
 # Query expansion: Gemini generates alternative phrasings for broader retrieval
-from langchain_google_genai import ChatGoogleGenerativeAI
-from .rag import search_by_department, _hybrid_search, _rerank_chunks, _format_output, DEFAULT_K, RERANK_CANDIDATES, ENABLE_RERANK
+from langchain_core.language_models import BaseChatModel
+from .llm_providers import cache_namespace, get_chat_model
+from .rag import (
+    search_by_department, _hybrid_search, _hybrid_search_many, _rerank_chunks, _format_output,
+    _get_pool, query_embeddings, semantic_cache, fetch_chunks_by_ids,
+    DATABASE_URL, DEFAULT_K, RERANK_CANDIDATES, ENABLE_RERANK,
+)
+from .rag_timing import rag_department, stage
+from .history_compaction import retrieval_artifact, recovered_text
+from .rag_cache import (
+    ExpansionCache,
+    PostgresExpansionStore,
+    EXPANSION_CACHE_PERSIST,
+    EXPANSION_CACHE_TTL_SECONDS,
+)
 
 ENABLE_QUERY_EXPANSION = True
 
+# Speculative retrieval: search the original query while the expansion LLM
+# call is in flight; variants found before the deadline are merged in.
+SPECULATIVE_EXPANSION = os.getenv("SPECULATIVE_EXPANSION", "true").lower() in ("true", "1", "yes")
+EXPANSION_DEADLINE_MS = int(os.getenv("EXPANSION_DEADLINE_MS", "1500"))
 
-def _expand_query(query: str) -> list[str]:
+EXPANSION_MODEL = "gemini-3.1-flash-lite-preview"
+EXPANSION_PROMPT_VERSION = "v1"  # Bump when the prompt changes (invalidates the cache)
+
+expansion_cache = ExpansionCache(
+    model_name=cache_namespace(f"{EXPANSION_MODEL}:{EXPANSION_PROMPT_VERSION}"),
+    store=(
+        PostgresExpansionStore(_get_pool, ttl_seconds=EXPANSION_CACHE_TTL_SECONDS)
+        if DATABASE_URL and EXPANSION_CACHE_PERSIST else None
+    ),
+)
+
+_expansion_llm = None
+_expansion_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="query-expansion")
+
+
+def _get_expansion_llm() -> BaseChatModel:
+    """Lazily create one shared client for query expansion."""
+    global _expansion_llm
+    if _expansion_llm is None:
+        _expansion_llm = get_chat_model(EXPANSION_MODEL, role="expansion", temperature=0.3)
+    return _expansion_llm
+
+
+def _generate_expansions(query: str) -> list[str]:
     """
     Use Gemini to generate 2 alternative phrasings of the user's query.
     This helps retrieve chunks that may use different terminology.
-    
+
+    Successful expansions are cached by normalized query (memory +
+    PostgreSQL); _expanded_search reads the cache before calling this.
+
     Returns: list of 2-3 queries (original + alternatives)
     """
-    if not ENABLE_QUERY_EXPANSION:
-        return [query]
-    
     try:
-        llm = ChatGoogleGenerativeAI(model="gemini-3.1-flash-lite-preview", temperature=0.3)
+        llm = _get_expansion_llm()
         prompt = (
             f"Eres un asistente de búsqueda para COOTRADECUN (una cooperativa colombiana). "
             f"Genera exactamente 2 reformulaciones alternativas de la siguiente pregunta "
@@ -92,11 +137,14 @@ def _expand_query(query: str) -> list[str]:
             f"Responde SOLO con las 2 alternativas, una por línea, sin numeración ni viñetas."
         )
         
-        result = llm.invoke(prompt)
+        with stage("expand_llm"):
+            result = llm.invoke(prompt)
         alternatives = [
             line.strip() for line in result.content.strip().split("\n") 
             if line.strip()
         ][:2]  # Max 2 alternatives
+        if alternatives:
+            expansion_cache.put(query, alternatives)
         
         all_queries = [query] + alternatives
         logger.info(
@@ -110,93 +158,214 @@ def _expand_query(query: str) -> list[str]:
         return [query]
 
 
-def _invoke_retriever_with_expansion(department: str, query: str, k: int = DEFAULT_K) -> str:
+def _merge_by_rrf(*result_sets: list[dict], k: int) -> list[dict]:
     """
-    Full RAG pipeline with query expansion:
-    1. Expand query into 2-3 variants
-    2. Run hybrid search for each variant
-    3. Deduplicate candidates
-    4. Re-rank all candidates
-    5. Return top-k formatted results
+    Fuse result lists by summing RRF scores per retrieved text (context_id),
+    consistent with the per-variant sum of HYBRID_SEARCH_MANY_SQL.
     """
-    # Step 1: Expand query
-    queries = _expand_query(query)
-    
-    # Step 2: Hybrid search for each query
-    all_candidates = []
-    seen_ids = set()
-    
-    for q in queries:
-        chunks = _hybrid_search(q, department, k=RERANK_CANDIDATES)
+    merged = {}
+    for chunks in result_sets:
         for chunk in chunks:
-            if chunk["id"] not in seen_ids:
-                seen_ids.add(chunk["id"])
-                all_candidates.append(chunk)
+            kept = merged.get(chunk["context_id"])
+            if kept is None:
+                merged[chunk["context_id"]] = dict(chunk)
+                continue
+            kept["rrf_score"] += chunk["rrf_score"]
+            kept["vec_score"] = max(kept["vec_score"], chunk["vec_score"])
+            kept["fts_score"] = max(kept["fts_score"], chunk["fts_score"])
+            kept["child_ids"] = list(dict.fromkeys(kept.get("child_ids", []) + chunk.get("child_ids", [])))
+    return sorted(merged.values(), key=lambda c: c["rrf_score"], reverse=True)[:k]
+
+
+def _expanded_search(department: str, query: str) -> tuple[list[str], list[dict]]:
+    """
+    Expand the query and run the hybrid search for all variants.
+
+    With a cached expansion (or SPECULATIVE_EXPANSION off) all variants go
+    through one _hybrid_search_many call. Otherwise the expansion LLM call
+    runs on a worker thread while the original query is searched; if it
+    returns within EXPANSION_DEADLINE_MS the variants are searched and merged,
+    else the original-only results are used (the late expansion still lands
+    in the cache for the next query).
+    """
+    if not ENABLE_QUERY_EXPANSION:
+        return [query], _hybrid_search(query, department, k=RERANK_CANDIDATES)
+
+    cached = expansion_cache.get(query)
+    if cached is not None or not SPECULATIVE_EXPANSION:
+        queries = [query] + cached if cached is not None else _generate_expansions(query)
+        return queries, _hybrid_search_many(queries, department, k=RERANK_CANDIDATES)
+
+    started = time.monotonic()
+    # copy_context: the worker thread reports into the caller's stage timings
+    expansion = _expansion_executor.submit(contextvars.copy_context().run, _generate_expansions, query)
+    original = _hybrid_search(query, department, k=RERANK_CANDIDATES)
+
+    remaining = EXPANSION_DEADLINE_MS / 1000 - (time.monotonic() - started)
+    try:
+        queries = expansion.result(timeout=max(remaining, 0))
+    except FutureTimeoutError:
+        logger.info(
+            f"🔍 [EXPAND] Deadline {EXPANSION_DEADLINE_MS}ms exceeded for '{query[:50]}...'. "
+            f"Using original-only results."
+        )
+        return [query], original
+
+    variants = queries[1:]
+    if not variants:
+        return queries, original
+    return queries, _merge_by_rrf(
+        original,
+        _hybrid_search_many(variants, department, k=RERANK_CANDIDATES),
+        k=RERANK_CANDIDATES,
+    )
+
+
+def _retrieve_with_expansion(department: str, query: str, k: int = DEFAULT_K) -> list[dict]:
+    """
+    Full RAG retrieval with query expansion:
+    0. Semantic cache lookup (skips steps 1-3 on a hit)
+    1. Expand query into 2-3 variants
+    2. Hybrid search for all variants in one round trip (one batched
+       embedding call, per-variant RRF summed; siblings already collapsed)
+    3. Re-rank all candidates → top-k chunks
+    """
+    # Step 0: Semantic cache — a similar query was answered recently
+    cache_variant = f"expand:k={k}"
+    if semantic_cache is not None:
+        with stage("semantic_cache"):
+            query_vector = query_embeddings.embed_query(query)
+            cached = semantic_cache.lookup(department, query_vector, variant=cache_variant)
+        if cached is not None:
+            return cached
+
+    # Steps 1-2: Expand query and search all variants
+    queries, all_candidates = _expanded_search(department, query)
     
     if not all_candidates:
-        return "No se encontró información relevante."
+        return []
     
     # Step 3: Re-rank the combined pool using original query
     if ENABLE_RERANK and len(all_candidates) > k:
         final_chunks = _rerank_chunks(query, all_candidates, top_k=k)
     else:
-        # Sort by RRF score as fallback
-        all_candidates.sort(key=lambda c: c["rrf_score"], reverse=True)
+        # Already ordered by fused RRF score
         final_chunks = all_candidates[:k]
     
-    # Step 4: Format output
-    from .rag import DEPT_TO_TITLE
-    result = _format_output(final_chunks, department)
-    
+    if semantic_cache is not None:
+        semantic_cache.store(department, query_vector, final_chunks, variant=cache_variant)
+
     total_chars = sum(len(c["content"]) for c in final_chunks)
     logger.info(
         f"📚 [RAG+EXPAND] {department}: queries={len(queries)}, "
         f"total_candidates={len(all_candidates)}, final={len(final_chunks)}, "
         f"chars={total_chars}"
     )
-    
-    return result
+    return final_chunks
 
 
-@tool
-def consultar_atencion_asociado(query: str):
-    """Useful to answer questions about association requirements, benefits, auxiliaries, and agreements."""
-    return _invoke_retriever_with_expansion("atencion_asociado", query)
+def _invoke_retriever_with_expansion(department: str, query: str, k: int = DEFAULT_K) -> tuple[str, dict]:
+    """
+    _retrieve_with_expansion formatted with source attribution for the LLM,
+    plus the ToolMessage artifact used to compact it later (history_compaction.py).
+    """
+    with rag_department(department):
+        chunks = _retrieve_with_expansion(department, query, k)
+    return _format_output(chunks, department), retrieval_artifact(chunks, department)
 
-@tool
-def consultar_nominas(query: str):
-    """Useful to answer questions about payment slips, payment channels, and payroll deductions."""
-    return _invoke_retriever_with_expansion("nominas", query)
 
-@tool
-def consultar_vivienda(query: str):
-    """Useful to answer questions about housing projects, credits, and simulations."""
-    return _invoke_retriever_with_expansion("vivienda", query)
+async def _ainvoke_retriever_with_expansion(department: str, query: str, k: int = DEFAULT_K) -> tuple[str, dict]:
+    """
+    Async entry point for the retrieval tools (used by graph.ainvoke).
 
-@tool
-def consultar_convenios(query: str):
-    """Useful to answer questions about partner companies, commercial agreements, discounts, and benefits for associates."""
-    return _invoke_retriever_with_expansion("convenios", query)
+    The RAG pipeline talks to pgvector through the sync psycopg pool, so it
+    runs on a worker thread and the event loop keeps serving other turns.
+    """
+    return await asyncio.to_thread(_invoke_retriever_with_expansion, department, query, k)
 
-@tool
-def consultar_cartera(query: str):
-    """Useful to answer questions about loans, credits, debt status, payment plans, and portfolio management."""
-    return _invoke_retriever_with_expansion("cartera", query)
 
-@tool
-def consultar_contabilidad(query: str):
-    """Useful to answer questions about supplier registration, invoicing, withholdings, and accounting certificates."""
-    return _invoke_retriever_with_expansion("contabilidad", query)
+def _retrieval_tool(name: str, department: str, description: str) -> StructuredTool:
+    """Build a consultar_* tool with both sync and async implementations."""
+    def _run(query: str) -> tuple[str, dict]:
+        return _invoke_retriever_with_expansion(department, query)
 
-@tool
-def consultar_tesoreria(query: str):
-    """Useful to answer questions about payment methods, bank accounts, disbursement times, and correspondents."""
-    return _invoke_retriever_with_expansion("tesoreria", query)
+    async def _arun(query: str) -> tuple[str, dict]:
+        return await _ainvoke_retriever_with_expansion(department, query)
 
-@tool
-def consultar_credito(query: str):
-    """Useful to answer questions about credit types, loan requirements, credit simulation, and credit applications."""
-    return _invoke_retriever_with_expansion("credito", query)
+    return StructuredTool.from_function(
+        func=_run,
+        coroutine=_arun,
+        name=name,
+        description=description,
+        response_format="content_and_artifact",
+    )
+
+
+consultar_atencion_asociado = _retrieval_tool(
+    "consultar_atencion_asociado", "atencion_asociado",
+    "Useful to answer questions about association requirements, benefits, auxiliaries, and agreements.",
+)
+
+consultar_nominas = _retrieval_tool(
+    "consultar_nominas", "nominas",
+    "Useful to answer questions about payment slips, payment channels, and payroll deductions.",
+)
+
+consultar_vivienda = _retrieval_tool(
+    "consultar_vivienda", "vivienda",
+    "Useful to answer questions about housing projects, credits, and simulations.",
+)
+
+consultar_convenios = _retrieval_tool(
+    "consultar_convenios", "convenios",
+    "Useful to answer questions about partner companies, commercial agreements, discounts, and benefits for associates.",
+)
+
+consultar_cartera = _retrieval_tool(
+    "consultar_cartera", "cartera",
+    "Useful to answer questions about loans, credits, debt status, payment plans, and portfolio management.",
+)
+
+consultar_contabilidad = _retrieval_tool(
+    "consultar_contabilidad", "contabilidad",
+    "Useful to answer questions about supplier registration, invoicing, withholdings, and accounting certificates.",
+)
+
+consultar_tesoreria = _retrieval_tool(
+    "consultar_tesoreria", "tesoreria",
+    "Useful to answer questions about payment methods, bank accounts, disbursement times, and correspondents.",
+)
+
+consultar_credito = _retrieval_tool(
+    "consultar_credito", "credito",
+    "Useful to answer questions about credit types, loan requirements, credit simulation, and credit applications.",
+)
+
+
+def _recover_fragments(department: str, chunk_ids: list[str]) -> tuple[str, dict | None]:
+    """Recovered text plus the artifact that lets it be compacted again."""
+    try:
+        chunks = fetch_chunks_by_ids(chunk_ids, department)
+    except Exception as e:
+        logger.error(f"RAG: Error recovering fragments for {department}: {e}")
+        return f"Error retrieving information: {e}", None
+    return recovered_text(chunks), retrieval_artifact(chunks, department)
+
+
+async def _arecover_fragments(department: str, chunk_ids: list[str]) -> tuple[str, dict | None]:
+    return await asyncio.to_thread(_recover_fragments, department, chunk_ids)
+
+
+recuperar_fragmentos = StructuredTool.from_function(
+    func=_recover_fragments,
+    coroutine=_arecover_fragments,
+    name="recuperar_fragmentos",
+    description=(
+        "Recovers the full text of document fragments from an earlier, compacted search result "
+        "('[Resultado compactado]'). Pass the department and the fragment ids listed there."
+    ),
+    response_format="content_and_artifact",
+)
 
 
 # --- Transfer Tool for Certificates ---
@@ -0,0 +1,507 @@
+"""
+Tracing — per-turn traces with node, LLM, tool and DB spans.
+
+DEBUG_GRAPH only logs what each node returned; where a turn's seconds go
+(primary_assistant vs. the *_tools nodes vs. summarize vs. the
+checkpointer) was invisible. Tracing is cheap enough to stay on:
+
+1. Trace per turn: trace_turn / start_trace open a trace (trace_id in a
+   ContextVar, 32 hex chars like OpenTelemetry) with a root span.
+   TRACE_SAMPLE_RATE decides per turn whether spans are recorded; the
+   trace_id exists either way and is stored on the turn's conversations
+   rows (db_writer.persist_turn, save_conversation).
+2. Graph spans: traced_config(config) adds a LangChain callback handler to
+   the run (debug.ainvoke_graph). It opens one span for the graph, one per
+   node (langgraph_node), and nested spans for every chat model call
+   (model, tokens) and tool call.
+3. Code spans: span(name, kind) / @traced(name, kind) for everything else:
+   checkpointer reads/writes (checkpoint_cache.py), RAG stages
+   (rag_timing.stage), db_writer queries. The parent is the innermost open
+   span, or the LangChain run (node / tool) the code runs under.
+4. Export: finished spans go through a bounded queue to one background
+   thread, which appends them to TRACE_JSONL_PATH (one span per line) and
+   posts them as OTLP/HTTP JSON to TRACE_OTLP_ENDPOINT (an OpenTelemetry
+   collector, e.g. http://otel-collector:4318/v1/traces). A full queue
+   drops spans instead of blocking the turn. One summary line per turn is
+   logged (🧭 [TRACE]) with the time per node, LLM, tools and DB.
+
+Stats: tracing_stats() (GET /tracing/stats).
+
+Config (env):
+    TRACING_ENABLED=true
+    TRACE_SAMPLE_RATE=1.0
+    TRACE_JSONL_PATH=                   (empty: no JSONL sink)
+    TRACE_OTLP_ENDPOINT=                (empty: no OTLP export)
+    TRACE_OTLP_HEADERS=                 (k1=v1,k2=v2)
+    TRACE_SERVICE_NAME=chatbot-backend
+    TRACE_QUEUE_SIZE=10000
+"""
+
+import os
+import json
+import time
+import queue
+import random
+import asyncio
+import logging
+import functools
+import threading
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables.config import var_child_runnable_config
+
+logger = logging.getLogger(__name__)
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() in ("true", "1", "yes")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", "")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "")
+TRACE_OTLP_HEADERS = os.getenv("TRACE_OTLP_HEADERS", "")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "chatbot-backend")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+
+EXPORT_BATCH = 256
+EXPORT_INTERVAL_SECONDS = 2.0
+
+# OTLP SpanKind: llm / db calls leave the process, the rest is internal work
+_OTLP_CLIENT_KINDS = {"llm", "db"}
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, kind: str, parent_id: Optional[str], attributes: dict):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+    def set(self, **attributes) -> None:
+        self.attributes.update({k: v for k, v in attributes.items() if v is not None})
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        if self.end_ns:
+            return
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"[:300]
+        self.end_ns = time.time_ns()
+        self.trace.finished.append(self)
+        exporter.export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "duration_ms": round(self.duration_ms, 2),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Trace:
+    __slots__ = ("trace_id", "sampled", "root", "finished", "by_run")
+
+    def __init__(self, sampled: bool):
+        self.trace_id = uuid.uuid4().hex
+        self.sampled = sampled
+        self.root: Optional[Span] = None
+        self.finished: list[Span] = []
+        self.by_run: dict = {}  # LangChain run_id -> Span (own or inherited from the parent run)
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+# (span, LangChain run_id it was opened under)
+_current: ContextVar[Optional[tuple]] = ContextVar("current_span", default=None)
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _trace.get()
+    return trace.trace_id if trace else None
+
+
+def _current_run_id():
+    config = var_child_runnable_config.get()
+    callbacks = config.get("callbacks") if config else None
+    return getattr(callbacks, "parent_run_id", None)
+
+
+def _parent(trace: Trace) -> Optional[Span]:
+    """Innermost open span() when opened under the same LangChain run, else that run's span."""
+    run_id = _current_run_id()
+    current = _current.get()
+    current_span = current[0] if current is not None and current[0] is not None and current[0].trace is trace else None
+    if current_span is not None and current[1] == run_id:
+        return current_span
+    if run_id is not None and trace.by_run.get(run_id) is not None:
+        return trace.by_run[run_id]
+    return current_span or trace.root
+
+
+def _open(trace: Trace, name: str, kind: str, parent: Optional[Span], attributes: dict) -> Span:
+    return Span(trace, name, kind, parent.span_id if parent else None, {k: v for k, v in attributes.items() if v is not None})
+
+
+@contextmanager
+def start_trace(name: str, **attributes) -> Iterator[Optional[Trace]]:
+    """New trace for the block (one per turn); logs the per-turn summary at the end."""
+    if not TRACING_ENABLED:
+        yield None
+        return
+    trace = Trace(sampled=random.random() < TRACE_SAMPLE_RATE)
+    if trace.sampled:
+        trace.root = _open(trace, name, "turn", None, attributes)
+    token = _trace.set(trace)
+    current_token = _current.set((trace.root, _current_run_id()) if trace.root else None)
+    error = None
+    try:
+        yield trace
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current.reset(current_token)
+        _trace.reset(token)
+        if trace.root is not None:
+            trace.root.end(error)
+            _log_summary(trace)
+
+
+def trace_turn(name: str):
+    """Decorator: run an async function (one turn) inside its own trace."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with start_trace(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_attributes(**attributes) -> None:
+    """Attach attributes to the innermost open span (the turn's root by default)."""
+    trace = _trace.get()
+    if trace is None or not trace.sampled:
+        return
+    span = _parent(trace)
+    if span is not None:
+        span.set(**attributes)
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes) -> Iterator[Optional[Span]]:
+    """Span around the block; a no-op outside a sampled trace."""
+    trace = _trace.get()
+    if trace is None or not trace.sampled:
+        yield None
+        return
+    opened = _open(trace, name, kind, _parent(trace), attributes)
+    token = _current.set((opened, _current_run_id()))
+    error = None
+    try:
+        yield opened
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current.reset(token)
+        opened.end(error)
+
+
+def traced(name: str, kind: str = "internal"):
+    """Decorator form of span() for sync and async functions."""
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, kind):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, kind):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- LangChain / LangGraph callbacks ---
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """Graph, node, chat model and tool spans of one run."""
+
+    run_inline = True  # No executor hop per event
+
+    def __init__(self, trace: Trace, parent: Optional[Span]):
+        self.trace = trace
+        self.parent = parent
+
+    def _parent_of(self, parent_run_id) -> Optional[Span]:
+        if parent_run_id is None:
+            return self.parent
+        # A span() opened inside the parent run (e.g. rag.expand_llm in a tool) comes first
+        current = _current.get()
+        if current is not None and current[1] == parent_run_id and current[0] is not None and current[0].trace is self.trace:
+            return current[0]
+        return self.trace.by_run.get(parent_run_id, self.parent)
+
+    def _start(self, run_id, parent_run_id, name: str, kind: str, **attributes) -> None:
+        self.trace.by_run[run_id] = _open(self.trace, name, kind, self._parent_of(parent_run_id), attributes)
+
+    def _end(self, run_id, error: Optional[BaseException] = None, **attributes) -> None:
+        opened = self.trace.by_run.get(run_id)
+        if opened is None or opened.end_ns:
+            return
+        opened.set(**attributes)
+        opened.end(error)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs) -> None:
+        name = kwargs.get("name") or (serialized or {}).get("name", "")
+        node = (metadata or {}).get("langgraph_node")
+        parent = self._parent_of(parent_run_id)
+        if parent_run_id is None:
+            self._start(run_id, None, name or "graph", "graph")
+        elif node and name == node and not (parent is not None and parent.kind == "node" and parent.name == node):
+            self._start(run_id, parent_run_id, node, "node", step=(metadata or {}).get("langgraph_step"))
+        else:
+            # Inner runnables (a node's own callable included): children nest under the closest span
+            self.trace.by_run[run_id] = parent
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id, error)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs) -> None:
+        params = kwargs.get("invocation_params") or {}
+        model = (metadata or {}).get("ls_model_name") or params.get("model") or params.get("model_name")
+        self._start(run_id, parent_run_id, f"llm {model or 'chat_model'}", "llm", model=model, messages=len(messages[0]) if messages else 0)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, metadata=None, **kwargs) -> None:
+        model = (metadata or {}).get("ls_model_name")
+        self._start(run_id, parent_run_id, f"llm {model or 'llm'}", "llm", model=model)
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        usage = {}
+        try:
+            message = response.generations[0][0].message
+            usage = getattr(message, "usage_metadata", None) or {}
+        except (AttributeError, IndexError):
+            pass
+        self._end(
+            run_id,
+            tokens_in=usage.get("input_tokens"),
+            tokens_out=usage.get("output_tokens"),
+            tokens_cached=(usage.get("input_token_details") or {}).get("cache_read"),
+        )
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id, error)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs) -> None:
+        name = kwargs.get("name") or (serialized or {}).get("name", "tool")
+        self._start(run_id, parent_run_id, f"tool {name}", "tool", tool=name)
+
+    def on_tool_end(self, output, *, run_id, **kwargs) -> None:
+        self._end(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs) -> None:
+        self._end(run_id, error)
+
+
+def traced_config(config: dict) -> dict:
+    """config with the trace callback handler added (unchanged outside a sampled trace)."""
+    trace = _trace.get()
+    if trace is None or not trace.sampled:
+        return config
+    callbacks = config.get("callbacks")
+    if callbacks is not None and not isinstance(callbacks, list):
+        return config  # A CallbackManager set by the caller: leave it alone
+    handler = TraceCallbackHandler(trace, _parent(trace))
+    return {**config, "callbacks": [*(callbacks or []), handler]}
+
+
+# --- Export ---
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(s: Span) -> dict:
+    attributes = {**s.attributes, "chatbot.kind": s.kind}
+    otlp = {
+        "traceId": s.trace.trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        "kind": 3 if s.kind in _OTLP_CLIENT_KINDS else 1,
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items()],
+        "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+    }
+    if s.parent_id:
+        otlp["parentSpanId"] = s.parent_id
+    return otlp
+
+
+class SpanExporter:
+    """Bounded queue + one daemon thread writing JSONL and posting OTLP/HTTP JSON."""
+
+    def __init__(self, jsonl_path: str = TRACE_JSONL_PATH, otlp_endpoint: str = TRACE_OTLP_ENDPOINT, queue_size: int = TRACE_QUEUE_SIZE):
+        self.jsonl_path = jsonl_path
+        self.otlp_endpoint = otlp_endpoint
+        self.otlp_headers = dict(
+            pair.split("=", 1) for pair in TRACE_OTLP_HEADERS.split(",") if "=" in pair
+        )
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+        self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.jsonl_path or self.otlp_endpoint)
+
+    def export(self, s: Span) -> None:
+        if not self.enabled:
+            return
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(s)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self) -> None:
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                batch = [self._queue.get(timeout=EXPORT_INTERVAL_SECONDS)]
+            except queue.Empty:
+                continue
+            while len(batch) < EXPORT_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self._flush([s for s in batch if s is not None])
+            if stop:
+                return
+
+    def _flush(self, batch: list[Span]) -> None:
+        if not batch:
+            return
+        if self.jsonl_path:
+            try:
+                with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(s.to_dict(), ensure_ascii=False, default=str) + "\n" for s in batch)
+            except OSError as e:
+                self.failures += 1
+                logger.warning(f"🧭 [TRACE] JSONL export failed: {e}")
+        if self.otlp_endpoint:
+            import httpx
+            payload = {"resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": [_otlp_span(s) for s in batch]}],
+            }]}
+            try:
+                httpx.post(self.otlp_endpoint, json=payload, headers=self.otlp_headers, timeout=5.0).raise_for_status()
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"🧭 [TRACE] OTLP export failed ({len(batch)} spans): {e}")
+        self.exported += len(batch)
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        """Flush what is queued (call on app shutdown)."""
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        return {
+            "jsonl_path": self.jsonl_path or None,
+            "otlp_endpoint": self.otlp_endpoint or None,
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "queued": self._queue.qsize(),
+        }
+
+
+exporter = SpanExporter()
+
+
+# --- Per-turn summary ---
+
+_turns = 0
+_turn_ms_total = 0.0
+
+
+def _log_summary(trace: Trace) -> None:
+    global _turns, _turn_ms_total
+    root = trace.root
+    _turns += 1
+    _turn_ms_total += root.duration_ms
+    nodes: dict[str, float] = {}
+    by_kind: dict[str, list] = {"llm": [0.0, 0], "tool": [0.0, 0], "db": [0.0, 0]}
+    by_id = {s.span_id: s for s in trace.finished}
+    for s in trace.finished:
+        if s.kind == "node":
+            nodes[s.name] = nodes.get(s.name, 0.0) + s.duration_ms
+        elif s.kind in by_kind:
+            parent = by_id.get(s.parent_id)
+            if parent is not None and parent.kind == s.kind:
+                continue  # Already inside a span of its kind (e.g. the LLM call of rag.expand_llm)
+            by_kind[s.kind][0] += s.duration_ms
+            by_kind[s.kind][1] += 1
+    parts = [f"🧭 [TRACE] {trace.trace_id} {root.name} {root.duration_ms:.0f}ms"]
+    if nodes:
+        parts.append("nodes: " + ", ".join(f"{name}={ms:.0f}ms" for name, ms in nodes.items()))
+    parts.append(" ".join(f"{kind}={ms:.0f}ms×{n}" for kind, (ms, n) in by_kind.items() if n))
+    logger.info(" | ".join(p for p in parts if p))
+
+
+def tracing_stats() -> dict:
+    return {
+        "enabled": TRACING_ENABLED,
+        "sample_rate": TRACE_SAMPLE_RATE,
+        "turns": _turns,
+        "turn_ms_avg": round(_turn_ms_total / _turns, 1) if _turns else 0,
+        **exporter.stats(),
+    }
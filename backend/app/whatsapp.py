@@ -9,15 +9,31 @@ phone_number_id) are passed per-call instead of read from globals,
 allowing different bots to share this module.
 """
 
+import os
 import logging
 import time
+import functools
 from typing import Optional
 
 import httpx
 from langchain_core.messages import AIMessage, HumanMessage
 
+from .thread_inbox import ThreadInbox
+from .thread_locks import ThreadBusyError, advisory_locks, thread_lock
+from .metrics import observe_turn, record_reply, record_turn
+from .tracing import set_attributes, trace_turn
+
 logger = logging.getLogger(__name__)
 
+# When another instance holds the thread (THREAD_LOCK_MODE=advisory):
+#   requeue: re-enqueue the messages in Cloud Tasks after THREAD_LOCK_REQUEUE_DELAY_SECONDS
+#   proceed: run the turn with the local lock only (pre-lock behaviour)
+# Outside production (no Cloud Tasks) requeue falls back to proceed.
+THREAD_LOCK_ON_BUSY = os.getenv("THREAD_LOCK_ON_BUSY", "requeue").lower()
+THREAD_LOCK_REQUEUE_DELAY_SECONDS = int(os.getenv("THREAD_LOCK_REQUEUE_DELAY_SECONDS", "5"))
+
+COST_PER_OUTPUT_TOKEN_USD = 0.0000025  # Gemini Flash pricing
+
 
 # ── Fallback detection ───────────────────────────────────────────────
 
@@ -176,6 +192,10 @@ async def mark_as_read(
 # These are imported and registered in main.py so they can reference
 # the compiled graph (Cootradecun) or the simple LLM (Explouse).
 
+# Bursts of messages from one sender are answered as a single turn (see thread_inbox.py)
+whatsapp_inbox = ThreadInbox()
+
+
 async def handle_cootradecun(
     sender_phone: str,
     text: str,
@@ -188,19 +208,93 @@ async def handle_cootradecun(
     Process a Cootradecun message through the LangGraph multi-agent system.
     graph_with_memory is injected via functools.partial in main.py.
 
-    Single-write to the unified `conversations` table (v4.0 schema).
-    Also updates contacts and session stats.
-
-    Sessions span 24 hours — close_session is NOT called here anymore.
-    The session stays active until upsert_session detects a 24h gap on the next message.
+    The message is queued in whatsapp_inbox: messages of the same sender
+    that arrive within the debounce window are answered by ONE graph turn
+    (_process_cootradecun_turn), and turns of a thread run strictly in order.
     """
-    from .db_writer import (
-        upsert_contact, upsert_session, save_conversation,
-        update_session_stats, increment_contact_messages,
+    await whatsapp_inbox.submit(
+        f"wa-{sender_phone}",
+        {"text": text, "message_id": message_id, "sender_name": sender_name},
+        functools.partial(_process_cootradecun_locked, sender_phone, tenant, graph_with_memory),
     )
 
-    _COST_PER_OUTPUT_TOKEN = 0.0000025  # Gemini Flash pricing
 
+def _requeue_batch(sender_phone: str, tenant, batch: list[dict]) -> list[dict]:
+    """
+    Send the batch back to Cloud Tasks, delayed, one task per message.
+
+    Returns the messages that could NOT be requeued (empty when all were).
+    Requeued messages belong to their tasks from then on: the caller must
+    not process them as well, or they would be answered twice.
+    """
+    if os.getenv("ENVIRONMENT", "development") != "production":
+        return batch
+    from .cloud_tasks import enqueue_message
+    for i, m in enumerate(batch):
+        parsed = {
+            "sender": sender_phone,
+            "text": m["text"],
+            "message_id": m["message_id"],
+            "name": m["sender_name"],
+            "phone_number_id": tenant.phone_number_id,
+        }
+        if not enqueue_message(parsed, tenant.name, delay_seconds=THREAD_LOCK_REQUEUE_DELAY_SECONDS):
+            return batch[i:]
+    return []
+
+
+@trace_turn("whatsapp.turn")
+async def _process_cootradecun_locked(
+    sender_phone: str,
+    tenant,  # TenantConfig
+    graph_with_memory,
+    batch: list[dict],
+) -> None:
+    """
+    Hold the thread lock for the whole turn (side effects included), so a
+    turn is never started twice when the messages are requeued.
+    """
+    thread_id = f"wa-{sender_phone}"
+    set_attributes(thread_id=thread_id, tenant=tenant.name, messages=len(batch))
+    with observe_turn(tenant.name, "whatsapp"):
+        try:
+            async with thread_lock(thread_id):
+                return await _process_cootradecun_turn(sender_phone, tenant, graph_with_memory, batch)
+        except ThreadBusyError as e:
+            if THREAD_LOCK_ON_BUSY == "requeue":
+                remaining = _requeue_batch(sender_phone, tenant, batch)
+                if len(remaining) < len(batch):
+                    advisory_locks.requeued += 1
+                    logger.info(f"🔒 [THREAD-LOCK] {e}; requeued {len(batch) - len(remaining)} messages")
+                if not remaining:
+                    return None
+                batch = remaining  # Partial requeue: only the rest is answered here
+            logger.warning(f"🔒 [THREAD-LOCK] {e}; processing {len(batch)} messages with the local lock only")
+        async with thread_lock(thread_id, distributed=False):
+            return await _process_cootradecun_turn(sender_phone, tenant, graph_with_memory, batch)
+
+
+async def _process_cootradecun_turn(
+    sender_phone: str,
+    tenant,  # TenantConfig
+    graph_with_memory,
+    batch: list[dict],
+) -> None:
+    """
+    Answer a batch of coalesced messages (arrival order) with one graph turn.
+
+    The turn is written to the v4.0 schema after the reply is sent, in one
+    round trip (db_writer.persist_turn): contact, session, one user row per
+    WhatsApp message, one assistant row for the reply and the counters.
+    If the turn fails, only the user rows are written.
+
+    Sessions span 24 hours — close_session is NOT called here anymore.
+    The session stays active until persist_turn detects a 24h gap on the next message.
+    """
+    from .db_writer import persist_turn
+
+    text = "\n".join(m["text"] for m in batch)
+    sender_name = batch[-1]["sender_name"]
     thread_id = f"wa-{sender_phone}"
     config = {"configurable": {"thread_id": thread_id}}
     inputs = {"messages": [HumanMessage(content=text)]}
@@ -208,45 +302,41 @@ async def handle_cootradecun(
     logger.info(f"━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
     logger.info(f"📨 Nuevo mensaje → Cootradecun")
     logger.info(f"   De:      +{sender_phone} ({sender_name})")
-    logger.info(f"   Mensaje: {text[:120]}")
+    logger.info(f"   Mensaje: {text[:120]}" + (f" ({len(batch)} mensajes)" if len(batch) > 1 else ""))
     logger.info(f"━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
 
-    # ── v4.0: register contact and session BEFORE processing ─────────
-    contact_id = await upsert_contact(sender_phone, sender_name)
-    session_id_v4 = await upsert_session(contact_id, thread_id) if contact_id else None
-
+    persisted = False
     try:
-        await mark_as_read(message_id, tenant.phone_number_id, tenant.access_token)
+        for m in batch:
+            await mark_as_read(m["message_id"], tenant.phone_number_id, tenant.access_token)
 
-        # ── Save user message ────────────────────────────────────────
-        if session_id_v4:
-            await save_conversation(
-                session_id=session_id_v4,
-                role="user",
-                message=text,
-                user_phone=sender_phone,
-                user_name=sender_name,
-                wa_message_id=message_id,
-                tenant=tenant.name,
-            )
-
-        # ── Invoke the agent and measure latency ─────────────────────
-        from .debug import stream_graph_with_debug
+        # ── Small talk: canned reply, no graph run ───────────────────
+        from .debug import ainvoke_graph
+        from .smalltalk import answer_smalltalk
 
         t_start = time.monotonic()
-        final_state = stream_graph_with_debug(graph_with_memory, inputs, config)
-        elapsed_ms = int((time.monotonic() - t_start) * 1000)
-
-        messages = final_state.get("messages", [])
-        last_message = messages[-1] if messages else None
+        smalltalk_reply = await answer_smalltalk(
+            graph_with_memory, config, text, tenant=tenant.name, name=sender_name,
+        )
 
-        if isinstance(last_message, AIMessage) and last_message.content:
-            content = last_message.content
-            if isinstance(content, list):
-                content = content[0].get("text", "") if content else ""
-            response_text = content or "Lo siento, no pude generar una respuesta."
+        # ── Invoke the agent and measure latency ─────────────────────
+        if smalltalk_reply is not None:
+            final_state = {}
+            response_text = smalltalk_reply.text
         else:
-            response_text = "Lo siento, hubo un error procesando tu solicitud."
+            final_state = await ainvoke_graph(graph_with_memory, inputs, config)
+
+            messages = final_state.get("messages", [])
+            last_message = messages[-1] if messages else None
+
+            if isinstance(last_message, AIMessage) and last_message.content:
+                content = last_message.content
+                if isinstance(content, list):
+                    content = content[0].get("text", "") if content else ""
+                response_text = content or "Lo siento, no pude generar una respuesta."
+            else:
+                response_text = "Lo siento, hubo un error procesando tu solicitud."
+        elapsed_ms = int((time.monotonic() - t_start) * 1000)
 
         # ── Extract TOTAL token usage from accumulator ────────────────
         # _token_totals_by_thread tracks ALL LLM calls (routing + agent + tools),
@@ -262,52 +352,49 @@ async def handle_cootradecun(
             )
 
         bot_is_fallback = _is_fallback(response_text)
+        record_reply(tenant.name, bot_is_fallback)
 
         success = await send_text_message(
             sender_phone, response_text,
             tenant.phone_number_id, tenant.access_token,
         )
 
+        # ── Deferred summarization (SUMMARIZATION_MODE=deferred) ─────
+        if smalltalk_reply is None:
+            from .agent import summarize_in_background
+            summarize_in_background(graph_with_memory, config)
+
         # ── Extract intent from dialog_state ─────────────────────────
         dialog_state = final_state.get("dialog_state", [])
         detected_intent = dialog_state[-1] if dialog_state else None
-
-        # ── Save bot response ────────────────────────────────────────
-        if session_id_v4:
-            await save_conversation(
-                session_id=session_id_v4,
-                role="assistant",
-                message=response_text,
-                user_phone=sender_phone,
-                user_name=sender_name,
-                tenant=tenant.name,
-                detected_intent=detected_intent,
-                is_fallback=bot_is_fallback,
-                response_time_ms=elapsed_ms,
-                tokens_in=tokens_in or 0,
-                tokens_out=tokens_out or 0,
-            )
-
-            # ── Update session counters ───────────────────────────────
-            await update_session_stats(
-                session_id_v4,
-                user_messages_delta=1,
-                bot_messages_delta=1,
-                fallback_delta=1 if bot_is_fallback else 0,
-                primary_intent=detected_intent,
-                tokens_input_delta=tokens_in or 0,
-                tokens_output_delta=tokens_out or 0,
-                estimated_cost_delta=(tokens_out or 0) * _COST_PER_OUTPUT_TOKEN,
-            )
-
-        # ── Update contact message counter ────────────────────────────
-        await increment_contact_messages(sender_phone, count=2)
+        if smalltalk_reply is not None:
+            detected_intent = smalltalk_reply.intent
+
+        # ── Persist the turn (user rows, bot row, counters) ──────────
+        persisted = True
+        await persist_turn(
+            sender_phone, sender_name, thread_id,
+            batch,
+            response_text,
+            tenant=tenant.name,
+            detected_intent=detected_intent,
+            # Small-talk intents must not replace the session's department
+            primary_intent=None if smalltalk_reply is not None else detected_intent,
+            is_fallback=bot_is_fallback,
+            response_time_ms=elapsed_ms,
+            tokens_in=tokens_in,
+            tokens_out=tokens_out,
+            estimated_cost=(tokens_out or 0) * COST_PER_OUTPUT_TOKEN_USD,
+            resolved=detected_intent == "farewell",
+        )
 
         if success:
             logger.info(f"✅ [Cootradecun] Reply sent to ...{sender_phone[-4:]} ({elapsed_ms}ms)")
 
     except Exception as e:
         logger.error(f"❌ [Cootradecun] Error: {e}")
+        if not persisted:
+            await persist_turn(sender_phone, sender_name, thread_id, batch, tenant=tenant.name)
         try:
             await send_text_message(
                 sender_phone,
@@ -328,16 +415,14 @@ async def handle_explouse(
     """
     Process an Explouse message through the simple direct LLM bot.
 
-    Single-write to the unified `conversations` table (v4.0 schema).
+    The turn is written to the v4.0 schema after the reply is sent, in one
+    round trip (db_writer.persist_turn); only the user row if the turn fails.
 
     Sessions span 24 hours — close_session is NOT called here anymore.
-    The session stays active until upsert_session detects a 24h gap on the next message.
+    The session stays active until persist_turn detects a 24h gap on the next message.
     """
     from .explouse.bot import get_response
-    from .db_writer import (
-        upsert_contact, upsert_session, save_conversation,
-        update_session_stats, increment_contact_messages,
-    )
+    from .db_writer import persist_turn
 
     thread_id = f"wa-{sender_phone}"
 
@@ -347,66 +432,43 @@ async def handle_explouse(
     logger.info(f"   Mensaje: {text[:120]}")
     logger.info(f"━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
 
-    # ── v4.0: register contact and session BEFORE processing ─────────
-    contact_id = await upsert_contact(sender_phone, sender_name)
-    session_id_v4 = await upsert_session(contact_id, thread_id) if contact_id else None
-
+    user_messages = [{"text": text, "message_id": message_id}]
+    persisted = False
     try:
         await mark_as_read(message_id, tenant.phone_number_id, tenant.access_token)
 
-        # ── Save user message ────────────────────────────────────────
-        if session_id_v4:
-            await save_conversation(
-                session_id=session_id_v4,
-                role="user",
-                message=text,
-                user_phone=sender_phone,
-                user_name=sender_name,
-                wa_message_id=message_id,
-                tenant=tenant.name,
-            )
-
         # ── Invoke the bot and measure latency ───────────────────────
         t_start = time.monotonic()
         response_text = await get_response(text, thread_id=thread_id)
         elapsed_ms = int((time.monotonic() - t_start) * 1000)
 
         bot_is_fallback = _is_fallback(response_text)
+        record_turn(tenant.name, "whatsapp", elapsed_ms / 1000)
+        record_reply(tenant.name, bot_is_fallback)
 
         success = await send_text_message(
             sender_phone, response_text,
             tenant.phone_number_id, tenant.access_token,
         )
 
-        # ── Save bot response ────────────────────────────────────────
-        if session_id_v4:
-            await save_conversation(
-                session_id=session_id_v4,
-                role="assistant",
-                message=response_text,
-                user_phone=sender_phone,
-                user_name=sender_name,
-                tenant=tenant.name,
-                is_fallback=bot_is_fallback,
-                response_time_ms=elapsed_ms,
-            )
-
-            # ── Update session counters ───────────────────────────────
-            await update_session_stats(
-                session_id_v4,
-                user_messages_delta=1,
-                bot_messages_delta=1,
-                fallback_delta=1 if bot_is_fallback else 0,
-            )
-
-        # ── Update contact message counter ────────────────────────────
-        await increment_contact_messages(sender_phone, count=2)
+        # ── Persist the turn (user row, bot row, counters) ───────────
+        persisted = True
+        await persist_turn(
+            sender_phone, sender_name, thread_id,
+            user_messages,
+            response_text,
+            tenant=tenant.name,
+            is_fallback=bot_is_fallback,
+            response_time_ms=elapsed_ms,
+        )
 
         if success:
             logger.info(f"✅ [Explouse] Reply sent to ...{sender_phone[-4:]} ({elapsed_ms}ms)")
 
     except Exception as e:
         logger.error(f"❌ [Explouse] Error: {e}")
+        if not persisted:
+            await persist_turn(sender_phone, sender_name, thread_id, user_messages, tenant=tenant.name)
         try:
             await send_text_message(
                 sender_phone,
@@ -0,0 +1,17 @@
+-- ============================================================
+-- Tracing Migration — trace_id on conversations
+--
+-- Links every conversations row to the trace of the turn that
+-- wrote it (app/tracing.py; spans in TRACE_JSONL_PATH or the
+-- OTLP backend). db_writer writes the column; the backend also
+-- adds it on startup (database.COLUMN_MIGRATIONS), so only the
+-- index below strictly needs this script.
+--
+-- Safe to re-run (uses IF NOT EXISTS checks).
+-- ============================================================
+
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS trace_id VARCHAR(32);
+
+-- Look up the rows of a trace (and the trace of a row)
+CREATE INDEX IF NOT EXISTS ix_conversations_trace_id ON conversations(trace_id)
+WHERE trace_id IS NOT NULL;
@@ -0,0 +1,20 @@
+-- ============================================================
+-- Query-Embedding Cache — persistent tier for app/rag_cache.py
+--
+-- Stores query embeddings keyed by (model, normalized query) so
+-- warm entries survive restarts and are shared by all instances.
+--
+-- Safe to re-run (uses IF NOT EXISTS checks).
+-- ============================================================
+
+CREATE TABLE IF NOT EXISTS rag_embedding_cache (
+    model      TEXT NOT NULL,
+    query_key  TEXT NOT NULL,
+    embedding  REAL[] NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (model, query_key)
+);
+
+-- Used by periodic cleanup of expired entries:
+--   DELETE FROM rag_embedding_cache WHERE created_at < NOW() - INTERVAL '7 days';
+CREATE INDEX IF NOT EXISTS idx_rag_embedding_cache_created ON rag_embedding_cache(created_at);
@@ -0,0 +1,21 @@
+-- ============================================================
+-- Query-Expansion Cache — persistent tier for app/rag_cache.py
+--
+-- Stores the LLM-generated alternative phrasings of a query,
+-- keyed by (model + prompt version, normalized query), so the
+-- expansion call is skipped for queries seen before.
+--
+-- Safe to re-run (uses IF NOT EXISTS checks).
+-- ============================================================
+
+CREATE TABLE IF NOT EXISTS rag_query_expansion_cache (
+    model        TEXT NOT NULL,
+    query_key    TEXT NOT NULL,
+    alternatives TEXT[] NOT NULL,
+    created_at   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (model, query_key)
+);
+
+-- Used by periodic cleanup of expired entries:
+--   DELETE FROM rag_query_expansion_cache WHERE created_at < NOW() - INTERVAL '30 days';
+CREATE INDEX IF NOT EXISTS idx_rag_query_expansion_cache_created ON rag_query_expansion_cache(created_at);
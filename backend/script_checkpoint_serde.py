@@ -0,0 +1,288 @@
+"""
+Script del Serializador Comprimido de Checkpoints (app/checkpoint_serde.py).
+
+Tres modos:
+  - Benchmark (por defecto): toma una muestra de checkpoint_blobs y
+    checkpoint_writes, la serializa con el formato actual (msgpack) y con
+    msgpack+zstd, y reporta bytes ahorrados y el costo de (de)serialización
+    por fila y por turno (filas por turno estimadas con los checkpoints de
+    source=input). Sin DATABASE_URL usa como muestra el corpus de docs/.
+  - --train: entrena el diccionario zstd con el corpus de docs/ (chunks
+    con el mismo chunking de script_index.py, serializados como mensajes)
+    y, si hay DATABASE_URL, con una muestra de checkpoints guardados.
+    Se carga con CHECKPOINT_ZSTD_DICT_PATH.
+  - --migrate: reescribe comprimidas las filas legadas de checkpoint_blobs
+    y checkpoint_writes, en lotes de --batch filas (una transacción por
+    lote). Las filas legadas se siguen leyendo sin migrar. Es un paso sin
+    vuelta atrás, como CHECKPOINT_COMPRESSION=true: una versión anterior
+    del backend no puede leer las filas "+zstd". Ejecutarlo solo cuando ya
+    no se vaya a desplegar una versión sin app/checkpoint_serde.py.
+
+Uso:
+    python script_checkpoint_serde.py                        # Benchmark
+    python script_checkpoint_serde.py --sample 2000
+    python script_checkpoint_serde.py --train --out checkpoint_zstd.dict
+    python script_checkpoint_serde.py --train --size 65536
+    python script_checkpoint_serde.py --migrate --batch 500 --max-batches 20
+"""
+
+import os
+import sys
+import time
+import uuid
+import logging
+import psycopg
+from dotenv import load_dotenv
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+load_dotenv()  # Before the app imports: they read their settings from the environment
+
+from app.checkpoint_serde import (
+    DEFAULT_DICT_SIZE,
+    ZSTD_SUFFIX,
+    CompressedSerializer,
+    load_dictionaries,
+    train_dictionary,
+)
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+DEFAULT_SAMPLE = 1000
+DEFAULT_BATCH = 500
+
+# --- SQL ---
+
+TABLE_KEYS = {
+    "checkpoint_blobs": ("thread_id", "checkpoint_ns", "channel", "version"),
+    "checkpoint_writes": ("thread_id", "checkpoint_ns", "checkpoint_id", "task_id", "task_path", "idx"),
+}
+
+SAMPLE_SQL = {
+    table: f"SELECT type, blob FROM {table} WHERE blob IS NOT NULL ORDER BY random() LIMIT %s"
+    for table in TABLE_KEYS
+}
+
+# Rows written per turn: checkpoints with source=input start a turn
+TURN_STATS_SQL = """
+SELECT COUNT(*) FILTER (WHERE metadata->>'source' = 'input') AS turns,
+       (SELECT COUNT(*) FROM checkpoint_blobs) AS blobs,
+       (SELECT COUNT(*) FROM checkpoint_writes) AS writes
+FROM checkpoints
+"""
+
+LEGACY_PAGE_SQL = {
+    table: f"""
+SELECT {', '.join(keys)}, type, blob FROM {table}
+WHERE ({', '.join(keys)}) > ({', '.join(['%s'] * len(keys))})
+  AND blob IS NOT NULL AND type NOT LIKE '%%{ZSTD_SUFFIX}'
+ORDER BY {', '.join(keys)}
+LIMIT %s
+"""
+    for table, keys in TABLE_KEYS.items()
+}
+
+UPDATE_SQL = {
+    table: f"UPDATE {table} SET type = %s, blob = %s WHERE {' AND '.join(f'{k} = %s' for k in keys)}"
+    for table, keys in TABLE_KEYS.items()
+}
+
+
+def _int_arg(name: str, default):
+    if name not in sys.argv:
+        return default
+    idx = sys.argv.index(name)
+    if idx + 1 >= len(sys.argv) or not sys.argv[idx + 1].isdigit():
+        logger.error(f"{name} requires a number. Example: {name} 500")
+        sys.exit(1)
+    return int(sys.argv[idx + 1])
+
+
+def _str_arg(name: str, default):
+    if name not in sys.argv:
+        return default
+    idx = sys.argv.index(name)
+    if idx + 1 >= len(sys.argv):
+        logger.error(f"{name} requires a value")
+        sys.exit(1)
+    return sys.argv[idx + 1]
+
+
+# --- Samples ---
+
+def corpus_samples() -> list[tuple[str, bytes]]:
+    """docs/*.pdf as serialized retrieval turns (what the messages channel stores)."""
+    from script_index import DOCS_DIR, FILES_CONFIG, build_chunks
+    from app.rag import DEFAULT_K, _format_output
+
+    serde = JsonPlusSerializer()
+    samples = []
+    for filename, _, department in FILES_CONFIG:
+        parent_chunks, _ = build_chunks(os.path.join(DOCS_DIR, filename), department)
+        for i in range(0, len(parent_chunks), DEFAULT_K):
+            window = parent_chunks[i:i + DEFAULT_K]
+            call_id = f"call_{uuid.uuid4().hex[:24]}"
+            question = window[0]["content"].split("\n", 1)[0][:120]
+            turn = [
+                HumanMessage(content=question, id=str(uuid.uuid4())),
+                AIMessage(
+                    content="",
+                    tool_calls=[{"name": f"consultar_{department}", "args": {"query": question}, "id": call_id}],
+                    id=str(uuid.uuid4()),
+                ),
+                ToolMessage(
+                    content=_format_output(window, department),
+                    name=f"consultar_{department}",
+                    tool_call_id=call_id,
+                    id=str(uuid.uuid4()),
+                ),
+                AIMessage(content=window[0]["content"][:600], id=str(uuid.uuid4())),
+            ]
+            samples.append(serde.dumps_typed(turn))
+    logger.info(f"📚 Corpus: {len(samples)} samples from {len(FILES_CONFIG)} documents")
+    return samples
+
+
+def db_samples(conn, serde: CompressedSerializer, limit: int) -> dict[str, list[tuple[str, bytes]]]:
+    """Uncompressed (type, bytes) rows sampled from each table."""
+    samples = {}
+    for table in TABLE_KEYS:
+        rows = conn.execute(SAMPLE_SQL[table], (limit,)).fetchall()
+        samples[table] = [serde.decompress_typed((type_, bytes(blob))) for type_, blob in rows]
+        logger.info(f"📚 {table}: {len(samples[table])} sampled rows")
+    return samples
+
+
+# --- Modes ---
+
+def train(out_path: str, size: int) -> None:
+    samples = [payload for _, payload in corpus_samples()]
+    if DATABASE_URL:
+        with psycopg.connect(DATABASE_URL) as conn:
+            for rows in db_samples(conn, CompressedSerializer(dictionaries=load_dictionaries()), DEFAULT_SAMPLE).values():
+                samples.extend(payload for type_, payload in rows if type_ == "msgpack")
+    t0 = time.monotonic()
+    dictionary = train_dictionary(samples, size=size)
+    with open(out_path, "wb") as f:
+        f.write(dictionary.as_bytes())
+    logger.info(
+        f"✅ Dictionary id={dictionary.dict_id()} ({len(dictionary.as_bytes()) / 1024:.0f} KB) trained on "
+        f"{len(samples)} samples in {int((time.monotonic() - t0) * 1000)}ms → {out_path}"
+    )
+    logger.info(f"   Set CHECKPOINT_ZSTD_DICT_PATH={out_path} (keep older dictionaries listed after it)")
+
+
+def _measure(rows: list[tuple[str, bytes]], plain: JsonPlusSerializer, serde: CompressedSerializer) -> dict:
+    result = {"rows": 0, "before": 0, "after": 0, "plain_ms": 0.0, "zstd_ms": 0.0, "plain_load_ms": 0.0, "zstd_load_ms": 0.0}
+    for data in rows:
+        obj = plain.loads_typed(data)
+        t0 = time.perf_counter()
+        before = plain.dumps_typed(obj)
+        t1 = time.perf_counter()
+        after = serde.dumps_typed(obj)
+        t2 = time.perf_counter()
+        plain.loads_typed(before)
+        t3 = time.perf_counter()
+        serde.loads_typed(after)
+        t4 = time.perf_counter()
+        result["rows"] += 1
+        result["before"] += len(before[1])
+        result["after"] += len(after[1])
+        result["plain_ms"] += (t1 - t0) * 1000
+        result["zstd_ms"] += (t2 - t1) * 1000
+        result["plain_load_ms"] += (t3 - t2) * 1000
+        result["zstd_load_ms"] += (t4 - t3) * 1000
+    return result
+
+
+def _report(name: str, m: dict, rows_per_turn: float = None) -> None:
+    if not m["rows"]:
+        logger.info(f"   {name}: no rows")
+        return
+    n = m["rows"]
+    saved = 1 - m["after"] / m["before"] if m["before"] else 0
+    logger.info(
+        f"   {name}: {n} rows, {m['before'] / n / 1024:.1f} KB → {m['after'] / n / 1024:.1f} KB per row "
+        f"(-{saved:.0%}); dumps {m['plain_ms'] / n:.3f} → {m['zstd_ms'] / n:.3f} ms, "
+        f"loads {m['plain_load_ms'] / n:.3f} → {m['zstd_load_ms'] / n:.3f} ms"
+    )
+    if rows_per_turn:
+        logger.info(
+            f"   {name} per turn (~{rows_per_turn:.1f} rows): {m['before'] / n * rows_per_turn / 1024:.1f} KB → "
+            f"{m['after'] / n * rows_per_turn / 1024:.1f} KB, serialization "
+            f"+{(m['zstd_ms'] - m['plain_ms']) / n * rows_per_turn:.2f} ms"
+        )
+
+
+def benchmark(sample: int) -> None:
+    plain = JsonPlusSerializer()
+    serde = CompressedSerializer(dictionaries=load_dictionaries(), compress=True)
+    per_turn = {}
+    if DATABASE_URL:
+        with psycopg.connect(DATABASE_URL) as conn:
+            samples = db_samples(conn, serde, sample)
+            turns, blobs, writes = conn.execute(TURN_STATS_SQL).fetchone()
+        if turns:
+            per_turn = {"checkpoint_blobs": blobs / turns, "checkpoint_writes": writes / turns}
+    else:
+        logger.info("DATABASE_URL not configured: benchmarking on the docs/ corpus (optimistic with a dictionary trained on it)")
+        samples = {"corpus": corpus_samples()[:sample]}
+
+    logger.info("=" * 60)
+    logger.info(f"msgpack vs msgpack+zstd (level={serde.level}, dict_id={serde.dict_id or 'none'})")
+    for name, rows in samples.items():
+        _report(name, _measure(rows, plain, serde), per_turn.get(name))
+    logger.info("=" * 60)
+
+
+def migrate(batch: int, max_batches) -> None:
+    if not DATABASE_URL:
+        logger.error("DATABASE_URL not configured")
+        sys.exit(1)
+    serde = CompressedSerializer(dictionaries=load_dictionaries(), compress=True)
+    batches = 0
+    with psycopg.connect(DATABASE_URL) as conn:
+        for table, keys in TABLE_KEYS.items():
+            after = ("",) * (len(keys) - 1) + (("",) if table == "checkpoint_blobs" else (-(2 ** 31),))
+            rewritten = kept = before = saved = 0
+            while max_batches is None or batches < max_batches:
+                rows = conn.execute(LEGACY_PAGE_SQL[table], (*after, batch)).fetchall()
+                if not rows:
+                    break
+                after = rows[-1][:len(keys)]
+                updates = []
+                for row in rows:
+                    type_, payload = row[-2], bytes(row[-1])
+                    new_type, new_payload = serde.compress_typed((type_, payload))
+                    before += len(payload)
+                    if new_type == type_:
+                        kept += 1
+                        continue
+                    saved += len(payload) - len(new_payload)
+                    updates.append((new_type, new_payload, *row[:len(keys)]))
+                if updates:
+                    with conn.cursor() as cur:
+                        cur.executemany(UPDATE_SQL[table], updates)
+                conn.commit()
+                rewritten += len(updates)
+                batches += 1
+            logger.info(
+                f"🗜️ {table}: {rewritten} rows compressed, {kept} kept (small or incompressible), "
+                f"-{saved / 1024 / 1024:.2f} MB of {before / 1024 / 1024:.2f} MB"
+            )
+    logger.info("Space is reusable after (auto)VACUUM")
+
+
+def main() -> None:
+    if "--train" in sys.argv:
+        train(_str_arg("--out", "checkpoint_zstd.dict"), _int_arg("--size", DEFAULT_DICT_SIZE))
+    elif "--migrate" in sys.argv:
+        migrate(_int_arg("--batch", DEFAULT_BATCH), _int_arg("--max-batches", None))
+    else:
+        benchmark(_int_arg("--sample", DEFAULT_SAMPLE))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Script de Compactación de Checkpoints de LangGraph (PostgresSaver).
+
+Aplica la política de retención de app/checkpoint_compaction.py sobre las
+tablas checkpoints, checkpoint_writes y checkpoint_blobs:
+  - borra los threads inactivos por más de --retention-days días,
+  - conserva solo los últimos --keep checkpoints de los demás threads,
+  - elimina writes y blobs huérfanos,
+en lotes de --batch threads (una transacción por lote). Reporta filas y
+bytes recuperados por tabla.
+
+Pensado para ejecutarse como job programado (Cloud Run Job / cron).
+
+Uso:
+    python script_compact_checkpoints.py                     # Valores de entorno
+    python script_compact_checkpoints.py --dry-run           # Solo reporta
+    python script_compact_checkpoints.py --keep 5 --retention-days 30
+    python script_compact_checkpoints.py --batch 100 --max-batches 10
+    python script_compact_checkpoints.py --vacuum            # VACUUM ANALYZE al final
+"""
+
+import os
+import sys
+import logging
+import psycopg
+from dotenv import load_dotenv
+
+load_dotenv()  # Before the app imports: they read their settings from the environment
+
+from app.checkpoint_compaction import (
+    TABLES,
+    CHECKPOINT_KEEP_LATEST,
+    CHECKPOINT_RETENTION_DAYS,
+    CHECKPOINT_ACTIVE_MINUTES,
+    CHECKPOINT_COMPACT_BATCH,
+    compact_checkpoints,
+)
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+
+def _int_arg(name: str, default):
+    if name not in sys.argv:
+        return default
+    idx = sys.argv.index(name)
+    if idx + 1 >= len(sys.argv) or not sys.argv[idx + 1].isdigit():
+        logger.error(f"{name} requires a number. Example: {name} 10")
+        sys.exit(1)
+    return int(sys.argv[idx + 1])
+
+
+def main() -> None:
+    if not DATABASE_URL:
+        logger.error("DATABASE_URL not configured")
+        sys.exit(1)
+
+    dry_run = "--dry-run" in sys.argv
+    with psycopg.connect(DATABASE_URL) as conn:
+        report = compact_checkpoints(
+            conn,
+            keep=_int_arg("--keep", CHECKPOINT_KEEP_LATEST),
+            retention_days=_int_arg("--retention-days", CHECKPOINT_RETENTION_DAYS),
+            active_minutes=_int_arg("--active-minutes", CHECKPOINT_ACTIVE_MINUTES),
+            batch_size=_int_arg("--batch", CHECKPOINT_COMPACT_BATCH),
+            max_batches=_int_arg("--max-batches", None),
+            dry_run=dry_run,
+        )
+
+        if "--vacuum" in sys.argv and not dry_run:
+            # VACUUM cannot run inside a transaction block
+            conn.autocommit = True
+            for table in TABLES:
+                logger.info(f"🧹 VACUUM ANALYZE {table}...")
+                conn.execute(f"VACUUM (ANALYZE) {table}")
+
+    total_rows = sum(report.rows.values())
+    total_mb = sum(report.bytes.values()) / 1024 / 1024
+    logger.info("=" * 60)
+    logger.info(f"{'Would reclaim' if dry_run else 'Reclaimed'}: {total_rows} rows, {total_mb:.2f} MB")
+    logger.info("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Script de Entrenamiento Offline del Re-Ranker local (FeatureReranker).
+
+Lee las llamadas de re-ranking registradas con RERANK_LOG_PATH (JSONL) y
+ajusta los pesos del modelo lineal de app/reranker.py por regresión
+logística. Las etiquetas de relevancia de cada registro salen de:
+  - "relevant": índices de candidatos marcados a mano, o
+  - "selected" de registros hechos con RERANKER=gemini (destilación), o
+  - --teacher gemini: re-etiqueta todos los registros con GeminiReranker.
+
+Reporta MRR del orden RRF vs el modelo ajustado y escribe el JSON que se
+carga con RERANK_WEIGHTS_PATH.
+
+Uso:
+    python script_fit_reranker.py rerank_log.jsonl
+    python script_fit_reranker.py rerank_log.jsonl --out reranker_weights.json
+    python script_fit_reranker.py rerank_log.jsonl --teacher gemini
+"""
+
+import sys
+import json
+import logging
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()  # Before the app imports: they read their settings from the environment
+
+from app.reranker import FEATURES, GeminiReranker, extract_features, fit_weights
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+TEACHER_TOP_K = 4  # Same as rag.DEFAULT_K
+
+
+def _load_examples(path: str, teacher: str = None) -> list[tuple[str, list[dict], set[int]]]:
+    gemini = GeminiReranker() if teacher == "gemini" else None
+    examples = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            chunks = record["candidates"]
+            if gemini is not None:
+                try:
+                    scores = gemini.score(record["query"], chunks, deadline=float("inf"))
+                except Exception as e:
+                    logger.warning(f"⚠️ Teacher failed for '{record['query'][:50]}': {e}")
+                    continue
+                ranked = sorted(range(len(chunks)), key=lambda i: -scores[i])[:TEACHER_TOP_K]
+                relevant = {i for i in ranked if scores[i] > 0}
+            elif "relevant" in record:
+                relevant = set(record["relevant"])
+            elif record.get("reranker") == "gemini":
+                relevant = set(record["selected"])
+            else:
+                continue  # No label for this record
+            if relevant and len(relevant) < len(chunks):
+                examples.append((record["query"], chunks, relevant))
+    return examples
+
+
+def _mrr(examples, weights: np.ndarray = None, bias: float = 0.0) -> float:
+    """MRR of the first relevant candidate (RRF order when weights is None)."""
+    total = 0.0
+    for query, chunks, relevant in examples:
+        if weights is None:
+            order = sorted(range(len(chunks)), key=lambda i: -chunks[i].get("rrf_score", 0.0))
+        else:
+            scores = extract_features(query, chunks) @ weights + bias
+            order = sorted(range(len(chunks)), key=lambda i: -scores[i])
+        rank = next(pos for pos, i in enumerate(order, 1) if i in relevant)
+        total += 1 / rank
+    return total / len(examples)
+
+
+def main(path: str, out: str, teacher: str = None) -> None:
+    examples = _load_examples(path, teacher)
+    if not examples:
+        logger.error("No labeled examples found. Log with RERANKER=gemini, add 'relevant' or use --teacher gemini.")
+        sys.exit(1)
+    logger.info(f"📊 Loaded {len(examples)} labeled queries from {path}")
+
+    model = fit_weights(examples)
+    weights = np.array([model["weights"][f] for f in FEATURES], dtype=np.float32)
+    logger.info(f"📊 MRR  rrf-order={_mrr(examples):.3f}  fitted={_mrr(examples, weights, model['bias']):.3f}")
+    logger.info(f"📊 Weights: {model['weights']} bias={model['bias']}")
+
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(model, f, indent=2)
+    logger.info(f"✅ Saved weights to {out} (set RERANK_WEIGHTS_PATH={out})")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1].startswith("--"):
+        logger.error("Usage: python script_fit_reranker.py <rerank_log.jsonl> [--out weights.json] [--teacher gemini]")
+        sys.exit(1)
+
+    out_path = "reranker_weights.json"
+    if "--out" in sys.argv:
+        out_path = sys.argv[sys.argv.index("--out") + 1]
+
+    teacher_name = None
+    if "--teacher" in sys.argv:
+        teacher_name = sys.argv[sys.argv.index("--teacher") + 1]
+        if teacher_name != "gemini":
+            logger.error(f"Unknown teacher: '{teacher_name}'. Valid options: gemini")
+            sys.exit(1)
+
+    main(sys.argv[1], out_path, teacher_name)
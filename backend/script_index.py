@@ -9,6 +9,10 @@ V2: Semantic chunking with parent-child strategy (Small-to-Big Retrieval).
     Child chunks (400 chars) are used for retrieval precision.
     tsvector is auto-populated by DB trigger.
 
+Re-indexing a document gives it a new rag_document id; running backends
+notice the changed corpus fingerprint and drop that department's semantic
+cache entries (see app/rag_cache.py).
+
 Uso:
     python script_index.py          # Indexa todos los PDFs
     python script_index.py --reset  # Borra datos existentes y re-indexa
@@ -23,7 +27,6 @@ import psycopg
 from dotenv import load_dotenv
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_core.documents import Document
 from app.preprocessing_service import (
     preprocess_pages,
@@ -31,6 +34,7 @@ from app.preprocessing_service import (
     deduplicate_chunks,
     enrich_chunks_with_context,
 )
+from app.llm_providers import get_embeddings
 
 load_dotenv()
 
@@ -39,11 +43,9 @@ logger = logging.getLogger(__name__)
 
 # --- Config ---
 DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
-    raise ValueError("DATABASE_URL is not set in environment.")
 
 DOCS_DIR = os.path.join(os.path.dirname(__file__), "docs")
-embeddings_model = GoogleGenerativeAIEmbeddings(model="models/gemini-embedding-001")
+embeddings_model = get_embeddings("models/gemini-embedding-001")
 
 FILES_CONFIG = [
     ("atencion al asociado.pdf", "Atención al Asociado", "atencion_asociado"),
@@ -160,6 +162,32 @@ def split_vivienda_by_project(docs) -> tuple[list[dict], list[dict]]:
     return create_parent_child_chunks(pages)
 
 
+def build_chunks(filepath: str, department: str) -> tuple[list[dict], list[dict]]:
+    """
+    Load a PDF and produce its (parent_chunks, child_chunks), before LLM enrichment.
+
+    Shared with tests/rag_benchmark.py, which builds an offline index from the
+    same chunks.
+    """
+    loader = PyPDFLoader(filepath)
+    docs = loader.load()
+    logger.info(f"  Loaded {len(docs)} pages from PDF")
+
+    # Create parent/child chunks
+    if department == "vivienda":
+        parent_chunks, child_chunks = split_vivienda_by_project(docs)
+    else:
+        pages = [{"content": d.page_content, "page_number": d.metadata.get("page", 0)} for d in docs]
+        # Preprocess pages (clean, normalize, remove headers)
+        pages = preprocess_pages(pages)
+        parent_chunks, child_chunks = create_parent_child_chunks(pages)
+
+    # Post-chunking preprocessing
+    child_chunks = quality_gate(child_chunks)
+    child_chunks = deduplicate_chunks(child_chunks)
+    return parent_chunks, child_chunks
+
+
 def process_and_index(reset: bool = False, only: str = None):
     """
     Main indexing function with parent-child chunking.
@@ -169,6 +197,9 @@ def process_and_index(reset: bool = False, only: str = None):
         only:  Re-index a single file by filename (e.g. "credito.pdf").
                Deletes only that file's chunks before re-indexing.
     """
+    if not DATABASE_URL:
+        raise ValueError("DATABASE_URL is not set in environment.")
+
     logger.info("=" * 60)
     logger.info("Starting RAG Offline Indexer (v2 — Semantic Chunking)")
     logger.info(f"Database: {DATABASE_URL.split('@')[1] if '@' in DATABASE_URL else 'configured'}")
@@ -237,25 +268,8 @@ def process_and_index(reset: bool = False, only: str = None):
         )
 
         try:
-            # Load PDF
-            loader = PyPDFLoader(filepath)
-            docs = loader.load()
-            logger.info(f"  Loaded {len(docs)} pages from PDF")
-
-            # Create parent/child chunks
-            if department == "vivienda":
-                parent_chunks, child_chunks = split_vivienda_by_project(docs)
-            else:
-                pages = [{"content": d.page_content, "page_number": d.metadata.get("page", 0)} for d in docs]
-                # Preprocess pages (clean, normalize, remove headers)
-                pages = preprocess_pages(pages)
-                parent_chunks, child_chunks = create_parent_child_chunks(pages)
-
-            # Post-chunking preprocessing
-            child_chunks = quality_gate(child_chunks)
-            child_chunks = deduplicate_chunks(child_chunks)
-
-            all_chunks = parent_chunks + child_chunks
+            # Load PDF, chunk, quality gate and dedupe
+            parent_chunks, child_chunks = build_chunks(filepath, department)
             
             # LLM Contextual Enrichment
             child_chunks = enrich_chunks_with_context(child_chunks, title)
@@ -0,0 +1,280 @@
+"""
+RAG Retrieval Benchmark — offline quality and latency harness.
+
+Runs the versioned cases in tests/rag_benchmark_cases.json through the two
+retrieval pipelines used by the agents:
+  - plain:  rag.retrieve_chunks            (search_by_department)
+  - expand: tools._retrieve_with_expansion (consultar_* tools)
+
+and reports, per pipeline:
+  - recall@k, hit@k and MRR against the expected text/pages of each case
+  - latency percentiles (p50/p95/p99) of the whole call and of each stage
+    (semantic_cache, expand_llm, embed, search, parents, rerank)
+  - characters of the context produced for the LLM prompt
+
+Backends:
+  --backend memory    Builds the in-process index (app/rag_index.py) from
+                      docs/*.pdf with the same chunking as script_index.py
+                      (no LLM enrichment). No database needed.
+  --backend pgvector  Queries DATABASE_URL (local Postgres + pgvector).
+
+Embedders:
+  --embedder hash     Deterministic HashEmbeddings from app/llm_providers.py,
+                      no network (default with --backend memory)
+  --embedder gemini   The production embedding model (default with pgvector,
+                      must match the embeddings stored in rag_chunk)
+
+Without --online, LLM_PROVIDER=fake replaces the query-expansion LLM and
+the Gemini reranker with FakeChatModel, so the benchmark never calls the
+network with --backend memory --embedder hash.
+
+Uso:
+    cd backend
+    python tests/rag_benchmark.py
+    python tests/rag_benchmark.py --pipeline expand --repeat 5 --cold
+    python tests/rag_benchmark.py --backend pgvector --online --json tests/results/rag.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import unicodedata
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+DEFAULT_CASES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rag_benchmark_cases.json")
+STAGES = ["semantic_cache", "expand_llm", "embed", "search", "parents", "rerank"]
+
+
+# --- Relevance ---
+
+def _fold(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return re.sub(r"\s+", " ", text)
+
+
+def _matches(chunk: dict, case: dict) -> set[str]:
+    """Expected items (texts/pages) satisfied by a retrieved chunk."""
+    content = _fold(chunk["content"])
+    found = {f"text:{t}" for t in case.get("expected_text", []) if _fold(t) in content}
+    if chunk.get("page_number") in case.get("expected_pages", []):
+        found.add(f"page:{chunk['page_number']}")
+    return found
+
+
+def _score_case(chunks: list[dict], case: dict, k: int) -> dict:
+    expected = {f"text:{t}" for t in case.get("expected_text", [])}
+    expected |= {f"page:{p}" for p in case.get("expected_pages", [])}
+    found = set()
+    first_rank = None
+    for rank, chunk in enumerate(chunks[:k], 1):
+        matched = _matches(chunk, case)
+        if matched and first_rank is None:
+            first_rank = rank
+        found |= matched
+    return {
+        "recall": len(found & expected) / len(expected) if expected else 0.0,
+        "hit": first_rank is not None,
+        "rr": 1 / first_rank if first_rank else 0.0,
+        "first_rank": first_rank,
+    }
+
+
+def _percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 2), "p95": round(float(p95), 2),
+            "p99": round(float(p99), 2), "mean": round(float(np.mean(values)), 2)}
+
+
+# --- Setup ---
+
+def _configure_environment(args) -> str:
+    """
+    Must run before importing app.*: modules read their config at import.
+    Returns the embedder name.
+    """
+    embedder = args.embedder or ("hash" if args.backend == "memory" else "gemini")
+    os.environ["RAG_BACKEND"] = args.backend
+    os.environ["LLM_PROVIDER"] = "google" if args.online else "fake"
+    os.environ["EMBEDDINGS_PROVIDER"] = "fake" if embedder == "hash" else "google"
+    os.environ["SEMANTIC_CACHE_ENABLED"] = "true" if args.semantic_cache else "false"
+    os.environ["EMBEDDING_CACHE_PERSIST"] = "false"
+    os.environ["EXPANSION_CACHE_PERSIST"] = "false"
+    os.environ["RERANKER"] = args.reranker
+    return embedder
+
+
+def _build_memory_index(rag, embedder, departments: set[str]) -> dict:
+    """Index docs/*.pdf for the departments under test; returns chunk counts."""
+    import uuid
+    import logging
+    from script_index import DOCS_DIR, FILES_CONFIG, build_chunks
+    from app.rag_index import DepartmentIndex
+
+    logging.getLogger("script_index").setLevel(logging.WARNING)
+    logging.getLogger("app.preprocessing_service").setLevel(logging.WARNING)
+    sizes = {}
+    versions = {}
+    # Serve the offline indexes as the corpus: refresh() sees no version change
+    rag.memory_index.fetch_versions = lambda: dict(versions)
+    for filename, _, department in FILES_CONFIG:
+        if department not in departments:
+            continue
+        parents, children = build_chunks(os.path.join(DOCS_DIR, filename), department)
+        parent_ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{filename}#p{i}")) for i in range(len(parents))]
+        child_ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{filename}#c{i}")) for i in range(len(children))]
+        vectors = np.array(embedder.embed_documents([c["content"] for c in children]), dtype=np.float32)
+        index = DepartmentIndex(
+            ids=child_ids,
+            parent_ids=[parent_ids[c["parent_index"]] for c in children],
+            page_numbers=[c.get("page_number") for c in children],
+            contents=[c["content"] for c in children],
+            matrix=DepartmentIndex.normalize_rows(vectors),
+            parents={pid: p["content"] for pid, p in zip(parent_ids, parents)},
+        )
+        rag.memory_index.set_department(department, index)
+        versions[department] = "static"
+        sizes[department] = len(children)
+    return sizes
+
+
+def _clear_caches(rag, tools) -> None:
+    rag.query_embeddings._memory.clear()
+    tools.expansion_cache._memory.clear()
+    if rag.semantic_cache is not None:
+        rag.semantic_cache.invalidate()
+
+
+# --- Run ---
+
+def run(args) -> dict:
+    embedder_name = _configure_environment(args)
+
+    from app import rag, tools
+    from app.rag_timing import collect_stage_timings
+
+    with open(args.cases, encoding="utf-8") as f:
+        suite = json.load(f)
+    cases = [c for c in suite["cases"] if not args.department or c["department"] == args.department]
+
+    index_sizes = {}
+    if args.backend == "memory":
+        index_sizes = _build_memory_index(rag, rag.query_embeddings.embeddings, {c["department"] for c in cases})
+
+    pipelines = {
+        "plain": lambda c: rag.retrieve_chunks(c["question"], c["department"], k=args.k),
+        "expand": lambda c: tools._retrieve_with_expansion(c["department"], c["question"], k=args.k),
+    }
+    selected = list(pipelines) if args.pipeline == "both" else [args.pipeline]
+
+    report = {
+        "cases_version": suite["version"],
+        "config": {
+            "backend": args.backend,
+            "embedder": embedder_name,
+            "k": args.k,
+            "repeat": args.repeat,
+            "cold": args.cold,
+            "online": args.online,
+            "reranker": rag.reranker.name if rag.reranker else "none",
+            "speculative_expansion": tools.SPECULATIVE_EXPANSION,
+            "index_sizes": index_sizes,
+        },
+        "pipelines": {},
+    }
+
+    for name in selected:
+        retrieve = pipelines[name]
+        rows = []
+        totals, stage_ms = [], {s: [] for s in STAGES}
+        for case in cases:
+            first_chunks = None
+            for _ in range(args.repeat):
+                if args.cold:
+                    _clear_caches(rag, tools)
+                with collect_stage_timings() as timings:
+                    started = time.perf_counter()
+                    chunks = retrieve(case)
+                    totals.append((time.perf_counter() - started) * 1000)
+                for s in STAGES:
+                    if s in timings:
+                        stage_ms[s].append(timings[s])
+                if first_chunks is None:
+                    first_chunks = chunks
+
+            score = _score_case(first_chunks, case, args.k)
+            rows.append({
+                "id": case["id"],
+                "department": case["department"],
+                **score,
+                "prompt_chars": len(rag._format_output(first_chunks, case["department"])),
+                "chunks": len(first_chunks),
+            })
+            if not args.cold:
+                _clear_caches(rag, tools)  # Do not let one case warm the next
+
+        n = len(rows) or 1
+        report["pipelines"][name] = {
+            f"recall@{args.k}": round(sum(r["recall"] for r in rows) / n, 4),
+            f"hit@{args.k}": round(sum(r["hit"] for r in rows) / n, 4),
+            "mrr": round(sum(r["rr"] for r in rows) / n, 4),
+            "prompt_chars": _percentiles([r["prompt_chars"] for r in rows]),
+            "latency_ms": {"total": _percentiles(totals), **{s: _percentiles(v) for s, v in stage_ms.items() if v}},
+            "cases": rows,
+        }
+    return report
+
+
+def _print_report(report: dict, k: int) -> None:
+    config = report["config"]
+    print("=" * 72)
+    print(f"RAG benchmark — cases v{report['cases_version']} | backend={config['backend']} "
+          f"embedder={config['embedder']} reranker={config['reranker']} k={k}")
+    if config["index_sizes"]:
+        print(f"Index: {config['index_sizes']}")
+    for name, result in report["pipelines"].items():
+        print("-" * 72)
+        print(f"[{name}] recall@{k}={result[f'recall@{k}']:.3f}  hit@{k}={result[f'hit@{k}']:.3f}  "
+              f"MRR={result['mrr']:.3f}  prompt_chars p50={result['prompt_chars']['p50']:.0f} "
+              f"p95={result['prompt_chars']['p95']:.0f}")
+        print(f"  {'stage':<15}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+        for stage_name, pct in result["latency_ms"].items():
+            print(f"  {stage_name:<15}{pct['p50']:>10.2f}{pct['p95']:>10.2f}{pct['p99']:>10.2f}{pct['mean']:>10.2f}")
+        misses = [r["id"] for r in result["cases"] if not r["hit"]]
+        if misses:
+            print(f"  misses: {', '.join(misses)}")
+    print("=" * 72)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline RAG retrieval benchmark")
+    parser.add_argument("--cases", default=DEFAULT_CASES)
+    parser.add_argument("--backend", choices=["memory", "pgvector"], default="memory")
+    parser.add_argument("--embedder", choices=["hash", "gemini"])
+    parser.add_argument("--pipeline", choices=["plain", "expand", "both"], default="both")
+    parser.add_argument("--reranker", choices=["feature", "gemini", "none"], default="feature")
+    parser.add_argument("--department", help="Only run the cases of one department")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case (latency samples)")
+    parser.add_argument("--cold", action="store_true", help="Clear in-process caches before every run")
+    parser.add_argument("--semantic-cache", action="store_true", help="Keep the semantic cache enabled")
+    parser.add_argument("--online", action="store_true", help="Allow Gemini calls (expansion, reranker)")
+    parser.add_argument("--json", help="Also write the full report to this path")
+    cli_args = parser.parse_args()
+
+    result_report = run(cli_args)
+    _print_report(result_report, cli_args.k)
+    if cli_args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(cli_args.json)), exist_ok=True)
+        with open(cli_args.json, "w", encoding="utf-8") as f:
+            json.dump(result_report, f, ensure_ascii=False, indent=2)
+        print(f"Report written to {cli_args.json}")